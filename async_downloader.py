@@ -0,0 +1,182 @@
+import os
+import shutil
+import asyncio
+import logging
+import tempfile
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import httpx
+
+from instagram_downloader import InstagramDownloader, STAGING_DIR
+from metrics import STAGE_SECONDS, ERRORS
+from rate_limiter import Priority
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+
+
+class AsyncInstagramDownloader:
+    # Downloader methods with an async version here
+    METHODS = ('get_post_info', 'download_post')
+
+    def __init__(self, downloader: Optional[InstagramDownloader] = None, max_connections: int = 16,
+                 http2: bool = True, timeout: float = 60, resolve_workers: int = 4, disk_workers: int = 4):
+        """
+        Asyncio counterpart of InstagramDownloader, fetching media with httpx
+
+        Args:
+            downloader: synchronous downloader whose resolver, sessions and index are shared
+            max_connections: connections of the HTTP client of each session
+            http2: use HTTP/2 if h2 is installed
+            timeout: connect and read timeout in seconds
+            resolve_workers: threads waiting on Instagram for post metadata
+            disk_workers: threads writing and publishing media files
+        """
+        self.downloader = downloader or InstagramDownloader()
+        self.max_connections = max_connections
+        self.http2 = http2 and importlib.util.find_spec('h2') is not None
+        if http2 and not self.http2:
+            logger.info("h2 is not installed, media is fetched over HTTP/1.1")
+        self.timeout = timeout
+        # (client, free connections) per session spec
+        self._clients: List[Tuple[httpx.AsyncClient, asyncio.Semaphore]] = []
+        self._turn = 0
+        # Resolving blocks on loader leases and the rate limiter, so it must not hold disk threads
+        self._resolve_pool = ThreadPoolExecutor(max_workers=resolve_workers, thread_name_prefix="async-resolve")
+        self._disk_pool = ThreadPoolExecutor(max_workers=disk_workers, thread_name_prefix="async-disk")
+
+    def next_client(self) -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        """HTTP client of the next session spec, the clients are created on first use"""
+        if not self._clients:
+            from loader_pool import USER_AGENT
+            for spec in self.downloader.loader_pool.specs:
+                client = httpx.AsyncClient(
+                    http2=self.http2,
+                    headers={'User-Agent': USER_AGENT, **spec.headers},
+                    cookies=spec.cookies,
+                    proxy=spec.proxy,
+                    limits=httpx.Limits(max_connections=self.max_connections,
+                                        max_keepalive_connections=self.max_connections),
+                    # Downloads wait for a free connection instead of failing
+                    timeout=httpx.Timeout(self.timeout, pool=None),
+                    follow_redirects=True
+                )
+                # httpcore matches every queued request against every connection on
+                # each state change, so requests wait here until a connection is free
+                self._clients.append((client, asyncio.Semaphore(self.max_connections)))
+        entry = self._clients[self._turn % len(self._clients)]
+        self._turn += 1
+        return entry
+
+    async def _resolve(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._resolve_pool, func, *args)
+
+    async def _disk(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._disk_pool, func, *args)
+
+    async def get_post_info(self, url: str, priority: Priority = Priority.INTERACTIVE) -> Tuple[bool, str, dict]:
+        """
+        Get post information without downloading
+        """
+        return await self._resolve(self.downloader.get_post_info, url, priority)
+
+    async def download_post(self, url: str, download_path: str = "downloads",
+                            priority: Priority = Priority.INTERACTIVE) -> Tuple[bool, str, list, dict]:
+        """
+        Download Instagram post content with caption metadata
+
+        Returns:
+            (success, message, file_paths, post_info)
+        """
+        downloader = self.downloader
+        try:
+            if not downloader.is_valid_instagram_url(url):
+                return False, "❌ لینک اینستاگرام نامعتبر است", [], {}
+
+            shortcode = downloader.extract_shortcode(url)
+            if not shortcode:
+                return False, "❌ نمی‌توان کد پست را استخراج کرد", [], {}
+
+            target_dir = os.path.normpath(os.path.join(download_path, shortcode))
+
+            def resolve():
+                # Media URLs missing from a cached post are fetched from Instagram, rate limited
+                post = downloader.resolve_post(shortcode, priority)
+                return post, downloader.media_items(post)
+
+            post, media = await self._resolve(resolve)
+
+            # Same staging directory as the synchronous download, so an
+            # interrupted download never leaves a partial post in target_dir
+            staging_dir = await self._disk(self._make_staging_dir, download_path, shortcode)
+            try:
+                with STAGE_SECONDS.labels('fetch').time():
+                    await self._fetch_all(self.next_client(),
+                                          [(item['url'], os.path.join(staging_dir, item['filename']))
+                                           for item in media])
+                file_paths = await self._disk(downloader.publish_staged, staging_dir, target_dir)
+            finally:
+                await self._disk(shutil.rmtree, staging_dir, True)
+
+            return await self._disk(downloader.index_downloaded_post, post, file_paths, download_path)
+
+        except httpx.HTTPError as e:
+            logger.error(f"Media download failed: {e}")
+            ERRORS.labels('download', type(e).__name__).inc()
+            return False, f"❌ خطا در دانلود: {str(e)}", [], {}
+        except Exception as e:
+            ERRORS.labels('download', type(e).__name__).inc()
+            return False, downloader.download_error_message(e), [], {}
+
+    @staticmethod
+    def _make_staging_dir(download_path: str, shortcode: str) -> str:
+        staging_root = os.path.join(download_path, STAGING_DIR)
+        os.makedirs(staging_root, exist_ok=True)
+        return tempfile.mkdtemp(prefix=f"{shortcode}-", dir=staging_root)
+
+    async def _fetch_all(self, session: Tuple[httpx.AsyncClient, asyncio.Semaphore], files: list):
+        """Fetch (url, path) pairs concurrently over one session, cancelling the rest when one fails"""
+        tasks = [asyncio.ensure_future(self._fetch(*session, media_url, path)) for media_url, path in files]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Let cancelled transfers close their files before the staging directory goes
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _fetch(self, client: httpx.AsyncClient, slots: asyncio.Semaphore, media_url: str, path: str):
+        """Stream one media file to path and check it against Content-Length"""
+        async with slots, client.stream('GET', media_url) as response:
+            response.raise_for_status()
+            # Content-Length counts the bytes on the wire, before any decoding
+            expected = response.headers.get('Content-Length')
+            if response.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+                expected = None
+            written = 0
+            f = await self._disk(open, path, 'wb')
+            write = None
+            try:
+                async for chunk in response.aiter_bytes(READ_SIZE):
+                    write = self._disk_pool.submit(f.write, chunk)
+                    await asyncio.wrap_future(write)
+                    written += len(chunk)
+            finally:
+                # A cancelled wait leaves the write running, the file must outlive it
+                if write is not None and not write.done():
+                    await asyncio.wrap_future(write)
+                await self._disk(f.close)
+            if expected is not None and written != int(expected):
+                raise httpx.ReadError(f"Got {written} of {expected} bytes of {os.path.basename(path)}",
+                                      request=response.request)
+
+    async def aclose(self):
+        """Close the HTTP clients and stop the worker threads"""
+        clients, self._clients = self._clients, []
+        for client, _ in clients:
+            await client.aclose()
+        self._resolve_pool.shutdown(wait=False, cancel_futures=True)
+        self._disk_pool.shutdown(wait=False, cancel_futures=True)
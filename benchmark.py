@@ -0,0 +1,527 @@
+"""
+Offline load test for the bot
+
+Starts a fake Instagram (GraphQL + CDN) server and a fake Telegram Bot API
+server in a separate process, points the bot at them and pushes synthetic
+updates through the same Application the bot runs. Reports throughput,
+latency percentiles, peak memory and disk usage.
+
+    python benchmark.py --updates 2000 --posts 300
+    python benchmark.py --json results.json
+    python benchmark.py --compare results.json --tolerance 0.15
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import hashlib
+import argparse
+import contextlib
+import logging
+import resource
+import tempfile
+import multiprocessing
+from email import message_from_bytes
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import threading
+
+BOT_TOKEN = "123456:benchmark"
+SHORTCODE_ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-"
+
+
+# Fake Instagram
+
+def fake_post(shortcode: str, cdn_url: str, scale: float, repost_ratio: float) -> dict:
+    """Deterministic Polaris media item for a shortcode, of varied type and size"""
+    rng = random.Random(shortcode)
+    kind = rng.choices(['image', 'video', 'sidecar'], weights=[5, 3, 2])[0]
+    # Reposts carry the bytes of one of a few original posts
+    content = f"orig{rng.randint(0, 20)}" if rng.random() < repost_ratio else shortcode
+
+    def item(index: int, is_video: bool) -> dict:
+        image_size = int(rng.randint(80_000, 600_000) * scale)
+        node = {
+            'media_type': 2 if is_video else 1,
+            'code': shortcode,
+            'image_versions2': {'candidates': [{'url': f"{cdn_url}/cdn/{content}/{index}.jpg?size={image_size}"}]},
+        }
+        if is_video:
+            video_size = int(rng.randint(1_000_000, 15_000_000) * scale)
+            node['video_versions'] = [{'url': f"{cdn_url}/cdn/{content}/{index}.mp4?size={video_size}"}]
+        return node
+
+    if kind == 'sidecar':
+        children = [item(i, rng.random() < 0.3) for i in range(rng.randint(2, 10))]
+        media = dict(children[0], media_type=8, carousel_media=children)
+    else:
+        media = item(0, kind == 'video')
+
+    media.update({
+        'code': shortcode,
+        'pk': str(int(hashlib.sha256(shortcode.encode()).hexdigest()[:12], 16)),
+        'taken_at': 1700000000 + rng.randint(0, 10_000_000),
+        'user': {'pk': '1', 'username': 'benchmark', 'full_name': 'Benchmark'},
+        'caption': {'text': f"Benchmark post {shortcode}"},
+        'like_count': rng.randint(0, 100_000),
+        'comment_count': rng.randint(0, 1_000),
+        'view_count': rng.randint(0, 1_000_000),
+    })
+    return media
+
+
+class _Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, key: str, amount: int = 1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+
+class FakeInstagramHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; Nagle would delay keep-alive replies
+    disable_nagle_algorithm = True
+    stats = _Stats()
+    scale = 1.0
+    repost_ratio = 0.1
+
+    def _reply(self, status: int, body: bytes, content_type: str = 'application/json', headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/_stats':
+            self._reply(200, json.dumps(self.stats.counts).encode())
+        elif url.path.startswith('/cdn/'):
+            self._send_media(url)
+        else:
+            # Instaloader fetches the home page once for a csrftoken
+            self.stats.add('home')
+            self._reply(200, b'<html></html>', 'text/html', {'Set-Cookie': 'csrftoken=benchmark; Path=/'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urlparse(self.path).path.rstrip('/') != '/graphql/query':
+            self._reply(404, b'{}')
+            return
+        self.stats.add('graphql')
+        variables = json.loads(parse_qs(body.decode())['variables'][0])
+        cdn_url = f"http://{self.headers.get('Host', '127.0.0.1')}"
+        media = fake_post(variables['shortcode'], cdn_url, self.scale, self.repost_ratio)
+        payload = {'data': {'xdt_api__v1__media__shortcode__web_info': {'items': [media]}}, 'status': 'ok'}
+        self._reply(200, json.dumps(payload).encode())
+
+    def _send_media(self, url):
+        size = int(parse_qs(url.query).get('size', ['1024'])[0])
+        seed = hashlib.sha256(url.path.encode()).digest()
+        block = seed * (65536 // len(seed))
+        etag = f'"{seed.hex()[:16]}"'
+        # Byte ranges, as Instagram's CDN serves them
+        start, end = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        ranged = match is not None and self.headers.get('If-Range', etag) == etag
+        if ranged:
+            start, end = int(match[1]), min(int(match[2] or size - 1), size - 1)
+        self.stats.add('cdn')
+        self.stats.add('cdn_bytes', end - start + 1)
+        self.send_response(206 if ranged else 200)
+        self.send_header('Content-Type', 'video/mp4' if url.path.endswith('.mp4') else 'image/jpeg')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        if ranged:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        position = start
+        while position <= end:
+            offset = position % len(block)
+            chunk = block[offset:offset + min(end + 1 - position, len(block) - offset)]
+            self.wfile.write(chunk)
+            position += len(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Fake Telegram Bot API
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    stats = _Stats()
+    _ids = iter(range(1, 1 << 62))
+    _ids_lock = threading.Lock()
+
+    def _next_id(self) -> int:
+        with self._ids_lock:
+            return next(self._ids)
+
+    def _reply(self, result):
+        body = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _parse(self, body: bytes) -> dict:
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/'):
+            message = message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body, policy=HTTP)
+            fields = {}
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                if part.get_filename() is None:
+                    fields[name] = part.get_content()
+            return fields
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+    def do_GET(self):
+        if self.path == '/_stats':
+            body = json.dumps(self.stats.counts).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def _read_body(self) -> bytes:
+        """Read a request body sent with Content-Length or chunked transfer encoding"""
+        if 'chunked' not in self.headers.get('Transfer-Encoding', '').lower():
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # Skip trailers up to the blank line that ends the body
+                while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def do_POST(self):
+        body = self._read_body()
+        method = self.path.rsplit('/', 1)[-1]
+        fields = self._parse(body)
+        self.stats.add(method)
+        self.stats.add('bytes_in', len(body))
+
+        if method == 'getMe':
+            self._reply({'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'})
+            return
+
+        chat_id = int(fields.get('chat_id', 0))
+        text = fields.get('text', '')
+        if isinstance(text, str) and text.startswith('❌'):
+            self.stats.add('error_messages')
+
+        if method == 'sendMediaGroup':
+            media = fields['media'] if isinstance(fields['media'], list) else json.loads(fields['media'])
+            self._reply([self._message(chat_id, item['type']) for item in media])
+        elif method in ('sendPhoto', 'sendVideo', 'sendDocument', 'sendAnimation'):
+            self._reply(self._message(chat_id, method[4:].lower()))
+        else:
+            message_id = int(fields.get('message_id', 0)) or self._next_id()
+            self._reply(self._message(chat_id, None, message_id, text))
+
+    def _message(self, chat_id: int, kind, message_id: int = None, text: str = '') -> dict:
+        message = {
+            'message_id': message_id or self._next_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }
+        if kind is None:
+            message['text'] = text or '.'
+            return message
+        file = {'file_id': f"F{self._next_id()}", 'file_unique_id': f"U{self._next_id()}"}
+        if kind == 'photo':
+            message['photo'] = [dict(file, width=1080, height=1080)]
+        elif kind == 'video':
+            message['video'] = dict(file, width=1080, height=1920, duration=10)
+        elif kind == 'animation':
+            message['animation'] = dict(file, width=1080, height=1920, duration=10)
+        else:
+            message['document'] = file
+        return message
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_fakes(ports: "multiprocessing.Queue", scale: float, repost_ratio: float):
+    """Run both fake backends until the process is terminated"""
+    FakeInstagramHandler.scale = scale
+    FakeInstagramHandler.repost_ratio = repost_ratio
+    instagram = ThreadingHTTPServer(('127.0.0.1', 0), FakeInstagramHandler)
+    telegram = ThreadingHTTPServer(('127.0.0.1', 0), FakeTelegramHandler)
+    instagram.daemon_threads = telegram.daemon_threads = True
+    threading.Thread(target=telegram.serve_forever, daemon=True).start()
+    ports.put((instagram.server_address[1], telegram.server_address[1]))
+    instagram.serve_forever()
+
+
+# Load generation
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def disk_usage(path: str) -> dict:
+    """Apparent bytes and allocated bytes, hardlinked files counted once"""
+    seen = set()
+    apparent = allocated = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            st = os.lstat(os.path.join(root, file))
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            apparent += st.st_size
+            allocated += st.st_blocks * 512
+    return {'apparent_bytes': apparent, 'allocated_bytes': allocated}
+
+
+def stage_means(rendered: str) -> dict:
+    """Mean seconds per stage from the rendered stage histogram"""
+    sums, counts = {}, {}
+    for line in rendered.splitlines():
+        for suffix, target in (('_sum{', sums), ('_count{', counts)):
+            prefix = 'insta_stage_duration_seconds' + suffix
+            if line.startswith(prefix):
+                stage = line[len(prefix):].split('"')[1]
+                target[stage] = float(line.rsplit(' ', 1)[1])
+    return {stage: {'count': int(counts[stage]), 'mean_seconds': sums[stage] / counts[stage]}
+            for stage in sorted(counts) if counts[stage]}
+
+
+def make_shortcodes(count: int, rng: random.Random) -> list:
+    return [''.join(rng.choice(SHORTCODE_ALPHABET) for _ in range(11)) for _ in range(count)]
+
+
+async def drive(args, instagram_url: str, telegram_url: str) -> dict:
+    # Imported here so the environment set up by main() is what config.py reads
+    import instaloader
+    from telegram import Update
+    from telegram.ext import Application
+    from bot import InstagramDownloadBot
+    from metrics import REGISTRY
+
+    # Instaloader's own sleeps and fixed per-query windows model Instagram's
+    # server-side limits; the bot's adaptive limiter still paces every query
+    instaloader.InstaloaderContext.do_sleep = lambda self: None
+    instaloader.RateController.wait_before_query = lambda self, query_type: None
+
+    logging.getLogger().setLevel(args.log_level)
+
+    app = InstagramDownloadBot()
+    latencies = []
+    enqueued_at = {}
+    done = asyncio.Event()
+
+    original_process_job = app.process_job
+
+    async def timed_process_job(bot, chat_id, *rest, **kwargs):
+        try:
+            return await original_process_job(bot, chat_id, *rest, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - enqueued_at[chat_id])
+            if len(latencies) == args.updates:
+                done.set()
+
+    app.process_job = timed_process_job
+
+    application = app.build_application(
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f"{telegram_url}/bot")
+        .base_file_url(f"{telegram_url}/file/bot")
+    )
+    await application.initialize()
+    await application.start()
+
+    rng = random.Random(args.seed)
+    shortcodes = make_shortcodes(args.posts, rng)
+    # Popularity follows a Zipf-like curve, so some posts are requested often
+    weights = [1 / (rank + 1) for rank in range(len(shortcodes))]
+    route = ['p', 'reel', 'tv']
+
+    started = time.perf_counter()
+    for i in range(args.updates):
+        chat_id = 100_000 + i
+        shortcode = rng.choices(shortcodes, weights)[0]
+        update = Update.de_json({
+            'update_id': i + 1,
+            'message': {
+                'message_id': i + 1,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': 1_000 + i % args.users, 'is_bot': False, 'first_name': 'User'},
+                'text': f"https://www.instagram.com/{rng.choice(route)}/{shortcode}/",
+            }
+        }, application.bot)
+        enqueued_at[chat_id] = time.perf_counter()
+        await application.update_queue.put(update)
+        if args.arrival_rate:
+            await asyncio.sleep(1 / args.arrival_rate)
+
+    try:
+        await asyncio.wait_for(done.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        logging.getLogger(__name__).error(f"Timed out with {len(latencies)} of {args.updates} updates done")
+    elapsed = time.perf_counter() - started
+
+    await application.stop()
+    await application.shutdown()
+    await app.executor.aclose()
+    app.executor.shutdown(wait=True)
+
+    return {
+        'updates': args.updates,
+        'completed': len(latencies),
+        'elapsed_seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_seconds': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies, default=0.0),
+        },
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'disk': disk_usage(app.download_path),
+        'stages': stage_means(REGISTRY.render()),
+    }
+
+
+def fetch_stats(url: str) -> dict:
+    import requests
+    return requests.get(f"{url}/_stats", timeout=10).json()
+
+
+def compare(results: dict, baseline_path: str, tolerance: float) -> list:
+    """Regressions of results against a saved baseline"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = []
+    if results['requests_per_second'] < baseline['requests_per_second'] * (1 - tolerance):
+        regressions.append(f"throughput {results['requests_per_second']:.1f} < "
+                           f"{baseline['requests_per_second']:.1f} req/s")
+    for q in ('p50', 'p95', 'p99'):
+        if results['latency_seconds'][q] > baseline['latency_seconds'][q] * (1 + tolerance):
+            regressions.append(f"{q} latency {results['latency_seconds'][q]:.3f} > "
+                               f"{baseline['latency_seconds'][q]:.3f} s")
+    if results['peak_rss_bytes'] > baseline['peak_rss_bytes'] * (1 + tolerance):
+        regressions.append(f"peak memory {results['peak_rss_bytes']} > {baseline['peak_rss_bytes']} bytes")
+    return regressions
+
+
+def print_report(results: dict):
+    mb = 1024 * 1024
+    latency = results['latency_seconds']
+    print(f"Completed:   {results['completed']}/{results['updates']} updates in {results['elapsed_seconds']:.1f}s")
+    print(f"Throughput:  {results['requests_per_second']:.1f} req/s")
+    print(f"Latency:     p50 {latency['p50'] * 1000:.0f} ms, p95 {latency['p95'] * 1000:.0f} ms, "
+          f"p99 {latency['p99'] * 1000:.0f} ms, max {latency['max'] * 1000:.0f} ms")
+    print(f"Peak memory: {results['peak_rss_bytes'] / mb:.1f} MB")
+    print(f"Disk:        {results['disk']['allocated_bytes'] / mb:.1f} MB allocated, "
+          f"{results['disk']['apparent_bytes'] / mb:.1f} MB apparent")
+    print("Stages:")
+    for stage, data in results['stages'].items():
+        print(f"  {stage:<16} {data['count']:>7}  {data['mean_seconds'] * 1000:>9.1f} ms mean")
+    print(f"Instagram:   {results['instagram']}")
+    print(f"Telegram:    {results['telegram']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot against local fake backends")
+    parser.add_argument('--updates', type=int, default=1000, help="synthetic updates to send")
+    parser.add_argument('--posts', type=int, default=200, help="distinct shortcodes to draw from")
+    parser.add_argument('--users', type=int, default=50, help="distinct users sending links")
+    parser.add_argument('--scale', type=float, default=0.05, help="media size multiplier (1.0 = real sizes)")
+    parser.add_argument('--repost-ratio', type=float, default=0.1, help="share of posts reusing other media")
+    parser.add_argument('--arrival-rate', type=float, default=0, help="updates per second, 0 sends all at once")
+    parser.add_argument('--timeout', type=float, default=600, help="seconds to wait for all updates")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help="directory for downloads (default: a temporary directory)")
+    parser.add_argument('--keep', action='store_true', help="keep the work directory")
+    parser.add_argument('--json', help="write results to this file")
+    parser.add_argument('--compare', help="baseline results file; exit 1 on regression")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed relative regression")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    ports = multiprocessing.Queue()
+    fakes = multiprocessing.Process(target=serve_fakes, args=(ports, args.scale, args.repost_ratio), daemon=True)
+    fakes.start()
+    instagram_port, telegram_port = ports.get(timeout=30)
+    instagram_url = f"http://127.0.0.1:{instagram_port}"
+    telegram_url = f"http://127.0.0.1:{telegram_port}"
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    cwd = os.getcwd()
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="insta-bench-"))
+    os.makedirs(workdir, exist_ok=True)
+    sessions_file = os.path.join(workdir, 'sessions.json')
+    with open(sessions_file, 'w', encoding='utf-8') as f:
+        json.dump([{'name': 'benchmark', 'endpoint': instagram_url}], f)
+
+    os.environ.update({
+        'BOT_TOKEN': BOT_TOKEN,
+        'INSTAGRAM_SESSIONS_FILE': sessions_file,
+        'INSTAGRAM_RATE': os.getenv('INSTAGRAM_RATE', '10000'),
+        'INSTAGRAM_BURST': os.getenv('INSTAGRAM_BURST', '10000'),
+        'METRICS_PORT': '0',
+        # Measure throughput, not the per-user abuse limits
+        'USER_RATE_LIMIT': '0',
+    })
+    # The bot keeps its downloads under the working directory
+    sys.path.insert(0, repo)
+    os.chdir(workdir)
+
+    try:
+        # Instaloader prints every file it saves
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = asyncio.run(drive(args, instagram_url, telegram_url))
+        results['instagram'] = fetch_stats(instagram_url)
+        results['telegram'] = fetch_stats(telegram_url)
+    finally:
+        fakes.terminate()
+        os.chdir(cwd)
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
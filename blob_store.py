@@ -0,0 +1,109 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    def __init__(self, root: str):
+        """
+        Content-addressed media store keyed by SHA-256
+
+        Every distinct media file is kept once as `<root>/<aa>/<sha256>`.
+        Post directories hold hardlinks to these blobs, so the same bytes
+        under several shortcodes take disk space only once. Reference counts
+        live in the post index, which decides when a blob may be removed.
+        """
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def variant_path(self, sha256: str, suffix: str) -> str:
+        """Path of a file derived from a blob, e.g. a transcoded copy, kept next to it"""
+        return f"{self.path(sha256)}.{suffix}"
+
+    def has(self, sha256: str) -> bool:
+        return os.path.isfile(self.path(sha256))
+
+    def link(self, file_path: str, sha256: str) -> bool:
+        """
+        Make file_path a hardlink of the blob with its content
+
+        The first file with a given hash becomes the blob, later copies are
+        replaced by links to it.
+
+        Returns:
+            False if the file system does not support hardlinks and the file
+            was left as a separate copy
+        """
+        blob_path = self.path(sha256)
+        try:
+            if not os.path.exists(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                try:
+                    os.link(file_path, blob_path)
+                    return True
+                except FileExistsError:
+                    # Another process stored the same content first
+                    pass
+
+            if not os.path.samefile(file_path, blob_path):
+                temp_path = file_path + '.link'
+                os.link(blob_path, temp_path)
+                os.replace(temp_path, file_path)
+            return True
+        except OSError as e:
+            logger.warning(f"Could not link {file_path} to blob {sha256}: {e}")
+            return False
+
+    def restore(self, sha256: str, file_path: str) -> bool:
+        """
+        Recreate a deleted post file from its blob
+
+        Returns:
+            True if file_path now holds the blob's content
+        """
+        blob_path = self.path(sha256)
+        if not os.path.isfile(blob_path):
+            return False
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            if os.path.exists(file_path) and os.path.samefile(file_path, blob_path):
+                return True
+            temp_path = file_path + '.link'
+            os.link(blob_path, temp_path)
+            os.replace(temp_path, file_path)
+            return True
+        except OSError as e:
+            logger.warning(f"Could not restore {file_path} from blob {sha256}: {e}")
+            return False
+
+    def variant_paths(self, sha256: str) -> list:
+        """Files derived from a blob"""
+        directory = os.path.dirname(self.path(sha256))
+        try:
+            return [os.path.join(directory, name) for name in os.listdir(directory) if name.startswith(sha256 + '.')]
+        except FileNotFoundError:
+            return []
+
+    def variant_size(self, sha256: str) -> int:
+        """Bytes of the files derived from a blob"""
+        size = 0
+        for path in self.variant_paths(sha256):
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def remove(self, sha256: str):
+        """Delete a blob that is no longer referenced, with the files derived from it"""
+        for path in [self.path(sha256)] + self.variant_paths(sha256):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not delete {path}: {e}")
@@ -1,23 +1,176 @@
 import os
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import httpx
+from telegram import Bot, Chat, Message, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
+import time
+import math
 import asyncio
-from config import BOT_TOKEN,DOWNLOAD_PATH, MAX_FILE_SIZE
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from datetime import datetime, timezone
+from config import (BOT_TOKEN, DOWNLOAD_PATH, MAX_FILE_SIZE,
+                    DOWNLOAD_EXECUTOR, DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_LIMIT, ASYNC_HTTP_CONNECTIONS, ASYNC_HTTP2,
+                    MEDIA_GROUP_SIZE, MEDIA_GROUP_MAX_ITEM_SIZE,
+                    UPLOAD_CONCURRENCY_PER_CHAT, UPLOAD_CONCURRENCY_GLOBAL, SAVED_PAGE_SIZE,
+                    STORAGE_QUOTA_BYTES, STORAGE_EVICTION_POLICY, STORAGE_CHECK_INTERVAL,
+                    STREAMING_MODE, STREAMING_TEE, STREAM_CHUNK_SIZE,
+                    BOT_MODE, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+                    WORKER_MODE, JOB_QUEUE_PATH, METRICS_PORT, METRICS_ADDR, LOG_TRACE_IDS,
+                    BATCH_MAX_LINKS, BATCH_CONCURRENCY, PROFILE_DEFAULT_POSTS, PROFILE_MAX_POSTS,
+                    TRANSCODE_ENABLED, TRANSCODE_WORKERS, TRANSCODE_MAX_BYTES, TRANSCODE_MAX_DIMENSION,
+                    TRANSCODE_PRESET, TRANSCODE_TIMEOUT, FFMPEG_PATH, FFPROBE_PATH,
+                    SCHEDULER_CONCURRENCY, USER_MAX_IN_FLIGHT, USER_RATE_LIMIT, USER_RATE_WINDOW, CHAT_WEIGHTS,
+                    PREFETCH_ENABLED, PREFETCH_INTERVAL, PREFETCH_TOP, PREFETCH_MIN_SCORE, PREFETCH_CHAT_ID,
+                    POPULARITY_HALF_LIFE, POPULARITY_MAX_ITEMS)
 from instagram_downloader import InstagramDownloader
+from download_executor import DownloadExecutor, QueueFullError
+from async_downloader import AsyncInstagramDownloader
+from single_flight import SingleFlight
+from storage_manager import StorageManager
+from download_queue import DownloadQueue
+from fair_scheduler import FairScheduler, RateLimitedError
+from media_processor import MediaProcessor, VideoVariant
+from popularity import PopularityTracker
+from prefetcher import Prefetcher
+from rate_limiter import Priority
+from metrics import (STAGE_SECONDS, BYTES_DOWNLOADED, BYTES_UPLOADED, FILES_SENT, ERRORS, QUEUE_DEPTH,
+                     start_http_server)
+from tracing import new_trace_id, install_trace_ids
 
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+if LOG_TRACE_IDS:
+    install_trace_ids('%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s')
 logger = logging.getLogger(__name__)
 
+# Journal owner of the jobs run inside the bot process
+INLINE_WORKER = 'inline'
+
+
+def job_message(bot: Bot, job: dict) -> Message:
+    """Rebuild the status message the bot created for a journaled job"""
+    processing_msg = Message(
+        message_id=job['message_id'],
+        date=datetime.now(timezone.utc),
+        chat=Chat(id=job['chat_id'], type=Chat.PRIVATE)
+    )
+    processing_msg.set_bot(bot)
+    return processing_msg
+
+
+class _BatchProgress:
+    """Progress of a batch shown in one status message, edited at most once per interval"""
+
+    def __init__(self, status_msg: Message, header: str, total: int, interval: float = 2.0):
+        self.status_msg = status_msg
+        self.header = header
+        self.total = total
+        self.interval = interval
+        self.sent = 0
+        self.failed = []
+        self._last_edit = 0.0
+
+    @property
+    def done(self) -> int:
+        return self.sent + len(self.failed)
+
+    async def update(self, url: str, success: bool, message: str):
+        if success:
+            self.sent += 1
+        else:
+            self.failed.append(f"• {url}\n  {message}")
+        if time.monotonic() - self._last_edit >= self.interval:
+            await self._edit(f"🔄 {self.done}/{self.total} انجام شد")
+
+    async def finish(self):
+        text = f"🏁 پایان: {self.done}/{self.total} انجام شد"
+        if self.failed:
+            # Keep the report under Telegram's message length limit
+            text += "\n\n❌ ناموفق:\n" + "\n".join(self.failed)[:3000]
+        await self._edit(text)
+
+    async def _edit(self, progress: str):
+        self._last_edit = time.monotonic()
+        text = f"{self.header}\n{progress}\n✅ موفق: {self.sent}  ❌ ناموفق: {len(self.failed)}"
+        try:
+            await self.status_msg.edit_text(text)
+        except TelegramError as e:
+            # Flood control or a timeout must not stop the batch, the next update retries
+            logger.warning(f"Could not update batch status: {e}")
+
+
 class InstagramDownloadBot:
     def __init__(self):
         self.downloader = InstagramDownloader()
         self.download_path = DOWNLOAD_PATH
+        self.executor = DownloadExecutor(
+            self.downloader,
+            mode=DOWNLOAD_EXECUTOR,
+            max_workers=DOWNLOAD_WORKERS,
+            max_queue_depth=DOWNLOAD_QUEUE_LIMIT,
+            async_connections=ASYNC_HTTP_CONNECTIONS,
+            http2=ASYNC_HTTP2
+        )
+        # Concurrent requests for the same shortcode share one fetch/download
+        self.single_flight = SingleFlight()
+        # Fair share of the download path between chats, with per-user limits
+        self.scheduler = FairScheduler(
+            concurrency=SCHEDULER_CONCURRENCY,
+            max_in_flight_per_user=USER_MAX_IN_FLIGHT,
+            rate_limit=USER_RATE_LIMIT,
+            rate_window=USER_RATE_WINDOW,
+            weights=CHAT_WEIGHTS
+        )
+        # Upload concurrency limits, shared by all chats and per chat
+        self.global_upload_limit = asyncio.Semaphore(UPLOAD_CONCURRENCY_GLOBAL)
+        # chat_id -> [semaphore, uploads using it], dropped when the last one finishes
+        self.chat_upload_limits = {}
+        # Background quota enforcement for the downloads directory
+        self.storage = StorageManager(
+            self.downloader.get_cache(self.download_path),
+            quota_bytes=STORAGE_QUOTA_BYTES,
+            policy=STORAGE_EVICTION_POLICY,
+            check_interval=STORAGE_CHECK_INTERVAL
+        )
+        # Streamable variants and thumbnails of downloaded videos
+        self.media = MediaProcessor(
+            self.downloader.get_cache(self.download_path),
+            max_bytes=TRANSCODE_MAX_BYTES,
+            max_dimension=TRANSCODE_MAX_DIMENSION,
+            workers=TRANSCODE_WORKERS,
+            preset=TRANSCODE_PRESET,
+            timeout=TRANSCODE_TIMEOUT,
+            ffmpeg=FFMPEG_PATH,
+            ffprobe=FFPROBE_PATH,
+            enabled=TRANSCODE_ENABLED
+        )
+        # Request popularity of shortcodes, and warming of the trending ones
+        self.popularity = PopularityTracker(half_life=POPULARITY_HALF_LIFE, max_items=POPULARITY_MAX_ITEMS)
+        self.prefetcher = None
+        # Job journal, also the queue shared with worker.py processes in split mode
+        self.download_queue = DownloadQueue(JOB_QUEUE_PATH)
+        self._resumed_jobs = set()
+        # Shortcodes being streamed into the cache, and the client for streamed uploads
+        self._teeing = set()
+        self._upload_client: Optional[httpx.AsyncClient] = None
+        # CDN clients of streamed media, shared with the executor in 'async' mode
+        self.cdn = self.executor.async_downloader or AsyncInstagramDownloader(
+            self.downloader, max_connections=ASYNC_HTTP_CONNECTIONS, http2=ASYNC_HTTP2
+        )
+        # Disk writes of streamed media into the cache
+        self._tee_executor = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY_GLOBAL, thread_name_prefix="stream-tee")
+        # Read at scrape time by the /metrics endpoint
+        QUEUE_DEPTH.labels('executor').set_function(lambda: self.executor.queue_depth)
+        QUEUE_DEPTH.labels('jobs').set_function(self.download_queue.depth)
+        QUEUE_DEPTH.labels('scheduler').set_function(lambda: self.scheduler.queued)
         
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
@@ -82,8 +235,10 @@ https://instagram.com/tv/DEF456/
 /help - نمایش این راهنما
 /about - اطلاعات ربات
 /saved - نمایش پست‌های ذخیره شده
+/profile username [تعداد] - دانلود پست‌های آخر یک صفحه عمومی
 
 **نکات مهم:**
+• می‌توانید چند لینک را در یک پیام ارسال کنید
 • فقط پست‌های عمومی قابل دانلود هستند
 • فایل‌ها و اطلاعات ذخیره می‌شوند
 • حداکثر حجم فایل: 2GB (بدون محدودیت زمانی)
@@ -125,64 +280,59 @@ https://instagram.com/tv/DEF456/
     async def saved_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /saved command - show saved posts"""
         try:
-            import os
-            import json
-            
-            saved_posts = []
-            download_path = self.download_path
-            
-            if os.path.exists(download_path):
-                for file in os.listdir(download_path):
-                    if file.endswith('_metadata.json'):
-                        try:
-                            metadata_path = os.path.join(download_path, file)
-                            with open(metadata_path, 'r', encoding='utf-8') as f:
-                                post_info = json.load(f)
-                            
-                            # Check if files still exist
-                            valid_files = []
-                            for file_path in post_info.get('file_paths', []):
-                                if os.path.exists(file_path):
-                                    valid_files.append(file_path)
-                            
-                            if valid_files:
-                                saved_posts.append({
-                                    'shortcode': post_info.get('shortcode', 'Unknown'),
-                                    'username': post_info.get('username', 'Unknown'),
-                                    'date': post_info.get('date', 'Unknown'),
-                                    'is_video': post_info.get('is_video', False),
-                                    'file_count': len(valid_files)
-                                })
-                        except Exception as e:
-                            logger.error(f"Error reading metadata file {file}: {e}")
-            
-            if saved_posts:
-                text = "📁 **پست‌های ذخیره شده:**\n\n"
-                for i, post in enumerate(saved_posts, 1):
-                    media_type = "🎬 ویدیو" if post['is_video'] else "📸 عکس"
-                    text += f"{i}. @{post['username']}\n"
-                    text += f"   📅 {post['date']}\n"
-                    text += f"   {media_type} ({post['file_count']} فایل)\n"
-                    text += f"   🔗 https://instagram.com/p/{post['shortcode']}/\n\n"
-                
-                text += f"📊 **مجموع:** {len(saved_posts)} پست"
-            else:
-                text = "📁 هیچ پستی ذخیره نشده است"
-            
-            await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
+            text, reply_markup = await self._build_saved_page(update.effective_user.id, 0)
+            await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
             
         except Exception as e:
             logger.error(f"Error in saved command: {e}")
             await update.message.reply_text("❌ خطا در دریافت پست‌های ذخیره شده")
     
+    async def _build_saved_page(self, user_id: int, page: int):
+        """Build one page of the user's saved posts with navigation buttons"""
+        cache = self.downloader.get_cache(self.download_path)
+        total = await asyncio.to_thread(cache.count_posts, user_id)
+        if not total:
+            return "📁 هیچ پستی ذخیره نشده است", None
+        
+        pages = (total + SAVED_PAGE_SIZE - 1) // SAVED_PAGE_SIZE
+        page = max(0, min(page, pages - 1))
+        offset = page * SAVED_PAGE_SIZE
+        saved_posts = await asyncio.to_thread(cache.list_posts, user_id, offset, SAVED_PAGE_SIZE)
+        
+        text = "📁 **پست‌های ذخیره شده:**\n\n"
+        for i, post in enumerate(saved_posts, offset + 1):
+            media_type = "🎬 ویدیو" if post['is_video'] else "📸 عکس"
+            # Usernames and shortcodes often contain '_', which Markdown reads as italics
+            text += f"{i}. @{escape_markdown(post['username'])}\n"
+            text += f"   📅 {post['date']}\n"
+            text += f"   {media_type} ({post['file_count']} فایل)\n"
+            text += f"   🔗 https://instagram.com/p/{escape_markdown(post['shortcode'])}/\n\n"
+        
+        text += f"📊 **مجموع:** {total} پست"
+        
+        if pages == 1:
+            return text, None
+        
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"saved:{page - 1}"))
+        buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"saved:{page}"))
+        if page < pages - 1:
+            buttons.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"saved:{page + 1}"))
+        return text, InlineKeyboardMarkup([buttons])
+    
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle text messages"""
         message = update.message
         text = message.text
         
+        # Several post links in one message are handled as a batch
+        urls = self.downloader.extract_post_urls(text)
+        if len(urls) > 1:
+            await self.process_batch(update, context, urls)
         # Check if message contains Instagram URL
-        if "instagram.com" in text:
-            await self.process_instagram_url(update, context, text)
+        elif "instagram.com" in text:
+            await self.process_instagram_url(update, context, urls[0] if urls else text)
         else:
             await message.reply_text(
                 "❌ لطفاً لینک معتبر اینستاگرام ارسال کنید.\n\n"
@@ -192,19 +342,283 @@ https://instagram.com/tv/DEF456/
     async def process_instagram_url(self, update: Update, context: ContextTypes.DEFAULT_TYPE, url: str):
         """Process Instagram URL and download content"""
         message = update.message
+        chat_id = update.effective_chat.id
+        if not await self._admit(message, update.effective_user.id):
+            return
+        self._count_requests([url])
         
-        # Send processing message
-        processing_msg = await message.reply_text("🔄 در حال پردازش لینک...")
+        # Send processing message, with the place in line if the job has to wait
+        position = self.scheduler.position(chat_id) if WORKER_MODE != 'queue' else 0
+        if position:
+            processing_msg = await message.reply_text(f"🕒 در صف پردازش (نفر {position})...")
+        else:
+            processing_msg = await message.reply_text("🔄 در حال پردازش لینک...")
         
+        if WORKER_MODE == 'queue':
+            # Split deployment: a worker process picks the job up and edits this message
+            depth = await asyncio.to_thread(
+                self.download_queue.enqueue, update.effective_chat.id, update.effective_user.id, processing_msg.message_id, url
+            )
+            await processing_msg.edit_text(f"🕒 در صف دانلود (نفر {depth})...")
+            return
+        
+        # Journal the job so it is resumed if the bot restarts before it is sent
+        job_id = await asyncio.to_thread(
+            self.download_queue.start, update.effective_chat.id, update.effective_user.id, processing_msg.message_id,
+            url, INLINE_WORKER
+        )
+        await self.scheduler.run(chat_id, update.effective_user.id, lambda: self.process_job(
+            context.bot, chat_id, update.effective_user.id, processing_msg, url, job_id
+        ))
+    
+    async def _admit(self, message: Message, user_id: int, count: int = 1) -> int:
+        """Apply the per-user rate limit to `count` links, returning how many may be processed (0 if rejected)"""
+        try:
+            admitted = self.scheduler.admit(user_id, count)
+        except RateLimitedError as e:
+            logger.warning(f"Rate limited user {user_id} ({count} links)")
+            ERRORS.labels('admit', type(e).__name__).inc()
+            await message.reply_text(
+                f"⏳ تعداد لینک‌های ارسالی شما زیاد است، لطفاً {math.ceil(e.retry_after)} ثانیه دیگر تلاش کنید"
+            )
+            return 0
+        if admitted < count:
+            logger.info(f"Capped user {user_id} at {admitted} of {count} links")
+        return admitted
+    
+    def _count_requests(self, urls: list):
+        """Feed requested posts to the popularity tracker"""
+        for url in urls:
+            shortcode = self.downloader.extract_shortcode(url)
+            if shortcode:
+                self.popularity.record(shortcode)
+    
+    def _instagram_idle(self) -> bool:
+        """Whether no user download is waiting for Instagram, so prefetching may use the budget"""
+        if self.scheduler.queued or self.executor.queue_depth >= self.executor.max_workers:
+            return False
+        # Process workers have their own loader pools; the queue depth is all the bot sees of them
+        return self.executor.mode == 'process' or self.downloader.is_idle()
+    
+    async def _warm_post(self, bot: Bot, shortcode: str) -> bool:
+        """
+        Download a trending post before it is requested again
+        
+        With PREFETCH_CHAT_ID, files without a Telegram file_id are also
+        uploaded to that chat, so their file_ids are stored and later
+        requests are answered without an upload, even after eviction.
+        """
+        url = f"https://www.instagram.com/p/{shortcode}/"
+        success, download_msg, file_paths, _ = await self.single_flight.do(
+            ('download', shortcode),
+            lambda: self.executor.run('download_post', url, self.download_path, Priority.PREFETCH)
+        )
+        if not success:
+            logger.warning(f"Could not prefetch {shortcode}: {download_msg}")
+            return False
+        
+        if PREFETCH_CHAT_ID:
+            cache = self.downloader.get_cache(self.download_path)
+            post = await asyncio.to_thread(cache.get_post, shortcode)
+            missing = [f['path'] for f in post['files'] if not f['telegram_file_id']] if post else file_paths
+            if missing:
+                await self.send_downloaded_files(bot, PREFETCH_CHAT_ID, missing, f"📌 {shortcode}", shortcode)
+        self.storage.request_eviction()
+        return True
+    
+    async def _start_prefetcher(self, bot: Bot):
+        """Seed the popularity tracker from recent requests and start prefetching"""
+        cache = self.downloader.get_cache(self.download_path)
+        # Requests older than a few half-lives no longer add to any score
+        requests = await asyncio.to_thread(cache.recent_requests, time.time() - 5 * POPULARITY_HALF_LIFE)
+        for shortcode, requested_at in requests:
+            self.popularity.record(shortcode, at=requested_at)
+        logger.info(f"Popularity seeded with {len(requests)} requests of {len(self.popularity)} posts")
+        
+        self.prefetcher = Prefetcher(
+            self.popularity, cache,
+            warm=lambda shortcode: self._warm_post(bot, shortcode),
+            is_idle=self._instagram_idle,
+            interval=PREFETCH_INTERVAL,
+            top=PREFETCH_TOP,
+            min_score=PREFETCH_MIN_SCORE
+        )
+        self.prefetcher.start()
+    
+    async def profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /profile command: download the latest posts of a public profile"""
+        message = update.message
+        if not context.args or len(context.args) > 2 or (len(context.args) == 2 and not context.args[1].isdigit()):
+            await message.reply_text(
+                "❌ استفاده صحیح: `/profile username [تعداد]`\n"
+                f"مثال: `/profile instagram {PROFILE_DEFAULT_POSTS}`",
+                parse_mode=ParseMode.MARKDOWN
+            )
+            return
+        
+        username = context.args[0].lstrip('@').strip('/')
+        count = int(context.args[1]) if len(context.args) == 2 else PROFILE_DEFAULT_POSTS
+        count = max(1, min(count, PROFILE_MAX_POSTS))
+        admitted = await self._admit(message, update.effective_user.id, count)
+        if not admitted:
+            return
+        note = ""
+        if admitted < count:
+            note = f"\n⏳ به دلیل محدودیت تعداد لینک‌ها فقط {admitted} پست آخر دریافت می‌شود"
+            count = admitted
+        
+        status_msg = await message.reply_text(f"🔍 در حال دریافت {count} پست آخر @{username}...{note}")
+        try:
+            success, profile_msg, urls = await self.executor.run('get_profile_post_urls', username, count)
+        except QueueFullError as e:
+            logger.warning(f"Rejected profile request, {e}")
+            await status_msg.edit_text("⏳ سرور در حال حاضر شلوغ است، لطفاً چند دقیقه دیگر تلاش کنید")
+            return
+        
+        if not success:
+            await status_msg.edit_text(profile_msg)
+            return
+        if not urls:
+            await status_msg.edit_text(f"📭 صفحه @{username} پستی ندارد")
+            return
+        await self._run_batch(context.bot, update.effective_chat.id, update.effective_user.id, status_msg, urls,
+                              profile_msg + note)
+    
+    async def process_batch(self, update: Update, context: ContextTypes.DEFAULT_TYPE, urls: list):
+        """Process several post links sent in one message"""
+        message = update.message
+        
+        header = f"📦 {len(urls)} لینک دریافت شد"
+        if len(urls) > BATCH_MAX_LINKS:
+            header = f"📦 {len(urls)} لینک دریافت شد، {BATCH_MAX_LINKS} لینک اول پردازش می‌شود"
+            urls = urls[:BATCH_MAX_LINKS]
+        admitted = await self._admit(message, update.effective_user.id, len(urls))
+        if not admitted:
+            return
+        if admitted < len(urls):
+            header = f"📦 {len(urls)} لینک دریافت شد، به دلیل محدودیت تعداد لینک‌ها {admitted} لینک اول پردازش می‌شود"
+            urls = urls[:admitted]
+        self._count_requests(urls)
+        status_msg = await message.reply_text(f"{header}\n🔄 در حال پردازش...")
+        await self._run_batch(context.bot, update.effective_chat.id, update.effective_user.id, status_msg, urls, header)
+    
+    async def _run_batch(self, bot: Bot, chat_id: int, user_id: int, status_msg: Message, urls: list, header: str):
+        """Download and send a list of posts, reporting progress in one status message"""
+        if WORKER_MODE == 'queue':
+            # Workers take the links one by one and all report in the status message
+            for url in urls:
+                depth = await asyncio.to_thread(
+                    self.download_queue.enqueue, chat_id, user_id, status_msg.message_id, url
+                )
+            await status_msg.edit_text(f"{header}\n🕒 {len(urls)} لینک در صف دانلود (تا نفر {depth})...")
+            return
+        
+        new_trace_id()
+        started = time.perf_counter()
+        job_ids = []
+        for url in urls:
+            job_ids.append(await asyncio.to_thread(
+                self.download_queue.start, chat_id, user_id, status_msg.message_id, url, INLINE_WORKER
+            ))
+        
+        slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+        
+        async def fetch(url: str, job_id: int):
+            async with slots:
+                return await self.scheduler.run(chat_id, user_id, lambda: self._fetch_post(url, job_id))
+        
+        tasks = [asyncio.create_task(fetch(url, job_id)) for url, job_id in zip(urls, job_ids)]
+        progress = _BatchProgress(status_msg, header, len(urls))
+        finished = set()
+        try:
+            for index, (url, job_id, task) in enumerate(zip(urls, job_ids, tasks), 1):
+                success, result_msg, shortcode, file_paths, file_ids = await task
+                if success:
+                    try:
+                        await self._set_stage(job_id, 'downloaded')
+                        with STAGE_SECONDS.labels('send').time():
+                            await self.send_downloaded_files(bot, chat_id, file_paths, f"📌 {index}/{len(urls)}\n{result_msg}",
+                                                             shortcode, file_ids)
+                        await self._set_stage(job_id, 'sent')
+                        await self._record_request(user_id, shortcode)
+                        await self._finish_job(job_id)
+                    except Exception as e:
+                        logger.error(f"Error sending {url}: {e}")
+                        ERRORS.labels('batch', type(e).__name__).inc()
+                        await self._finish_job(job_id, str(e))
+                        success, result_msg = False, f"❌ خطا در ارسال: {str(e)}"
+                else:
+                    await self._finish_job(job_id, result_msg)
+                finished.add(job_id)
+                await progress.update(url, success, result_msg)
+            await progress.finish()
+        except Exception as e:
+            # Posts that were not sent are not left running for the next restart to replay
+            logger.error(f"Batch stopped early: {e}")
+            ERRORS.labels('batch', type(e).__name__).inc()
+            for job_id in job_ids:
+                if job_id not in finished:
+                    await self._finish_job(job_id, f"batch stopped: {e}")
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            STAGE_SECONDS.labels('batch').observe(time.perf_counter() - started)
+            self.storage.request_eviction()
+    
+    async def _fetch_post(self, url: str, job_id: int):
+        """
+        Load a post from storage or download it, without sending anything
+        
+        Returns:
+            (success, message, shortcode, file_paths, file_ids)
+        """
+        shortcode = self.downloader.extract_shortcode(url)
+        if not shortcode:
+            return False, "❌ نمی‌توان کد پست را استخراج کرد", None, [], {}
+        try:
+            with STAGE_SECONDS.labels('lookup').time():
+                success, load_msg, saved_info = await self.executor.run('load_saved_post', shortcode, self.download_path)
+            if success:
+                return True, load_msg, shortcode, saved_info['file_paths'], saved_info.get('file_ids')
+            
+            await self._set_stage(job_id, 'downloading')
+            with STAGE_SECONDS.labels('download').time():
+                success, download_msg, file_paths, _ = await self.single_flight.do(
+                    ('download', shortcode), lambda: self.executor.run('download_post', url, self.download_path)
+                )
+            return success, download_msg, shortcode, file_paths, {}
+        except QueueFullError as e:
+            logger.warning(f"Rejected batch item {url}, {e}")
+            ERRORS.labels('batch', type(e).__name__).inc()
+            return False, "⏳ سرور شلوغ است", shortcode, [], {}
+        except Exception as e:
+            logger.error(f"Error fetching {url}: {e}")
+            ERRORS.labels('batch', type(e).__name__).inc()
+            return False, f"❌ خطا در پردازش: {str(e)}", shortcode, [], {}
+    
+    async def process_job(self, bot: Bot, chat_id: int, user_id: int, processing_msg: Message, url: str,
+                          job_id: int = None):
+        """
+        Download an Instagram URL and send the result, reporting progress in processing_msg
+        
+        With a job_id, progress is recorded in the job journal and the job is
+        completed or failed there when processing ends.
+        """
+        trace_id = new_trace_id(f"job-{job_id}" if job_id is not None else None)
+        logger.info(f"Processing {url} (trace {trace_id})")
+        started = time.perf_counter()
         try:
             # Extract shortcode first
             shortcode = self.downloader.extract_shortcode(url)
             if not shortcode:
                 await processing_msg.edit_text("❌ نمی‌توان کد پست را استخراج کرد")
+                await self._finish_job(job_id, "invalid shortcode")
                 return
             
             # Check if post is already downloaded
-            success, load_msg, saved_info = self.downloader.load_saved_post(shortcode, self.download_path)
+            with STAGE_SECONDS.labels('lookup').time():
+                success, load_msg, saved_info = await self.executor.run('load_saved_post', shortcode, self.download_path)
             
             if success:
                 # Post already downloaded, show saved info
@@ -228,15 +642,26 @@ https://instagram.com/tv/DEF456/
                 await processing_msg.edit_text(info_text + "\n📁 ارسال فایل‌ها...")
                 
                 # Send saved files
-                await self.send_downloaded_files(update, context, saved_info['file_paths'], load_msg)
+                await self._set_stage(job_id, 'downloaded')
+                with STAGE_SECONDS.labels('send').time():
+                    await self.send_downloaded_files(bot, chat_id, saved_info['file_paths'], load_msg,
+                                                     shortcode, saved_info.get('file_ids'))
+                await self._set_stage(job_id, 'sent')
+                await self._record_request(user_id, shortcode)
+                await self._finish_job(job_id)
                 return
             
             # Get post info first
-            success, info_msg, post_info = self.downloader.get_post_info(url)
+            with STAGE_SECONDS.labels('info').time():
+                success, info_msg, post_info = await self.single_flight.do(
+                    ('info', shortcode), lambda: self.executor.run('get_post_info', url)
+                )
             
             if not success:
                 await processing_msg.edit_text(info_msg)
+                await self._finish_job(job_id, info_msg)
                 return
+            await self._set_stage(job_id, 'resolved')
             
             # Show post info
             info_text = f"" ""
@@ -249,12 +674,27 @@ https://instagram.com/tv/DEF456/
             
             await processing_msg.edit_text(info_text + "\n🔄 در حال دانلود...")
             
+            # Streaming mode: pipe media from the CDN straight into Telegram
+            await self._set_stage(job_id, 'downloading')
+            streamed = set()
+            if STREAMING_MODE and await self._stream_post(bot, chat_id, url, shortcode, streamed):
+                await self._set_stage(job_id, 'sent')
+                await self._record_request(user_id, shortcode)
+                await self._finish_job(job_id)
+                self.storage.request_eviction()
+                return
+            
             # Download the post with metadata
-            success, download_msg, file_paths, post_info = self.downloader.download_post(url, self.download_path)
+            with STAGE_SECONDS.labels('download').time():
+                success, download_msg, file_paths, post_info = await self.single_flight.do(
+                    ('download', shortcode), lambda: self.executor.run('download_post', url, self.download_path)
+                )
             
             if not success:
                 await processing_msg.edit_text(download_msg)
+                await self._finish_job(job_id, download_msg)
                 return
+            await self._set_stage(job_id, 'downloaded')
             
             # Show final info with downloaded data
             final_info = f"" ""
@@ -267,61 +707,419 @@ https://instagram.com/tv/DEF456/
             
             await processing_msg.edit_text(final_info + "\n📁 ارسال فایل‌ها...")
             
+            # Files that went out before streaming failed are not sent again
+            if streamed:
+                file_paths = [p for p in file_paths if os.path.basename(p) not in streamed]
+                download_msg = None
+            
             # Send files
-            await self.send_downloaded_files(update, context, file_paths, download_msg)
+            with STAGE_SECONDS.labels('send').time():
+                await self.send_downloaded_files(bot, chat_id, file_paths, download_msg, shortcode)
+            # From here on a restart must not send the files again
+            await self._set_stage(job_id, 'sent')
+            await self._record_request(user_id, shortcode)
+            await self._finish_job(job_id)
+            self.storage.request_eviction()
             
+        except QueueFullError as e:
+            logger.warning(f"Rejected request, {e}")
+            ERRORS.labels('job', type(e).__name__).inc()
+            await self._finish_job(job_id, str(e))
+            await processing_msg.edit_text("⏳ سرور در حال حاضر شلوغ است، لطفاً چند دقیقه دیگر تلاش کنید")
         except Exception as e:
             logger.error(f"Error processing Instagram URL: {e}")
+            ERRORS.labels('job', type(e).__name__).inc()
+            await self._finish_job(job_id, str(e))
             await processing_msg.edit_text(f"❌ خطا در پردازش: {str(e)}")
+        finally:
+            STAGE_SECONDS.labels('job').observe(time.perf_counter() - started)
     
-    async def send_downloaded_files(self, update: Update, context: ContextTypes.DEFAULT_TYPE, file_paths: list, message: str):
-        """Send downloaded files to user"""
-        chat_id = update.effective_chat.id
+    async def _set_stage(self, job_id: int, stage: str):
+        """Record job progress in the journal"""
+        if job_id is not None:
+            await asyncio.to_thread(self.download_queue.set_stage, job_id, stage)
+    
+    async def _finish_job(self, job_id: int, error: str = None):
+        """Mark a journaled job as sent, or as failed with the given error"""
+        if job_id is None:
+            return
+        if error is None:
+            await asyncio.to_thread(self.download_queue.complete, job_id)
+        else:
+            await asyncio.to_thread(self.download_queue.fail, job_id, error)
+    
+    def cleanup_interrupted(self, older_than: float = 0) -> int:
+        """Remove leftovers of interrupted downloads in staging and in the posts of unfinished jobs"""
+        shortcodes = {self.downloader.extract_shortcode(url) for url in self.download_queue.unfinished_urls()}
+        return self.downloader.cleanup_interrupted(self.download_path, older_than, shortcodes - {None})
+    
+    async def resume_jobs(self, bot: Bot, worker: str):
+        """Clean up after an unclean shutdown and run the jobs it interrupted again"""
+        await asyncio.to_thread(self.cleanup_interrupted)
+        jobs = await asyncio.to_thread(self.download_queue.resume_interrupted, worker)
+        for job in jobs:
+            task = asyncio.create_task(
+                self.scheduler.run(job['chat_id'], job['user_id'], lambda job=job: self._resume_job(bot, job))
+            )
+            self._resumed_jobs.add(task)
+            task.add_done_callback(self._resumed_jobs.discard)
+    
+    async def _resume_job(self, bot: Bot, job: dict):
+        logger.info(f"Resuming job {job['id']} from stage {job['stage'] or 'queued'}: {job['url']}")
+        processing_msg = job_message(bot, job)
+        try:
+            await processing_msg.edit_text("🔄 ادامه پردازش لینک پس از راه‌اندازی مجدد...")
+        except BadRequest as e:
+            logger.warning(f"Could not update status of job {job['id']}: {e}")
+        await self.process_job(bot, job['chat_id'], job['user_id'], processing_msg, job['url'], job['id'])
+    
+    async def _stream_post(self, bot: Bot, chat_id: int, url: str, shortcode: str, sent: set) -> bool:
+        """
+        Send a post by streaming each CDN response into the Telegram upload
+        
+        Names of the files that went out are added to `sent`, with None for
+        the status message, so a fallback download only sends the rest.
+        
+        Returns:
+            True if every item was sent, False to fall back to a full download
+        """
+        # Another stream of the same post already writes it to the cache
+        tee = STREAMING_TEE and shortcode not in self._teeing
+        if tee:
+            self._teeing.add(shortcode)
+        try:
+            success, stream_msg, media, post_info = await self.single_flight.do(
+                ('media', shortcode), lambda: self.executor.run('resolve_media', url)
+            )
+            if not success:
+                logger.warning(f"Could not resolve media for {shortcode}: {stream_msg}")
+                return False
+            
+            await bot.send_message(chat_id, stream_msg)
+            sent.add(None)
+            
+            streamed = []
+            for item in media:
+                file_path = os.path.normpath(os.path.join(self.download_path, shortcode, item['filename']))
+                message, stream = await self._with_upload_limit(
+                    chat_id, self._stream_item(bot, chat_id, item, file_path if tee else None)
+                )
+                
+                if not stream.completed:
+                    raise IOError(f"Stream for {item['filename']} ended early")
+                sent.add(item['filename'])
+                BYTES_DOWNLOADED.inc(stream.size)
+                BYTES_UPLOADED.inc(stream.size)
+                FILES_SENT.labels('stream').inc()
+                streamed.append(((file_path, stream.size, stream.sha256), message))
+                logger.info(f"Streamed {item['filename']} ({stream.size} bytes)")
+            
+            # Without the tee a concurrent stream indexes the post with its cached files
+            if tee or not STREAMING_TEE:
+                await asyncio.to_thread(
+                    self.downloader.index_streamed_post, post_info, [f for f, _ in streamed], tee, self.download_path
+                )
+                for (file_path, _, _), message in streamed:
+                    await self._remember_file_id(shortcode, file_path, message)
+            return True
+            
+        except Exception as e:
+            logger.warning(f"Streaming failed for {shortcode}, falling back to download: {e}")
+            ERRORS.labels('stream', type(e).__name__).inc()
+            return False
+        finally:
+            if tee:
+                self._teeing.discard(shortcode)
+    
+    async def _stream_item(self, bot: Bot, chat_id: int, item: dict, tee_path: Optional[str]):
+        """Open one CDN response and upload it, returning the message and the finished stream"""
+        from media_stream import MediaStream
+        client, slots = self.cdn.next_client()
+        async with slots:
+            response = await client.send(client.build_request('GET', item['url']), stream=True)
+            async with MediaStream(response, tee_path, chunk_size=STREAM_CHUNK_SIZE,
+                                   executor=self._tee_executor) as stream:
+                response.raise_for_status()
+                return await self._upload_stream(bot, chat_id, item, stream), stream
+    
+    async def _upload_stream(self, bot: Bot, chat_id: int, item: dict, stream) -> Message:
+        """
+        Upload a MediaStream as a photo or video while it is still downloading
+        
+        The Bot API request is made here rather than through the Bot, whose
+        HTTP client reads file objects synchronously on the event loop and
+        sends bodies of unknown length with chunked transfer encoding.
+        """
+        from media_stream import upload
+        if self._upload_client is None:
+            self._upload_client = httpx.AsyncClient(timeout=httpx.Timeout(60))
+        
+        if item['is_video']:
+            method, field, caption = 'sendVideo', 'video', f"📹 {item['filename']}"
+        else:
+            method, field, caption = 'sendPhoto', 'photo', f"📸 {item['filename']}"
+        response = await upload(self._upload_client, f"{bot.base_url}/{method}",
+                                {'chat_id': chat_id, 'caption': caption}, field, item['filename'], stream)
+        try:
+            result = response.json()
+        except ValueError:
+            raise NetworkError(f"Invalid response to {method}: HTTP {response.status_code}")
+        if not result.get('ok'):
+            retry_after = (result.get('parameters') or {}).get('retry_after')
+            if retry_after:
+                raise RetryAfter(retry_after)
+            raise BadRequest(result.get('description', f"HTTP {response.status_code}"))
+        return Message.de_json(result['result'], bot)
+    
+    async def _record_request(self, user_id: int, shortcode: str):
+        """Add the post to the user's /saved list"""
+        try:
+            cache = self.downloader.get_cache(self.download_path)
+            await asyncio.to_thread(cache.record_request, user_id, shortcode)
+        except Exception as e:
+            logger.warning(f"Could not record request for {shortcode}: {e}")
+    
+    async def send_downloaded_files(self, bot: Bot, chat_id: int, file_paths: list, message: Optional[str],
+                                    shortcode: str = None, file_ids: dict = None):
+        """Send downloaded files to user, after message unless it is None"""
+        file_ids = file_ids or {}
         
         try:
             # Send message about download
-            await context.bot.send_message(chat_id, message)
+            if message is not None:
+                await bot.send_message(chat_id, message)
             
-            # Send each file
-            for file_path in file_paths:
-                if os.path.exists(file_path):
-                    file_size = os.path.getsize(file_path)
-                    
-                    # Try to send file with appropriate method
-                    await self._send_single_file(context, chat_id, file_path)
+            available = [p for p in file_paths if p in file_ids or os.path.exists(p)]
+            
+            # Videos that still have to be uploaded go out as streamable variants once those exist
+            variants = await self._prepare_videos([p for p in available if p not in file_ids])
+            
+            # Photos and videos go out as albums, everything else one by one
+            album_items = [p for p in available if self._can_group(p, file_ids.get(p), variants.get(p))]
+            groups = [album_items[i:i + MEDIA_GROUP_SIZE] for i in range(0, len(album_items), MEDIA_GROUP_SIZE)]
+            singles = [p for p in available if p not in album_items]
+            
+            # An album needs at least two items
+            if groups and len(groups[-1]) == 1:
+                singles = groups.pop() + singles
+            
+            await asyncio.gather(*[
+                self._with_upload_limit(chat_id, self._send_media_group(bot, chat_id, group, shortcode, file_ids,
+                                                                        variants))
+                for group in groups
+            ])
+            
+            for file_path in singles:
+                # Try to send file with appropriate method
+                await self._with_upload_limit(
+                    chat_id, self._send_single_file(bot, chat_id, file_path, shortcode, file_ids.get(file_path),
+                                                    variants.get(file_path))
+                )
                     
         except Exception as e:
             logger.error(f"Error sending files: {e}")
-            await context.bot.send_message(chat_id, f"❌ خطا در ارسال فایل: {str(e)}")
+            ERRORS.labels('send', type(e).__name__).inc()
+            await bot.send_message(chat_id, f"❌ خطا در ارسال فایل: {str(e)}")
+    
+    async def _with_upload_limit(self, chat_id: int, coro):
+        """Run an upload under the per-chat and global concurrency limits"""
+        entry = self.chat_upload_limits.setdefault(chat_id, [asyncio.Semaphore(UPLOAD_CONCURRENCY_PER_CHAT), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self.global_upload_limit:
+                return await coro
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chat_upload_limits[chat_id]
+    
+    @staticmethod
+    def _media_kind(file_path: str):
+        """Get the album media type of a file from its extension"""
+        if file_path.lower().endswith(('.mp4', '.mov', '.avi')):
+            return 'video'
+        elif file_path.lower().endswith(('.jpg', '.jpeg', '.png')):
+            return 'photo'
+        return None
+    
+    def _can_group(self, file_path: str, cached: dict = None, variant: VideoVariant = None) -> bool:
+        """Check whether a file can be sent as part of an album"""
+        if cached:
+            return cached['kind'] in ('photo', 'video')
+        return (self._media_kind(file_path) is not None
+                and os.path.getsize(variant.path if variant else file_path) <= MEDIA_GROUP_MAX_ITEM_SIZE)
+    
+    async def _prepare_videos(self, file_paths: list) -> dict:
+        """Get the ready streamable variants of the videos among file_paths, keyed by path"""
+        videos = [p for p in file_paths if self._media_kind(p) == 'video']
+        variants = await asyncio.gather(*[self.media.prepare(p) for p in videos])
+        return {path: variant for path, variant in zip(videos, variants) if variant is not None}
     
-    async def _send_single_file(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, file_path: str):
+    @staticmethod
+    def _video_options(variant: VideoVariant, stack: ExitStack) -> dict:
+        """send_video/InputMediaVideo arguments that make Telegram play a variant inline"""
+        options = {
+            'width': variant.width,
+            'height': variant.height,
+            'duration': variant.duration,
+            'supports_streaming': True,
+        }
+        if variant.thumbnail:
+            options['thumbnail'] = stack.enter_context(open(variant.thumbnail, 'rb'))
+        return options
+    
+    async def _send_media_group(self, bot: Bot, chat_id: int, group: list,
+                                shortcode: str = None, file_ids: dict = None, variants: dict = None):
+        """Send up to 10 photos/videos as one album, falling back to single sends"""
+        file_ids = file_ids or {}
+        variants = variants or {}
+        
+        try:
+            with ExitStack() as stack:
+                media = []
+                for file_path in group:
+                    cached = file_ids.get(file_path)
+                    variant = variants.get(file_path)
+                    kind = cached['kind'] if cached else self._media_kind(file_path)
+                    upload_path = variant.path if variant else file_path
+                    source = cached['file_id'] if cached else stack.enter_context(open(upload_path, 'rb'))
+                    if kind == 'video' and variant and not cached:
+                        media.append(InputMediaVideo(source, caption=f"📹 {os.path.basename(file_path)}",
+                                                     filename=os.path.basename(file_path),
+                                                     **self._video_options(variant, stack)))
+                    elif kind == 'video':
+                        media.append(InputMediaVideo(source, caption=f"📹 {os.path.basename(file_path)}"))
+                    else:
+                        media.append(InputMediaPhoto(source, caption=f"📸 {os.path.basename(file_path)}"))
+                
+                with STAGE_SECONDS.labels('upload_album').time():
+                    sent_messages = await bot.send_media_group(chat_id=chat_id, media=media)
+            
+            logger.info(f"Successfully sent album of {len(group)} files")
+            for file_path in group:
+                if file_path in file_ids:
+                    FILES_SENT.labels('file_id').inc()
+                else:
+                    FILES_SENT.labels('album').inc()
+                    BYTES_UPLOADED.inc(os.path.getsize(variants[file_path].path if file_path in variants else file_path))
+            for file_path, sent in zip(group, sent_messages):
+                if file_path not in file_ids:
+                    await self._remember_file_id(shortcode, file_path, sent)
+            return True
+            
+        except Exception as group_error:
+            logger.warning(f"send_media_group failed, sending files one by one: {group_error}")
+            ERRORS.labels('upload_album', type(group_error).__name__).inc()
+            for file_path in group:
+                await self._send_single_file(bot, chat_id, file_path, shortcode, file_ids.get(file_path),
+                                             variants.get(file_path))
+            return False
+    
+    async def _send_by_file_id(self, bot: Bot, chat_id: int, file_path: str, cached: dict):
+        """Send a previously uploaded file by its Telegram file_id"""
+        name = os.path.basename(file_path)
+        if cached['kind'] == 'video':
+            return await bot.send_video(chat_id=chat_id, video=cached['file_id'], caption=f"📹 {name}")
+        elif cached['kind'] == 'photo':
+            return await bot.send_photo(chat_id=chat_id, photo=cached['file_id'], caption=f"📸 {name}")
+        elif cached['kind'] == 'animation':
+            return await bot.send_animation(chat_id=chat_id, animation=cached['file_id'], caption=f"📹 {name}")
+        return await bot.send_document(chat_id=chat_id, document=cached['file_id'], caption=f"📁 {name}")
+    
+    async def _remember_file_id(self, shortcode: str, file_path: str, sent_message):
+        """Store the file_id Telegram returned for an uploaded file"""
+        if not shortcode or sent_message is None:
+            return
+        
+        if sent_message.video:
+            kind, file_id = 'video', sent_message.video.file_id
+        elif sent_message.animation:
+            kind, file_id = 'animation', sent_message.animation.file_id
+        elif sent_message.document:
+            kind, file_id = 'document', sent_message.document.file_id
+        elif sent_message.photo:
+            kind, file_id = 'photo', sent_message.photo[-1].file_id
+        else:
+            return
+        
+        try:
+            await asyncio.to_thread(
+                self.downloader.remember_file_id, shortcode, file_path, file_id, kind, self.download_path
+            )
+        except Exception as e:
+            logger.warning(f"Could not store file_id for {file_path}: {e}")
+    
+    async def _send_single_file(self, bot: Bot, chat_id: int, file_path: str,
+                                shortcode: str = None, cached: dict = None, variant: VideoVariant = None):
         """Send a single file with appropriate method"""
+        # Already uploaded once: send by file_id, no disk read and no upload
+        if cached:
+            try:
+                with STAGE_SECONDS.labels('upload_file_id').time():
+                    await self._send_by_file_id(bot, chat_id, file_path, cached)
+                logger.info(f"Sent file by file_id: {file_path}")
+                FILES_SENT.labels('file_id').inc()
+                return True
+            except BadRequest as id_error:
+                logger.warning(f"Telegram rejected file_id for {file_path}: {id_error}")
+                ERRORS.labels('upload_file_id', type(id_error).__name__).inc()
+                await asyncio.to_thread(
+                    self.downloader.remember_file_id, shortcode, file_path, None, None, self.download_path
+                )
+                if not os.path.exists(file_path):
+                    await bot.send_message(chat_id, f"❌ فایل {os.path.basename(file_path)} در دسترس نیست")
+                    return False
+        
+        # A streamable variant plays inline instead of arriving as a document
+        if variant is not None:
+            try:
+                with ExitStack() as stack, STAGE_SECONDS.labels('upload').time():
+                    sent = await bot.send_video(
+                        chat_id=chat_id,
+                        video=stack.enter_context(open(variant.path, 'rb')),
+                        filename=os.path.basename(file_path),
+                        caption=f"📹 {os.path.basename(file_path)}",
+                        **self._video_options(variant, stack)
+                    )
+                logger.info(f"Successfully sent streamable video: {file_path}")
+                FILES_SENT.labels('upload').inc()
+                BYTES_UPLOADED.inc(os.path.getsize(variant.path))
+                await self._remember_file_id(shortcode, file_path, sent)
+                return True
+            except Exception as video_error:
+                logger.warning(f"send_video failed for the variant of {file_path}: {video_error}")
+                ERRORS.labels('upload', type(video_error).__name__).inc()
+        
         try:
             # First try with send_document (most compatible)
-            with open(file_path, 'rb') as f:
-                await context.bot.send_document(
+            with open(file_path, 'rb') as f, STAGE_SECONDS.labels('upload').time():
+                sent = await bot.send_document(
                     chat_id=chat_id,
                     document=f,
                     caption=f"📁 {os.path.basename(file_path)}"
                 )
             logger.info(f"Successfully sent file as document: {file_path}")
+            FILES_SENT.labels('upload').inc()
+            BYTES_UPLOADED.inc(os.path.getsize(file_path))
+            await self._remember_file_id(shortcode, file_path, sent)
             return True
             
         except Exception as doc_error:
             logger.warning(f"send_document failed for {file_path}: {doc_error}")
+            ERRORS.labels('upload', type(doc_error).__name__).inc()
             
             # Try with specific media type
             try:
-                with open(file_path, 'rb') as f:
+                with open(file_path, 'rb') as f, STAGE_SECONDS.labels('upload').time():
                     if file_path.lower().endswith(('.mp4', '.mov', '.avi')):
-                        await context.bot.send_video(
+                        sent = await bot.send_video(
                             chat_id=chat_id,
                             video=f,
                             caption=f"📹 {os.path.basename(file_path)}"
                         )
                         logger.info(f"Successfully sent as video: {file_path}")
                     elif file_path.lower().endswith(('.jpg', '.jpeg', '.png')):
-                        await context.bot.send_photo(
+                        sent = await bot.send_photo(
                             chat_id=chat_id,
                             photo=f,
                             caption=f"📸 {os.path.basename(file_path)}"
@@ -329,17 +1127,21 @@ https://instagram.com/tv/DEF456/
                         logger.info(f"Successfully sent as photo: {file_path}")
                     else:
                         # Fallback to document for unknown types
-                        await context.bot.send_document(
+                        sent = await bot.send_document(
                             chat_id=chat_id,
                             document=f,
                             caption=f"📄 {os.path.basename(file_path)}"
                         )
                         logger.info(f"Successfully sent as document fallback: {file_path}")
+                FILES_SENT.labels('upload').inc()
+                BYTES_UPLOADED.inc(os.path.getsize(file_path))
+                await self._remember_file_id(shortcode, file_path, sent)
                 return True
                 
             except Exception as media_error:
                 logger.error(f"All methods failed for {file_path}: {media_error}")
-                await context.bot.send_message(
+                ERRORS.labels('upload', type(media_error).__name__).inc()
+                await bot.send_message(
                     chat_id, 
                     f"❌ خطا در ارسال فایل {os.path.basename(file_path)}: {str(media_error)}"
                 )
@@ -347,7 +1149,8 @@ https://instagram.com/tv/DEF456/
                 
         except Exception as e:
             logger.error(f"Unexpected error sending {file_path}: {e}")
-            await context.bot.send_message(
+            ERRORS.labels('upload', type(e).__name__).inc()
+            await bot.send_message(
                 chat_id, 
                 f"❌ خطای غیرمنتظره در ارسال {os.path.basename(file_path)}: {str(e)}"
             )
@@ -362,29 +1165,99 @@ https://instagram.com/tv/DEF456/
             await self.help_command(update, context)
         elif query.data == "about":
             await self.about_command(update, context)
+        elif query.data.startswith("saved:"):
+            text, reply_markup = await self._build_saved_page(query.from_user.id, int(query.data.split(":", 1)[1]))
+            try:
+                await query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
+            except BadRequest as e:
+                # Pressing the current page button leaves the message unchanged
+                if 'not modified' in str(e).lower():
+                    logger.debug(f"Saved page not updated: {e}")
+                else:
+                    logger.error(f"Error showing saved page: {e}")
     
-    def run(self):
-        """Run the bot"""
-        if not BOT_TOKEN:
-            logger.error("BOT_TOKEN not found! Please set it in your environment variables.")
-            return
-        
+    async def post_init(self, application: Application):
+        """Start background tasks once the event loop is running"""
+        # In split mode the workers own the downloads directory and its jobs
+        if WORKER_MODE != 'queue':
+            await self.resume_jobs(application.bot, INLINE_WORKER)
+            self.storage.start()
+            if PREFETCH_ENABLED:
+                await self._start_prefetcher(application.bot)
+    
+    async def post_shutdown(self, application: Application):
+        """Stop background tasks"""
+        await self.storage.stop()
+        if self.prefetcher is not None:
+            await self.prefetcher.stop()
+        await self.executor.aclose()
+        await self.close_stream_clients()
+        self.media.shutdown()
+    
+    async def close_stream_clients(self):
+        """Close the HTTP clients and tee threads of streamed media"""
+        if self._upload_client is not None:
+            await self._upload_client.aclose()
+            self._upload_client = None
+        if self.cdn is not self.executor.async_downloader:
+            await self.cdn.aclose()
+        self._tee_executor.shutdown(wait=False)
+    
+    def build_application(self, builder) -> Application:
+        """Create the application with this bot's handlers from a configured ApplicationBuilder"""
         # Create application
-        application = Application.builder().token(BOT_TOKEN).build()
+        # Handlers only wait for their turn in the fair scheduler, so one
+        # chat's updates must not hold up the updates of the others
+        application = (
+            builder
+            .concurrent_updates(True)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
         
         # Add handlers
         application.add_handler(CommandHandler("start", self.start_command))
         application.add_handler(CommandHandler("help", self.help_command))
         application.add_handler(CommandHandler("about", self.about_command))
         application.add_handler(CommandHandler("saved", self.saved_command))
+        application.add_handler(CommandHandler("profile", self.profile_command))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
         application.add_handler(CallbackQueryHandler(self.button_callback))
+        return application
+    
+    def run(self):
+        """Run the bot"""
+        if not BOT_TOKEN:
+            logger.error("BOT_TOKEN not found! Please set it in your environment variables.")
+            return
+        if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+            logger.error("WEBHOOK_URL not found! Please set it in your environment variables to use webhook mode.")
+            return
+        
+        application = self.build_application(Application.builder().token(BOT_TOKEN))
         
         # Start bot
         logger.info("Starting Instagram Download Bot...")
         logger.info(f"Max file size: {MAX_FILE_SIZE // (1024*1024)} MB")
         logger.info("Timeout restrictions removed for better performance")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if METRICS_PORT:
+            start_http_server(METRICS_PORT, METRICS_ADDR)
+        try:
+            if BOT_MODE == 'webhook':
+                logger.info(f"Listening for webhook updates on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+                application.run_webhook(
+                    listen=WEBHOOK_LISTEN,
+                    port=WEBHOOK_PORT,
+                    url_path=WEBHOOK_PATH,
+                    webhook_url=WEBHOOK_URL,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES
+                )
+            else:
+                application.run_polling(allowed_updates=Update.ALL_TYPES)
+        finally:
+            self.executor.shutdown(wait=False)
 
 def main():
     """Main function"""
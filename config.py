@@ -9,3 +9,110 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 # Download Configuration
 DOWNLOAD_PATH = 'downloads'
 MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 2GB in bytes (Telegram's maximum)
+
+# Download Worker Pool Configuration
+DOWNLOAD_EXECUTOR = os.getenv('DOWNLOAD_EXECUTOR', 'thread')  # 'thread', 'process' or 'async'
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+DOWNLOAD_QUEUE_LIMIT = int(os.getenv('DOWNLOAD_QUEUE_LIMIT', '100'))  # max pending + running jobs
+ASYNC_HTTP_CONNECTIONS = int(os.getenv('ASYNC_HTTP_CONNECTIONS', '16'))  # media connections per session in 'async' mode
+ASYNC_HTTP2 = os.getenv('ASYNC_HTTP2', 'true').lower() == 'true'  # needs the h2 package
+
+# Post Metadata Cache Configuration
+POST_INFO_TTL = int(os.getenv('POST_INFO_TTL', '300'))  # seconds
+POST_INFO_CACHE_SIZE = int(os.getenv('POST_INFO_CACHE_SIZE', '1000'))
+
+# Upload Configuration
+MEDIA_GROUP_SIZE = 10  # Telegram's maximum items per album
+MEDIA_GROUP_MAX_ITEM_SIZE = int(os.getenv('MEDIA_GROUP_MAX_ITEM_SIZE', str(50 * 1024 * 1024)))
+UPLOAD_CONCURRENCY_PER_CHAT = int(os.getenv('UPLOAD_CONCURRENCY_PER_CHAT', '2'))
+UPLOAD_CONCURRENCY_GLOBAL = int(os.getenv('UPLOAD_CONCURRENCY_GLOBAL', '8'))
+
+# Instagram Session Pool Configuration
+LOADER_POOL_SIZE = int(os.getenv('LOADER_POOL_SIZE', '4'))  # loaders per session
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))  # keep-alive connections per session
+
+# Parallel Range Downloads of Large Media
+RANGE_MIN_BYTES = int(os.getenv('RANGE_MIN_BYTES', str(8 * 1024 * 1024)))  # smaller files use one request, 0 disables
+RANGE_CHUNK_BYTES = int(os.getenv('RANGE_CHUNK_BYTES', str(4 * 1024 * 1024)))
+RANGE_CONNECTIONS = int(os.getenv('RANGE_CONNECTIONS', '4'))  # ranges fetched at once per file
+RANGE_RETRIES = int(os.getenv('RANGE_RETRIES', '3'))  # resumes per range after a dropped connection
+
+# Saved Posts Listing
+SAVED_PAGE_SIZE = int(os.getenv('SAVED_PAGE_SIZE', '10'))
+
+# Video Processing (needs ffmpeg and ffprobe)
+TRANSCODE_ENABLED = os.getenv('TRANSCODE_ENABLED', 'true').lower() == 'true'
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', '2'))  # ffmpeg processes
+TRANSCODE_MAX_BYTES = int(os.getenv('TRANSCODE_MAX_BYTES', str(48 * 1024 * 1024)))  # under the 50MB upload limit
+TRANSCODE_MAX_DIMENSION = int(os.getenv('TRANSCODE_MAX_DIMENSION', '1280'))  # longer side of re-encoded videos
+TRANSCODE_PRESET = os.getenv('TRANSCODE_PRESET', 'veryfast')
+TRANSCODE_TIMEOUT = float(os.getenv('TRANSCODE_TIMEOUT', '600'))
+FFMPEG_PATH = os.getenv('FFMPEG_PATH', 'ffmpeg')
+FFPROBE_PATH = os.getenv('FFPROBE_PATH', 'ffprobe')
+
+# Fair Scheduling and Abuse Throttling
+SCHEDULER_CONCURRENCY = int(os.getenv('SCHEDULER_CONCURRENCY', '8'))  # jobs processed at once by the bot
+USER_MAX_IN_FLIGHT = int(os.getenv('USER_MAX_IN_FLIGHT', '2'))  # running jobs per user
+USER_RATE_LIMIT = int(os.getenv('USER_RATE_LIMIT', '30'))  # links per user per window, 0 disables
+USER_RATE_WINDOW = float(os.getenv('USER_RATE_WINDOW', '300'))  # sliding window in seconds
+# Extra round-robin turns for specific chats, e.g. "12345:3,67890:2"
+CHAT_WEIGHTS = {
+    int(chat_id): int(weight)
+    for chat_id, weight in (item.split(':') for item in os.getenv('CHAT_WEIGHTS', '').split(',') if item.strip())
+}
+
+# Bulk Links and /profile
+BATCH_MAX_LINKS = int(os.getenv('BATCH_MAX_LINKS', '50'))  # links handled from one message
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))  # posts of one batch fetched in parallel
+PROFILE_DEFAULT_POSTS = int(os.getenv('PROFILE_DEFAULT_POSTS', '12'))
+PROFILE_MAX_POSTS = int(os.getenv('PROFILE_MAX_POSTS', '50'))
+
+# Storage Quota Configuration
+STORAGE_QUOTA_BYTES = int(os.getenv('STORAGE_QUOTA_BYTES', str(20 * 1024 * 1024 * 1024)))  # 0 disables eviction
+STORAGE_EVICTION_POLICY = os.getenv('STORAGE_EVICTION_POLICY', 'lru')  # 'lru' or 'lfu'
+STORAGE_CHECK_INTERVAL = int(os.getenv('STORAGE_CHECK_INTERVAL', '300'))  # seconds
+
+# Trending Post Prefetch
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'true').lower() == 'true'
+PREFETCH_INTERVAL = float(os.getenv('PREFETCH_INTERVAL', '60'))  # seconds between rounds
+PREFETCH_TOP = int(os.getenv('PREFETCH_TOP', '20'))  # hottest posts checked per round
+PREFETCH_MIN_SCORE = float(os.getenv('PREFETCH_MIN_SCORE', '2.5'))  # decayed request count worth warming, ~3 recent requests
+PREFETCH_CHAT_ID = int(os.getenv('PREFETCH_CHAT_ID', '0'))  # chat that warmed posts are uploaded to, 0 disables
+POPULARITY_HALF_LIFE = float(os.getenv('POPULARITY_HALF_LIFE', '3600'))  # seconds
+POPULARITY_MAX_ITEMS = int(os.getenv('POPULARITY_MAX_ITEMS', '10000'))  # tracked shortcodes
+
+# Streaming Configuration
+STREAMING_MODE = os.getenv('STREAMING_MODE', 'false').lower() == 'true'  # pipe CDN responses into uploads
+STREAMING_TEE = os.getenv('STREAMING_TEE', 'true').lower() == 'true'  # also keep a copy in the cache
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Instagram Rate Limiting
+INSTAGRAM_RATE = float(os.getenv('INSTAGRAM_RATE', '0.5'))  # max requests per second
+INSTAGRAM_BURST = int(os.getenv('INSTAGRAM_BURST', '5'))
+INSTAGRAM_MIN_RATE = float(os.getenv('INSTAGRAM_MIN_RATE', '0.02'))
+INSTAGRAM_BACKOFF_BASE = float(os.getenv('INSTAGRAM_BACKOFF_BASE', '5'))  # seconds
+INSTAGRAM_BACKOFF_MAX = float(os.getenv('INSTAGRAM_BACKOFF_MAX', '900'))  # seconds
+
+# Instagram Session Pool (JSON list of {name, proxy, headers, cookies})
+INSTAGRAM_SESSIONS_FILE = os.getenv('INSTAGRAM_SESSIONS_FILE')
+SESSION_QUARANTINE_SECONDS = int(os.getenv('SESSION_QUARANTINE_SECONDS', '300'))
+
+# Deployment Mode
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # 'polling' or 'webhook'
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # public HTTPS URL Telegram posts updates to
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+# Worker Split ('inline' handles downloads in the bot process, 'queue' hands them to worker.py)
+WORKER_MODE = os.getenv('WORKER_MODE', 'inline')
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', os.path.join(DOWNLOAD_PATH, 'jobs.sqlite3'))
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '2'))
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', '4'))  # jobs per worker process
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', '0.5'))  # seconds
+
+# Observability
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))  # 0 disables the /metrics endpoint
+METRICS_ADDR = os.getenv('METRICS_ADDR', '127.0.0.1')
+LOG_TRACE_IDS = os.getenv('LOG_TRACE_IDS', 'true').lower() == 'true'  # prefix log lines with request trace ids
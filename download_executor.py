@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Optional
+
+from async_downloader import AsyncInstagramDownloader
+from instagram_downloader import InstagramDownloader
+
+logger = logging.getLogger(__name__)
+
+# Downloader instance owned by each worker process (process mode only)
+_worker_downloader: Optional[InstagramDownloader] = None
+
+
+def _init_worker():
+    """Create the per-process downloader when a worker process starts"""
+    global _worker_downloader
+    _worker_downloader = InstagramDownloader()
+
+
+def _call_in_worker(method_name: str, args: tuple, kwargs: dict) -> Any:
+    """Run a downloader method inside a worker process"""
+    return getattr(_worker_downloader, method_name)(*args, **kwargs)
+
+
+# Cache index lookups: never wait for Instagram, so they skip the download pool and its limit
+LOOKUP_METHODS = ('load_saved_post',)
+
+
+class QueueFullError(Exception):
+    """Raised when the download queue has reached its depth limit"""
+
+
+class DownloadExecutor:
+    def __init__(self, downloader: InstagramDownloader, mode: str = "thread",
+                 max_workers: int = 4, max_queue_depth: int = 100,
+                 async_connections: int = 16, http2: bool = True, lookup_workers: int = 4):
+        """
+        Run blocking downloader calls on a worker pool so the event loop stays free
+
+        In 'async' mode the calls AsyncInstagramDownloader implements run on
+        the event loop instead, and only the others use the thread pool.
+        Cache lookups run on a small thread pool of their own in every mode.
+
+        Args:
+            downloader: downloader used directly by thread workers
+            mode: 'thread', 'process' or 'async'
+            max_workers: number of pool workers
+            max_queue_depth: maximum number of pending + running jobs
+            async_connections: HTTP connections of the async downloader
+            http2: let the async downloader use HTTP/2
+            lookup_workers: threads for cache lookups
+        """
+        if mode not in ("thread", "process", "async"):
+            raise ValueError(f"Unknown executor mode: {mode}")
+
+        self.downloader = downloader
+        self.mode = mode
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+
+        self._depth = 0
+        self._lock = threading.Lock()
+        self.async_downloader: Optional[AsyncInstagramDownloader] = None
+        if mode == "async":
+            self.async_downloader = AsyncInstagramDownloader(downloader, max_connections=async_connections,
+                                                             http2=http2, resolve_workers=max_workers)
+
+        if mode == "process":
+            self._pool = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker)
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+        self._lookup_pool = ThreadPoolExecutor(max_workers=lookup_workers, thread_name_prefix="lookup")
+
+        logger.info(f"Download executor started: {mode} pool, {max_workers} workers, queue limit {max_queue_depth}")
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of jobs currently pending or running"""
+        return self._depth
+
+    def submit(self, method_name: str, *args, **kwargs) -> Future:
+        """
+        Submit a downloader method call to the pool
+
+        Returns:
+            concurrent.futures.Future for the job
+
+        Raises:
+            QueueFullError: if the queue depth limit is reached
+        """
+        self._acquire()
+        try:
+            if self.mode == "process":
+                future = self._pool.submit(_call_in_worker, method_name, args, kwargs)
+            else:
+                # Carry the caller's trace id into the worker thread
+                context = contextvars.copy_context()
+                future = self._pool.submit(context.run, getattr(self.downloader, method_name), *args, **kwargs)
+        except Exception:
+            self._release()
+            raise
+
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    async def run(self, method_name: str, *args, **kwargs) -> Any:
+        """Submit a downloader method call and await its result"""
+        if method_name in LOOKUP_METHODS:
+            context = contextvars.copy_context()
+            future = self._lookup_pool.submit(context.run, getattr(self.downloader, method_name), *args, **kwargs)
+            return await asyncio.wrap_future(future)
+        if self.async_downloader is not None and method_name in AsyncInstagramDownloader.METHODS:
+            self._acquire()
+            try:
+                return await getattr(self.async_downloader, method_name)(*args, **kwargs)
+            finally:
+                self._release()
+        future = self.submit(method_name, *args, **kwargs)
+        return await asyncio.wrap_future(future)
+
+    async def aclose(self):
+        """Close the async downloader's HTTP client"""
+        if self.async_downloader is not None:
+            await self.async_downloader.aclose()
+
+    def shutdown(self, wait: bool = True):
+        """Stop the worker pool"""
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+        self._lookup_pool.shutdown(wait=wait, cancel_futures=True)
+        logger.info("Download executor stopped")
+
+    def _acquire(self):
+        with self._lock:
+            if self._depth >= self.max_queue_depth:
+                raise QueueFullError(f"Download queue is full ({self._depth} jobs)")
+            self._depth += 1
+
+    def _release(self):
+        with self._lock:
+            self._depth -= 1
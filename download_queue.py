@@ -0,0 +1,205 @@
+import time
+import sqlite3
+import logging
+import threading
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadQueue:
+    def __init__(self, db_path: str, stale_after: float = 1800):
+        """
+        SQLite-backed job queue and journal shared by the bot and worker processes
+
+        The front end enqueues one job per link; each worker claims jobs
+        atomically, so any number of worker processes can share one queue file.
+        Jobs handled inside the bot process are journaled in the same table.
+        Every job records how far it got (resolved, downloading, downloaded,
+        sent), so jobs interrupted by a restart are resumed from the journal
+        instead of being lost.
+
+        Args:
+            db_path: SQLite database file
+            stale_after: seconds after which a claimed, unfinished job is
+                considered abandoned by a dead worker and queued again
+        """
+        self.db_path = db_path
+        self.stale_after = stale_after
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._lock, self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    url TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    stage TEXT,
+                    worker TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    claimed_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, id);
+                CREATE INDEX IF NOT EXISTS jobs_by_chat ON jobs (status, chat_id);
+            """)
+            self._add_column('jobs', 'stage', 'TEXT')
+
+    def _add_column(self, table: str, column: str, declaration: str) -> bool:
+        """Add a column if the table lacks it, returns True if it was added"""
+        columns = {row['name'] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+        if column in columns:
+            return False
+        self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        return True
+
+    def enqueue(self, chat_id: int, user_id: int, message_id: int, url: str) -> int:
+        """
+        Add a job to the queue
+
+        Returns:
+            the number of queued jobs including this one
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (chat_id, user_id, message_id, url, created_at) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, user_id, message_id, url, time.time())
+            )
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def start(self, chat_id: int, user_id: int, message_id: int, url: str, worker: str) -> int:
+        """
+        Journal a job that the caller runs right away
+
+        Returns:
+            the job id
+        """
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (chat_id, user_id, message_id, url, status, worker, attempts, created_at, claimed_at) "
+                "VALUES (?, ?, ?, ?, 'running', ?, 1, ?, ?)",
+                (chat_id, user_id, message_id, url, worker, time.time(), time.time())
+            )
+            return cursor.lastrowid
+
+    def claim(self, worker: str) -> Optional[dict]:
+        """
+        Atomically take the next queued job in round-robin order over chats
+
+        Each chat's oldest job comes first, then the second oldest of every
+        chat and so on; jobs of chats that already have jobs running move
+        back by that many rounds. One chat with many links cannot hold up
+        the others.
+
+        Returns:
+            the job as a dict, or None if the queue is empty
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                """
+                UPDATE jobs SET status = 'running', worker = ?, claimed_at = ?, attempts = attempts + 1
+                WHERE id = (
+                    SELECT id FROM (
+                        SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id)
+                            + (SELECT COUNT(*) FROM jobs r WHERE r.status = 'running' AND r.chat_id = q.chat_id)
+                            AS round
+                        FROM jobs q WHERE status = 'queued'
+                    ) ORDER BY round, id LIMIT 1
+                )
+                RETURNING id, chat_id, user_id, message_id, url, stage, attempts
+                """,
+                (worker, time.time())
+            ).fetchone()
+        return dict(row) if row else None
+
+    def set_stage(self, job_id: int, stage: str):
+        """Record how far a running job got"""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET stage = ? WHERE id = ?", (stage, job_id))
+
+    def complete(self, job_id: int):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET status = 'done', stage = 'sent' WHERE id = ?", (job_id,))
+
+    def fail(self, job_id: int, error: str):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET status = 'failed', error = ? WHERE id = ?", (error, job_id))
+
+    def requeue_stale(self, max_attempts: int = 3) -> int:
+        """
+        Put jobs of crashed workers back in the queue
+
+        Returns:
+            number of jobs requeued
+        """
+        cutoff = time.time() - self.stale_after
+        with self._lock, self._conn:
+            # The user already has the files, only the completion was lost
+            self._conn.execute(
+                "UPDATE jobs SET status = 'done' WHERE status = 'running' AND claimed_at < ? AND stage = 'sent'",
+                (cutoff,)
+            )
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'too many attempts' "
+                "WHERE status = 'running' AND claimed_at < ? AND attempts >= ?",
+                (cutoff, max_attempts)
+            )
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND claimed_at < ?",
+                (cutoff,)
+            )
+        if cursor.rowcount:
+            logger.warning(f"Requeued {cursor.rowcount} stale jobs")
+        return cursor.rowcount
+
+    def resume_interrupted(self, worker: str, max_attempts: int = 3) -> List[dict]:
+        """
+        Take back the running jobs of a worker that was restarted
+
+        Jobs that already reached the 'sent' stage are completed, jobs that
+        were interrupted too often are failed, the rest are returned to be run again.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'done' WHERE status = 'running' AND worker = ? AND stage = 'sent'",
+                (worker,)
+            )
+            self._conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'too many attempts' "
+                "WHERE status = 'running' AND worker = ? AND attempts >= ?",
+                (worker, max_attempts)
+            )
+            rows = self._conn.execute(
+                """
+                UPDATE jobs SET attempts = attempts + 1, claimed_at = ?
+                WHERE status = 'running' AND worker = ?
+                RETURNING id, chat_id, user_id, message_id, url, stage, attempts
+                """,
+                (time.time(), worker)
+            ).fetchall()
+        jobs = sorted((dict(row) for row in rows), key=lambda job: job['id'])
+        if jobs:
+            logger.warning(f"Resuming {len(jobs)} interrupted jobs of {worker}")
+        return jobs
+
+    def unfinished_urls(self) -> List[str]:
+        """Links of the jobs that are queued or running"""
+        with self._lock:
+            rows = self._conn.execute("SELECT url FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+        return [row['url'] for row in rows]
+
+    def depth(self) -> int:
+        """Number of queued jobs"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,200 @@
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitedError(Exception):
+    """Raised when a user sent more links than the sliding window allows"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limited, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+@dataclass
+class _Job:
+    chat_id: int
+    user_id: int
+    fn: Callable[[], Awaitable[Any]]
+    future: asyncio.Future = field(repr=False)
+
+
+class FairScheduler:
+    def __init__(self, concurrency: int = 8, max_in_flight_per_user: int = 2,
+                 rate_limit: int = 30, rate_window: float = 300,
+                 weights: Optional[Dict[int, int]] = None):
+        """
+        Weighted round-robin queuing of download jobs across chats, with per-user limits
+
+        Args:
+            concurrency: jobs running at once
+            max_in_flight_per_user: running jobs per user
+            rate_limit: links a user may send per window (0 disables the limit)
+            rate_window: length of the sliding window in seconds
+            weights: turns per round of specific chats, 1 for all others
+        """
+        self.concurrency = concurrency
+        self.max_in_flight_per_user = max_in_flight_per_user
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.weights = weights or {}
+
+        self._queues: Dict[int, Deque[_Job]] = {}
+        # Chats with waiting jobs in round-robin order, the current one first
+        self._rotation: Deque[int] = deque()
+        self._turns_left: Dict[int, int] = {}
+        self._in_flight: Dict[int, int] = {}
+        self._running = 0
+        self._requests: Dict[int, Deque[float]] = {}
+        self._next_sweep = 0.0
+        self._tasks = set()
+
+    @property
+    def queued(self) -> int:
+        """Number of jobs waiting for a slot"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def admit(self, user_id: int, count: int = 1) -> int:
+        """
+        Count up to `count` links against the user's sliding window
+
+        Returns:
+            number of links admitted, less than count when the window is nearly full
+
+        Raises:
+            RateLimitedError: if no link fits in the window
+        """
+        if self.rate_limit <= 0:
+            return count
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            # Users who stopped sending links would otherwise keep their deques
+            for other in list(self._requests):
+                self._expire(other, now)
+            self._next_sweep = now + self.rate_window
+        requests = self._expire(user_id, now) or self._requests.setdefault(user_id, deque())
+        admitted = min(count, self.rate_limit - len(requests))
+        if admitted <= 0:
+            # The window frees up as the oldest requests age out
+            raise RateLimitedError(max(1.0, requests[0] + self.rate_window - now))
+        requests.extend([now] * admitted)
+        return admitted
+
+    def _expire(self, user_id: int, now: float) -> Optional[Deque[float]]:
+        """Drop the user's links that left the window, and the user once none are left"""
+        requests = self._requests.get(user_id)
+        while requests and requests[0] <= now - self.rate_window:
+            requests.popleft()
+        if requests is not None and not requests:
+            del self._requests[user_id]
+            return None
+        return requests
+
+    def position(self, chat_id: int) -> int:
+        """
+        Estimated number of jobs that start before a job added now for chat_id
+
+        Returns:
+            0 if the job would start right away
+        """
+        if self._running < self.concurrency and not self._rotation:
+            return 0
+        own = len(self._queues.get(chat_id, ()))
+        weight = self.weights.get(chat_id, 1)
+        rounds = math.ceil((own + 1) / weight)
+        ahead = own
+        for other, queue in self._queues.items():
+            if other != chat_id:
+                ahead += min(len(queue), rounds * self.weights.get(other, 1))
+        return ahead + 1
+
+    def enqueue(self, chat_id: int, user_id: int, fn: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """
+        Queue fn() for chat_id and start it when its turn comes
+
+        Returns:
+            future with the result of fn()
+        """
+        future = asyncio.get_running_loop().create_future()
+        # The waiter may be gone; retrieve the exception so it is not logged as lost
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        job = _Job(chat_id, user_id, fn, future)
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            self._rotation.append(chat_id)
+            self._turns_left[chat_id] = self.weights.get(chat_id, 1)
+        queue.append(job)
+        self._dispatch()
+        return future
+
+    async def run(self, chat_id: int, user_id: int, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Run fn() in chat_id's turn and return its result"""
+        return await self.enqueue(chat_id, user_id, fn)
+
+    def _next_job(self) -> Optional[_Job]:
+        """Take the next job in weighted round-robin order, skipping users at their cap"""
+        for _ in range(len(self._rotation)):
+            chat_id = self._rotation[0]
+            queue = self._queues[chat_id]
+            # Waiters that gave up are dropped without using a turn
+            while queue and queue[0].future.done():
+                queue.popleft()
+            if queue and self._in_flight.get(queue[0].user_id, 0) >= self.max_in_flight_per_user:
+                self._rotation.rotate(-1)
+                continue
+
+            job = queue.popleft() if queue else None
+            if job is not None:
+                self._turns_left[chat_id] -= 1
+            if not queue:
+                self._rotation.popleft()
+                del self._queues[chat_id]
+                del self._turns_left[chat_id]
+            elif self._turns_left[chat_id] <= 0:
+                self._turns_left[chat_id] = self.weights.get(chat_id, 1)
+                self._rotation.rotate(-1)
+            if job is not None:
+                return job
+        return None
+
+    def _dispatch(self):
+        """Start queued jobs while slots are free"""
+        while self._running < self.concurrency:
+            job = self._next_job()
+            if job is None:
+                return
+            self._running += 1
+            self._in_flight[job.user_id] = self._in_flight.get(job.user_id, 0) + 1
+            task = asyncio.create_task(self._run_job(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_job(self, job: _Job):
+        try:
+            result = await job.fn()
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._running -= 1
+            self._in_flight[job.user_id] -= 1
+            if not self._in_flight[job.user_id]:
+                del self._in_flight[job.user_id]
+            self._dispatch()
@@ -1,36 +1,163 @@
 import os
 import re
-import requests
-import instaloader
-from typing import Optional, Tuple
-from urllib.parse import urlparse
+from typing import Optional, Tuple, Dict, Iterable, List, TYPE_CHECKING
+import shutil
+import itertools
 import logging
+import tempfile
+import threading
 import time
 
+from config import (POST_INFO_TTL, POST_INFO_CACHE_SIZE, LOADER_POOL_SIZE, HTTP_POOL_SIZE,
+                    INSTAGRAM_RATE, INSTAGRAM_BURST, INSTAGRAM_MIN_RATE, INSTAGRAM_BACKOFF_BASE, INSTAGRAM_BACKOFF_MAX,
+                    INSTAGRAM_SESSIONS_FILE, SESSION_QUARANTINE_SECONDS,
+                    RANGE_MIN_BYTES, RANGE_CHUNK_BYTES, RANGE_CONNECTIONS, RANGE_RETRIES)
+from metrics import STAGE_SECONDS, CACHE_REQUESTS, BYTES_DOWNLOADED, ERRORS
+from post_cache import PostCache
+from rate_limiter import AdaptiveRateLimiter, Priority, request_priority
+
+# Instaloader and requests are imported when the first request needs
+# Instagram, so startup and cache hits never pay for them
+if TYPE_CHECKING:
+    import instaloader
+    from loader_pool import LoaderPool
+    from media_stream import MediaStream
+    from post_resolver import PostResolver
+
 logger = logging.getLogger(__name__)
 
+# Downloads in progress live here until they are complete
+STAGING_DIR = '.staging'
+# Unfinished range downloads, kept across attempts and restarts for resuming
+PARTIAL_DIR = '.partial'
+
+
 class InstagramDownloader:
     def __init__(self):
         """
         Initialize Instagram downloader for public content only
+        
+        The loader pool and post resolver are built on the first call that
+        needs Instagram, so a process that only serves saved posts never
+        imports Instaloader.
         """
-        self.loader = instaloader.Instaloader(
-            download_pictures=True,
-            download_videos=True,
-            download_video_thumbnails=False,
-            download_geotags=False,
-            download_comments=False,
-            save_metadata=False,
-            compress_json=False
-        )
-        
-        # Set user agent to avoid detection
-        self.loader.context._session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        })
+        self._loader_pool: Optional["LoaderPool"] = None
+        self._resolver: Optional["PostResolver"] = None
+        self._network_lock = threading.Lock()
+        
+        # One cache index per download directory
+        self._caches: Dict[str, PostCache] = {}
+        self._caches_lock = threading.Lock()
         
         logger.info("Instagram downloader initialized for public content")
     
+    @property
+    def loader_pool(self) -> "LoaderPool":
+        self._ensure_network()
+        return self._loader_pool
+    
+    def is_idle(self) -> bool:
+        """Whether no request waits for Instagram, without building the loader pool"""
+        return self._loader_pool is None or self._loader_pool.is_idle()
+    
+    @property
+    def resolver(self) -> "PostResolver":
+        self._ensure_network()
+        return self._resolver
+    
+    def _ensure_network(self):
+        """Build the loader pool and resolver on first use"""
+        if self._loader_pool is not None:
+            return
+        with self._network_lock:
+            if self._loader_pool is not None:
+                return
+            from loader_pool import LoaderPool, load_session_specs
+            from range_fetcher import RangeFetcher
+            from post_resolver import PostResolver
+            
+            # Each session gets its own limiter pacing its share of Instagram traffic
+            loader_pool = LoaderPool(
+                specs=load_session_specs(INSTAGRAM_SESSIONS_FILE),
+                loaders_per_session=LOADER_POOL_SIZE,
+                http_pool_size=HTTP_POOL_SIZE,
+                limiter_factory=lambda: AdaptiveRateLimiter(
+                    rate=INSTAGRAM_RATE,
+                    burst=INSTAGRAM_BURST,
+                    min_rate=INSTAGRAM_MIN_RATE,
+                    backoff_base=INSTAGRAM_BACKOFF_BASE,
+                    backoff_max=INSTAGRAM_BACKOFF_MAX
+                ),
+                quarantine_seconds=SESSION_QUARANTINE_SECONDS,
+                range_fetcher_factory=lambda session: RangeFetcher(
+                    session,
+                    min_bytes=RANGE_MIN_BYTES,
+                    chunk_bytes=RANGE_CHUNK_BYTES,
+                    connections=RANGE_CONNECTIONS,
+                    retries=RANGE_RETRIES
+                )
+            )
+            
+            # Resolved posts are shared by get_post_info and download_post
+            self._resolver = PostResolver(loader_pool, ttl=POST_INFO_TTL, max_entries=POST_INFO_CACHE_SIZE)
+
+            # Published last: other threads only check this one
+            self._loader_pool = loader_pool
+    
+    def get_cache(self, download_path: str = "downloads") -> PostCache:
+        """
+        Get the saved-post index for a download directory
+        """
+        key = os.path.normpath(download_path)
+        with self._caches_lock:
+            if key not in self._caches:
+                self._caches[key] = PostCache(key)
+            return self._caches[key]
+    
+    def cleanup_interrupted(self, download_path: str = "downloads", older_than: float = 0,
+                            shortcodes: Iterable[str] = ()) -> int:
+        """
+        Remove staging directories and partial files left by interrupted downloads
+        
+        Only the staging directory and the directories of the given posts are
+        scanned, never the whole archive, so startup does not grow with it.
+        
+        Args:
+            older_than: only remove leftovers not modified for this many seconds,
+                so downloads still running in other processes are kept
+            shortcodes: posts of the unfinished jobs, whose directories may hold temp files
+        
+        Returns:
+            number of leftovers removed
+        """
+        if not os.path.isdir(download_path):
+            return 0
+        
+        cutoff = time.time() - older_than
+        removed = 0
+        staging_root = os.path.join(download_path, STAGING_DIR)
+        if os.path.isdir(staging_root):
+            for entry in os.listdir(staging_root):
+                path = os.path.join(staging_root, entry)
+                if os.path.getmtime(path) <= cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+        
+        # Temp files of Instaloader writes, streaming tees and blob links
+        for shortcode in set(shortcodes):
+            post_dir = os.path.join(download_path, shortcode)
+            if not os.path.isdir(post_dir):
+                continue
+            for entry in os.scandir(post_dir):
+                if (entry.is_file() and entry.name.endswith(('.temp', '.part', '.link'))
+                        and entry.stat().st_mtime <= cutoff):
+                    os.remove(entry.path)
+                    removed += 1
+        
+        if removed:
+            logger.info(f"Removed {removed} leftovers of interrupted downloads")
+        return removed
+    
     def is_valid_instagram_url(self, url: str) -> bool:
         """
         Check if the URL is a valid Instagram post/story URL
@@ -63,10 +190,57 @@ class InstagramDownloader:
                 return match.group(1)
         return None
     
-    def download_post(self, url: str, download_path: str = "downloads") -> Tuple[bool, str, list, dict]:
+    def extract_post_urls(self, text: str) -> List[str]:
+        """
+        Extract every post, reel and IGTV link from a text
+        
+        Returns:
+            the links in order of appearance, one per shortcode
+        """
+        urls = {}
+        for match in re.finditer(r'https?://(?:www\.)?instagram\.com/(?:p|reel|tv)/([A-Za-z0-9_-]+)/?', text):
+            urls.setdefault(match.group(1), match.group(0))
+        return list(urls.values())
+    
+    def get_profile_post_urls(self, username: str, limit: int,
+                              priority: Priority = Priority.INTERACTIVE) -> Tuple[bool, str, list]:
+        """
+        List the links of a public profile's latest posts
+        
+        The listed posts are cached in the resolver, so downloading them
+        does not fetch their metadata again.
+        
+        Returns:
+            (success, message, urls) with the newest post first
+        """
+        import instaloader
+        try:
+            with self.loader_pool.lease() as loader, request_priority(priority), \
+                    STAGE_SECONDS.labels('profile').time():
+                profile = instaloader.Profile.from_username(loader.context, username)
+                if profile.is_private:
+                    return False, "❌ این صفحه خصوصی است", []
+                posts = list(itertools.islice(profile.get_posts(), limit))
+            
+            for post in posts:
+                self.resolver.prime(post)
+            urls = [f"https://www.instagram.com/p/{post.shortcode}/" for post in posts]
+            return True, f"✅ {len(urls)} پست از @{username} یافت شد", urls
+            
+        except instaloader.exceptions.ProfileNotExistsException:
+            return False, f"❌ صفحه @{username} یافت نشد", []
+        except Exception as e:
+            logger.error(f"Error listing posts of {username}: {e}")
+            ERRORS.labels('profile', type(e).__name__).inc()
+            return False, f"❌ خطا در دریافت پست‌های صفحه: {str(e)}", []
+    
+    def download_post(self, url: str, download_path: str = "downloads",
+                      priority: Priority = Priority.INTERACTIVE) -> Tuple[bool, str, list, dict]:
         """
         Download Instagram post content with caption metadata
         
+        Instagram requests are scheduled with the given priority class.
+        
         Returns:
             (success, message, file_paths, post_info)
         """
@@ -80,63 +254,111 @@ class InstagramDownloader:
             
             # Create unique download directory for this post
             target_dir = os.path.normpath(os.path.join(download_path, shortcode))
-            os.makedirs(target_dir, exist_ok=True)
             
-            # Get post
-            post = instaloader.Post.from_shortcode(self.loader.context, shortcode)
+            # Get post (reuses the one resolved by get_post_info if still fresh)
+            post = self.resolve_post(shortcode, priority)
             
-            # Download post to target_dir (ensure no subdirectories are created)
-            self.loader.dirname_pattern = target_dir
-            self.loader.filename_pattern = "{shortcode}"
-            self.loader.download_post(post, target=target_dir)
+            # Download into a private staging directory first, so target_dir
+            # never holds a partial post if the download is interrupted
+            staging_root = os.path.join(download_path, STAGING_DIR)
+            os.makedirs(staging_root, exist_ok=True)
+            staging_dir = tempfile.mkdtemp(prefix=f"{shortcode}-", dir=staging_root)
+            try:
+                with self.loader_pool.lease() as loader, request_priority(priority), \
+                        STAGE_SECONDS.labels('fetch').time():
+                    loader.dirname_pattern = staging_dir
+                    loader.filename_pattern = "{shortcode}"
+                    loader.context.partial_dir = os.path.join(download_path, PARTIAL_DIR)
+                    loader.download_post(post, target=staging_dir)
+                
+                file_paths = self.publish_staged(staging_dir, target_dir)
+            finally:
+                shutil.rmtree(staging_dir, ignore_errors=True)
             
-            # Get downloaded files
+            return self.index_downloaded_post(post, file_paths, download_path)
+                
+        except Exception as e:
+            ERRORS.labels('download', type(e).__name__).inc()
+            return False, self.download_error_message(e), [], {}
+    
+    def resolve_post(self, shortcode: str, priority: Priority = Priority.INTERACTIVE) -> "instaloader.Post":
+        """
+        Fetch a post's metadata through the resolver with the given priority class
+        """
+        with request_priority(priority), STAGE_SECONDS.labels('resolve').time():
+            return self.resolver.resolve(shortcode)
+    
+    def publish_staged(self, staging_dir: str, target_dir: str) -> List[str]:
+        """
+        Move the complete set of media files of a download into place
+        
+        Returns:
+            paths of the moved files in name order
+        """
+        with STAGE_SECONDS.labels('move').time():
+            os.makedirs(target_dir, exist_ok=True)
             file_paths = []
-            for file in os.listdir(target_dir):
+            for file in sorted(os.listdir(staging_dir)):
+                if not file.endswith(('.jpg', '.jpeg', '.png', '.mp4', '.mov')):
+                    continue
                 full_path = os.path.normpath(os.path.join(target_dir, file))
-                if os.path.isfile(full_path) and file.endswith(('.jpg', '.jpeg', '.png', '.mp4', '.mov')):
-                    file_paths.append(full_path)
-                    logger.info(f"Found file: {full_path}")
-            
-            # Save metadata (only caption)
-            post_info = {
-                'shortcode': shortcode,
-                'username': post.owner_username,
-                'caption': post.caption,
-                'likes': post.likes,
-                'comments': post.comments,
-                'is_video': post.is_video,
-                'video_view_count': post.video_view_count if post.is_video else 0,
-                'date': post.date_utc.strftime("%Y-%m-%d %H:%M:%S"),
-                'file_paths': file_paths
-            }
-            
-            # Save metadata to JSON file
-            import json
-            metadata_path = os.path.normpath(os.path.join(target_dir, f"{shortcode}_metadata.json"))
-            with open(metadata_path, 'w', encoding='utf-8') as f:
-                json.dump(post_info, f, ensure_ascii=False, indent=2)
-            logger.info(f"Saved metadata: {metadata_path}")
-            
-            if file_paths:
-                return True, f"✅ پست با موفقیت دانلود شد\n📁 {len(file_paths)} فایل", file_paths, post_info
-            else:
-                logger.error(f"No files found in {target_dir} after download.")
-                return False, "❌ هیچ فایلی دانلود نشد", [], {}
-                
-        except instaloader.exceptions.InstaloaderException as e:
+                BYTES_DOWNLOADED.inc(os.path.getsize(os.path.join(staging_dir, file)))
+                os.replace(os.path.join(staging_dir, file), full_path)
+                file_paths.append(full_path)
+                logger.info(f"Found file: {full_path}")
+        return file_paths
+    
+    def index_downloaded_post(self, post: "instaloader.Post", file_paths: List[str],
+                              download_path: str = "downloads") -> Tuple[bool, str, list, dict]:
+        """
+        Index a downloaded post so later requests skip the network
+        
+        Returns:
+            the (success, message, file_paths, post_info) result of download_post
+        """
+        # Save metadata (only caption)
+        post_info = self._build_post_info(post)
+        post_info['file_paths'] = file_paths
+        
+        if not file_paths:
+            logger.error(f"No files found for {post.shortcode} after download.")
+            return False, "❌ هیچ فایلی دانلود نشد", [], {}
+        
+        with STAGE_SECONDS.labels('index').time():
+            self.get_cache(download_path).put_post(post_info, file_paths)
+        return True, f"✅ پست با موفقیت دانلود شد\n📁 {len(file_paths)} فایل", file_paths, post_info
+    
+    def download_error_message(self, e: Exception) -> str:
+        """
+        User-facing message for an exception raised while downloading a post
+        """
+        import instaloader
+        if isinstance(e, instaloader.exceptions.InstaloaderException):
             logger.error(f"Instaloader error: {e}")
             if "Login required" in str(e):
-                return False, "❌ این پست خصوصی است و نیاز به ورود دارد", [], {}
+                return "❌ این پست خصوصی است و نیاز به ورود دارد"
             elif "Not found" in str(e):
-                return False, "❌ پست یافت نشد یا حذف شده است", [], {}
-            else:
-                return False, f"❌ خطا در دانلود: {str(e)}", [], {}
-        except Exception as e:
-            logger.error(f"Unexpected error: {e}")
-            return False, f"❌ خطای غیرمنتظره: {str(e)}", [], {}
+                return "❌ پست یافت نشد یا حذف شده است"
+            return f"❌ خطا در دانلود: {str(e)}"
+        logger.error(f"Unexpected error: {e}")
+        return f"❌ خطای غیرمنتظره: {str(e)}"
 
-    def get_post_info(self, url: str) -> Tuple[bool, str, dict]:
+    def _build_post_info(self, post: "instaloader.Post") -> dict:
+        """
+        Build the metadata dict stored and shown for a post
+        """
+        return {
+            'shortcode': post.shortcode,
+            'username': post.owner_username,
+            'caption': post.caption,
+            'likes': post.likes,
+            'comments': post.comments,
+            'is_video': post.is_video,
+            'video_view_count': post.video_view_count if post.is_video else 0,
+            'date': post.date_utc.strftime("%Y-%m-%d %H:%M:%S")
+        }
+    
+    def get_post_info(self, url: str, priority: Priority = Priority.INTERACTIVE) -> Tuple[bool, str, dict]:
         """
         Get post information without downloading
         """
@@ -148,24 +370,78 @@ class InstagramDownloader:
             if not shortcode:
                 return False, "❌ نمی‌توان کد پست را استخراج کرد", {}
             
-            post = instaloader.Post.from_shortcode(self.loader.context, shortcode)
+            post = self.resolve_post(shortcode, priority)
             
-            info = {
-                'shortcode': shortcode,
-                'username': post.owner_username,
-                'caption': post.caption[:100] + "..." if post.caption and len(post.caption) > 100 else post.caption,
-                'likes': post.likes,
-                'comments': post.comments,
-                'is_video': post.is_video,
-                'video_view_count': post.video_view_count if post.is_video else 0,
-                'date': post.date_utc.strftime("%Y-%m-%d %H:%M:%S")
-            }
+            info = self._build_post_info(post)
+            if info['caption'] and len(info['caption']) > 100:
+                info['caption'] = info['caption'][:100] + "..."
             
             return True, "✅ اطلاعات پست دریافت شد", info
             
         except Exception as e:
+            ERRORS.labels('info', type(e).__name__).inc()
             return False, f"❌ خطا در دریافت اطلاعات: {str(e)}", {}
     
+    def resolve_media(self, url: str, priority: Priority = Priority.INTERACTIVE) -> Tuple[bool, str, list, dict]:
+        """
+        Resolve the media URLs of a post without downloading anything
+        
+        Returns:
+            (success, message, media, post_info) where media is a list of
+            {'url', 'is_video', 'filename'} in post order
+        """
+        try:
+            if not self.is_valid_instagram_url(url):
+                return False, "❌ لینک اینستاگرام نامعتبر است", [], {}
+            
+            shortcode = self.extract_shortcode(url)
+            if not shortcode:
+                return False, "❌ نمی‌توان کد پست را استخراج کرد", [], {}
+            
+            post = self.resolve_post(shortcode, priority)
+            media = self.media_items(post)
+            
+            return True, f"✅ پست آماده ارسال است\n📁 {len(media)} فایل", media, self._build_post_info(post)
+            
+        except Exception as e:
+            logger.error(f"Error resolving media: {e}")
+            ERRORS.labels('resolve_media', type(e).__name__).inc()
+            return False, f"❌ خطا در دریافت اطلاعات: {str(e)}", [], {}
+    
+    def media_items(self, post: "instaloader.Post") -> List[dict]:
+        """
+        Media URLs of a resolved post as {'url', 'is_video', 'filename'} in post order
+        """
+        shortcode = post.shortcode
+        # Same file names Instaloader would use with the "{shortcode}" pattern
+        if post.typename == 'GraphSidecar':
+            nodes = [(n.is_video, n.video_url if n.is_video else n.display_url) for n in post.get_sidecar_nodes()]
+            return [
+                {'url': media_url, 'is_video': is_video, 'filename': f"{shortcode}_{i}.{'mp4' if is_video else 'jpg'}"}
+                for i, (is_video, media_url) in enumerate(nodes, 1)
+            ]
+        elif post.is_video:
+            return [{'url': post.video_url, 'is_video': True, 'filename': f"{shortcode}.mp4"}]
+        return [{'url': post.url, 'is_video': False, 'filename': f"{shortcode}.jpg"}]
+    
+    def index_streamed_post(self, post_info: dict, files: list, on_disk: bool, download_path: str = "downloads"):
+        """
+        Index a post whose media was streamed instead of downloaded
+        
+        Args:
+            post_info: metadata from resolve_media
+            files: (path, size, sha256) per media item
+            on_disk: whether the stream was teed into the cache
+        """
+        self.get_cache(download_path).put_post(post_info, [f[0] for f in files], hashed=files, on_disk=on_disk)
+    
+    def remember_file_id(self, shortcode: str, file_path: str, file_id: Optional[str],
+                         kind: Optional[str] = None, download_path: str = "downloads"):
+        """
+        Store the Telegram file_id of a sent file so it is never uploaded again
+        """
+        self.get_cache(download_path).set_file_id(shortcode, file_path, file_id, kind)
+    
     def load_saved_post(self, shortcode: str, download_path: str = "downloads") -> Tuple[bool, str, dict]:
         """
         Load previously saved post data
@@ -174,30 +450,50 @@ class InstagramDownloader:
             (success, message, post_info)
         """
         try:
-            metadata_path = os.path.join(download_path, f"{shortcode}_metadata.json")
+            cache = self.get_cache(download_path)
+            post_info = cache.get_post(shortcode) or cache.import_legacy_metadata(shortcode)
             
-            if not os.path.exists(metadata_path):
+            if post_info is None:
+                CACHE_REQUESTS.labels('miss').inc()
                 return False, "❌ اطلاعات پست ذخیره نشده است", {}
             
-            import json
-            with open(metadata_path, 'r', encoding='utf-8') as f:
-                post_info = json.load(f)
-            
-            # Verify files still exist
+            # Verify every file is in the blob store (relinking it into the post
+            # directory if needed), still on disk, or can be resent by Telegram file_id
             verified_files = []
-            for file_path in post_info.get('file_paths', []):
-                if os.path.exists(file_path):
+            file_ids = {}
+            missing = False
+            files = post_info.pop('files')
+            evicted = post_info.pop('evicted')
+            # An evicted post is only relinked if other posts kept all of its blobs
+            on_disk = not evicted or all(cache.blobs.has(entry['sha256']) for entry in files)
+            for entry in files:
+                file_path = entry['path']
+                if entry['telegram_file_id']:
+                    file_ids[file_path] = {'file_id': entry['telegram_file_id'], 'kind': entry['telegram_kind']}
+                if on_disk and (cache.blobs.restore(entry['sha256'], file_path) or (
+                        os.path.isfile(file_path) and os.path.getsize(file_path) == entry['size'])):
+                    verified_files.append(file_path)
+                elif file_path in file_ids:
                     verified_files.append(file_path)
                 else:
-                    logger.warning(f"File not found: {file_path}")
+                    logger.warning(f"File missing or changed: {file_path}")
+                    missing = True
             
             post_info['file_paths'] = verified_files
+            post_info['file_ids'] = file_ids
             
-            if verified_files:
+            # A partial set is treated as a miss so the post is downloaded again
+            if verified_files and not missing:
+                if evicted and on_disk:
+                    cache.mark_restored(shortcode)
+                cache.touch(shortcode)
+                CACHE_REQUESTS.labels('hit').inc()
                 return True, f"✅ اطلاعات پست بارگذاری شد\n📁 {len(verified_files)} فایل", post_info
             else:
+                CACHE_REQUESTS.labels('partial').inc()
                 return False, "❌ فایل‌های پست یافت نشد", {}
                 
         except Exception as e:
             logger.error(f"Error loading saved post: {e}")
+            ERRORS.labels('lookup', type(e).__name__).inc()
             return False, f"❌ خطا در بارگذاری اطلاعات: {str(e)}", {}
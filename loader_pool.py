@@ -0,0 +1,333 @@
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+import instaloader
+from instaloader.exceptions import (ConnectionException, LoginRequiredException, QueryReturnedForbiddenException,
+                                    QueryReturnedNotFoundException)
+from requests.adapters import HTTPAdapter
+
+from range_fetcher import RangeFetcher
+from rate_limiter import AdaptiveRateLimiter, classify_response, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# Set user agent to avoid detection
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+
+@dataclass
+class SessionSpec:
+    """
+    One Instagram identity: its own proxy, headers, cookies and rate budget
+
+    `endpoint` sends Instagram API traffic to another base URL instead of
+    https://www.instagram.com, e.g. a local fake server in tests.
+    """
+    name: str = "direct"
+    proxy: Optional[str] = None
+    headers: Dict[str, str] = field(default_factory=dict)
+    cookies: Dict[str, str] = field(default_factory=dict)
+    endpoint: Optional[str] = None
+
+
+def load_session_specs(path: Optional[str]) -> List[SessionSpec]:
+    """
+    Read session specs from a JSON list of {name, proxy, headers, cookies, endpoint}
+
+    Without a file a single direct session is used.
+    """
+    if not path:
+        return [SessionSpec()]
+    with open(path, 'r', encoding='utf-8') as f:
+        return [SessionSpec(**entry) for entry in json.load(f)]
+
+
+class EndpointAdapter(HTTPAdapter):
+    """
+    Transport adapter that redirects Instagram API hosts to another base URL
+
+    The response keeps the original URL, so Instaloader and the health
+    checks see the same thing they would against Instagram.
+    """
+
+    def __init__(self, endpoint: str, **kwargs):
+        self.endpoint = endpoint.rstrip('/')
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        original_url = request.url
+        parsed = urlparse(original_url)
+        if parsed.hostname in ('www.instagram.com', 'i.instagram.com'):
+            request.url = self.endpoint + original_url.split(parsed.netloc, 1)[1]
+        response = super().send(request, **kwargs)
+        response.url = original_url
+        request.url = original_url
+        return response
+
+
+class AdaptiveRateController(instaloader.RateController):
+    """
+    Instaloader rate controller that defers to a shared AdaptiveRateLimiter
+
+    Instaloader's own per-query sliding windows still apply as a hard ceiling.
+    429s are already reported to the limiter by the session's response hook,
+    so the retry only waits for the limiter instead of Instaloader's fixed sleep.
+    """
+
+    def __init__(self, context: instaloader.InstaloaderContext, limiter: AdaptiveRateLimiter):
+        super().__init__(context)
+        self.limiter = limiter
+
+    def wait_before_query(self, query_type: str) -> None:
+        self.limiter.acquire()
+        super().wait_before_query(query_type)
+
+    def handle_429(self, query_type: str) -> None:
+        self._context.error(f"Instagram responded with 429 for {query_type}, retrying after backoff",
+                            repeat_at_end=False)
+
+
+class PooledInstaloaderContext(instaloader.InstaloaderContext):
+    """
+    Instaloader context that keeps its HTTP connections warm
+
+    Stock Instaloader opens a fresh anonymous session for every media request;
+    this context reuses one pooled session for all CDN downloads instead.
+    Every session it creates carries the spec's proxy, headers and cookies.
+    Large files are handed to a RangeFetcher on the same session, which
+    keeps unfinished files in partial_dir (set per download) for resuming.
+    """
+
+    def __init__(self, *args, http_pool_size: int = 10, spec: Optional[SessionSpec] = None,
+                 response_hook=None, range_fetcher_factory=None, **kwargs):
+        # Needed by get_anonymous_session, which the base __init__ calls
+        self.http_pool_size = http_pool_size
+        self.spec = spec or SessionSpec()
+        self.response_hook = response_hook
+        super().__init__(*args, **kwargs)
+        self._cdn_session = self.get_anonymous_session()
+        self.range_fetcher: Optional[RangeFetcher] = (
+            range_fetcher_factory(self._cdn_session) if range_fetcher_factory else None
+        )
+        self.partial_dir: Optional[str] = None
+
+    def get_anonymous_session(self) -> requests.Session:
+        session = super().get_anonymous_session()
+        self._configure_session(session)
+        session.headers.update(self.spec.headers)
+        session.cookies.update(self.spec.cookies)
+        return session
+
+    def _configure_session(self, session: requests.Session):
+        """Apply the pooled adapters, endpoint, proxy and response hook to a session"""
+        adapter = HTTPAdapter(pool_connections=self.http_pool_size, pool_maxsize=self.http_pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if self.spec.endpoint:
+            endpoint_adapter = EndpointAdapter(self.spec.endpoint, pool_connections=self.http_pool_size,
+                                               pool_maxsize=self.http_pool_size)
+            session.mount('https://www.instagram.com/', endpoint_adapter)
+            session.mount('https://i.instagram.com/', endpoint_adapter)
+        if self.spec.proxy:
+            session.proxies.update({'http': self.spec.proxy, 'https': self.spec.proxy})
+        if self.response_hook is not None and self.response_hook not in session.hooks['response']:
+            session.hooks['response'].append(self.response_hook)
+
+    def get_json(self, path: str, params: Dict, host: str = 'www.instagram.com',
+                 session: Optional[requests.Session] = None, *args, **kwargs) -> Dict:
+        # Instaloader's copy_session (used for doc_id queries) drops adapters,
+        # proxies and hooks, so the copies would bypass this session's spec
+        if session is not None and session is not self._session and not getattr(session, '_configured', False):
+            self._configure_session(session)
+            session._configured = True
+        return super().get_json(path, params, host, session, *args, **kwargs)
+
+    def _check_raw_response(self, resp: requests.Response) -> requests.Response:
+        if resp.status_code == 200:
+            return resp
+        if resp.status_code == 403:
+            # suspected invalid URL signature
+            raise QueryReturnedForbiddenException(self._response_error(resp))
+        if resp.status_code == 404:
+            raise QueryReturnedNotFoundException(self._response_error(resp))
+        raise ConnectionException(self._response_error(resp))
+
+    def get_raw(self, url: str, _attempt=1) -> requests.Response:
+        resp = self._check_raw_response(self._cdn_session.get(url, stream=True))
+        resp.raw.decode_content = True
+        return resp
+
+    def head(self, url: str, allow_redirects: bool = False) -> requests.Response:
+        return self._check_raw_response(self._cdn_session.head(url, allow_redirects=allow_redirects))
+
+    def write_raw(self, resp, filename: str) -> None:
+        if not isinstance(resp, requests.Response):
+            return super().write_raw(resp, filename)
+        self.log(filename, end=' ', flush=True)
+        if self.range_fetcher is not None and self.range_fetcher.fetch(resp, filename, self.partial_dir):
+            return
+        # Read through iter_content so the connection goes back to the pool
+        with resp, open(filename + '.temp', 'wb') as file:
+            for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                file.write(chunk)
+        os.replace(filename + '.temp', filename)
+
+    def close(self):
+        super().close()
+        self._cdn_session.close()
+
+
+class _SessionSlot:
+    """Loaders of one session spec with their shared limiter and health state"""
+
+    def __init__(self, spec: SessionSpec, limiter: AdaptiveRateLimiter):
+        self.spec = spec
+        self.limiter = limiter
+        self.idle: List[instaloader.Instaloader] = []
+        self.in_use = 0
+        self.quarantined_until = 0.0
+        self.strikes = 0
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.quarantined_until
+
+
+class LoaderPool:
+    def __init__(self, specs: Optional[List[SessionSpec]] = None, loaders_per_session: int = 4,
+                 http_pool_size: int = 10, limiter_factory=None, quarantine_seconds: float = 300,
+                 range_fetcher_factory=None):
+        """
+        Pool of Instaloader instances leased per job, spread over sessions with their own limiters
+
+        Args:
+            specs: sessions to use, a single direct session by default
+            loaders_per_session: concurrent jobs per session
+            http_pool_size: keep-alive connections per HTTP session
+            limiter_factory: callable returning a new AdaptiveRateLimiter
+            quarantine_seconds: base quarantine after a login wall
+            range_fetcher_factory: callable returning a RangeFetcher for a CDN session,
+                None downloads every file in one request
+        """
+        self.quarantine_seconds = quarantine_seconds
+        self.range_fetcher_factory = range_fetcher_factory
+        limiter_factory = limiter_factory or AdaptiveRateLimiter
+        self._cond = threading.Condition()
+        self._slots: List[_SessionSlot] = []
+        for spec in specs or [SessionSpec()]:
+            slot = _SessionSlot(spec, limiter_factory())
+            for _ in range(loaders_per_session):
+                slot.idle.append(self._create_loader(slot, http_pool_size))
+            self._slots.append(slot)
+        logger.info(f"Loader pool ready: {len(self._slots)} sessions x {loaders_per_session} loaders")
+
+    @property
+    def specs(self) -> List[SessionSpec]:
+        """Session specs of the pool, in configuration order"""
+        return [slot.spec for slot in self._slots]
+
+    def _create_loader(self, slot: _SessionSlot, http_pool_size: int) -> instaloader.Instaloader:
+        loader = instaloader.Instaloader(
+            download_pictures=True,
+            download_videos=True,
+            download_video_thumbnails=False,
+            download_geotags=False,
+            download_comments=False,
+            save_metadata=False,
+            compress_json=False
+        )
+        loader.context.close()
+        loader.context = PooledInstaloaderContext(
+            user_agent=USER_AGENT,
+            http_pool_size=http_pool_size,
+            spec=slot.spec,
+            response_hook=lambda resp, *args, **kwargs: self._on_response(slot, resp),
+            range_fetcher_factory=self.range_fetcher_factory,
+            rate_controller=lambda context: AdaptiveRateController(context, slot.limiter)
+        )
+        return loader
+
+    def _on_response(self, slot: _SessionSlot, resp: requests.Response):
+        """Feed Instagram API responses into the session's limiter and health"""
+        outcome = classify_response(resp)
+        if outcome == 'ok':
+            slot.limiter.on_success()
+            slot.strikes = 0
+        elif outcome == 'rate_limited':
+            self.quarantine(slot, slot.limiter.on_rate_limited(retry_after_seconds(resp)), "rate limited")
+        elif outcome == 'login_wall':
+            self.quarantine(slot, self.quarantine_seconds * 2 ** slot.strikes, "login wall")
+
+    def quarantine(self, slot: _SessionSlot, seconds: float, reason: str):
+        """Take a session out of rotation for a while"""
+        with self._cond:
+            slot.strikes += 1
+            slot.quarantined_until = max(slot.quarantined_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+        logger.warning(f"Session {slot.spec.name} quarantined for {seconds:.0f}s: {reason}")
+
+    def _pick_slot(self, now: float) -> Optional[_SessionSlot]:
+        candidates = [slot for slot in self._slots if slot.idle and slot.healthy(now)]
+        if not candidates and not any(slot.healthy(now) for slot in self._slots):
+            # Everything is quarantined: use whichever session recovers first
+            candidates = [slot for slot in self._slots if slot.idle]
+            candidates.sort(key=lambda slot: slot.quarantined_until)
+            return candidates[0] if candidates else None
+        if not candidates:
+            return None
+        return max(candidates, key=lambda slot: (slot.limiter.available_tokens(), -slot.in_use))
+
+    @contextmanager
+    def lease(self):
+        """
+        Borrow a loader for the duration of a job, blocking until one is free
+        """
+        with self._cond:
+            while True:
+                slot = self._pick_slot(time.monotonic())
+                if slot is not None:
+                    break
+                self._cond.wait(timeout=1)
+            loader = slot.idle.pop()
+            slot.in_use += 1
+
+        try:
+            yield loader
+        except LoginRequiredException:
+            self.quarantine(slot, self.quarantine_seconds * 2 ** slot.strikes, "login required")
+            raise
+        finally:
+            with self._cond:
+                slot.idle.append(loader)
+                slot.in_use -= 1
+                self._cond.notify()
+
+    def is_idle(self) -> bool:
+        """True when some healthy session has spare budget and a free loader"""
+        now = time.monotonic()
+        with self._cond:
+            return any(slot.idle and slot.healthy(now) and slot.limiter.is_idle() for slot in self._slots)
+
+    def stats(self) -> List[dict]:
+        """Per-session state for monitoring"""
+        now = time.monotonic()
+        with self._cond:
+            return [{
+                'name': slot.spec.name,
+                'healthy': slot.healthy(now),
+                'in_use': slot.in_use,
+                'rate': slot.limiter.rate
+            } for slot in self._slots]
+
+    def close(self):
+        with self._cond:
+            for slot in self._slots:
+                for loader in slot.idle:
+                    loader.close()
@@ -0,0 +1,296 @@
+import os
+import json
+import shutil
+import struct
+import asyncio
+import logging
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Optional
+
+from metrics import STAGE_SECONDS, ERRORS
+from post_cache import PostCache
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Variant files stored next to each video blob
+VARIANT_SUFFIX = 'stream.mp4'
+THUMBNAIL_SUFFIX = 'thumb.jpg'
+METADATA_SUFFIX = 'video.json'
+
+AUDIO_BITRATE = 128_000
+MIN_VIDEO_BITRATE = 150_000
+THUMBNAIL_SIZE = 320  # Telegram's maximum thumbnail width and height
+
+
+@dataclass
+class VideoVariant:
+    """Streamable MP4 of a video with its thumbnail and stream properties"""
+    path: str
+    thumbnail: Optional[str]
+    width: int
+    height: int
+    duration: int
+
+
+def is_faststart(file_path: str) -> bool:
+    """Check whether the moov atom of an MP4 comes before its media data"""
+    with open(file_path, 'rb') as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, kind = struct.unpack('>I4s', header)
+            if kind == b'moov':
+                return True
+            if kind == b'mdat':
+                return False
+            if size == 1:
+                size = struct.unpack('>Q', f.read(8))[0] - 8
+            elif size < 8:
+                return False
+            f.seek(size - 8, os.SEEK_CUR)
+
+
+def probe_video(file_path: str, ffprobe: str = 'ffprobe', timeout: float = 60) -> dict:
+    """
+    Read the stream properties of a video with ffprobe
+
+    Returns:
+        {duration, width, height, video_codec, pix_fmt, audio_codec, size}
+    """
+    result = subprocess.run(
+        [ffprobe, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', file_path],
+        capture_output=True, check=True, timeout=timeout
+    )
+    data = json.loads(result.stdout)
+    streams = data.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    if video is None:
+        raise ValueError(f"No video stream in {file_path}")
+
+    return {
+        'duration': float(data.get('format', {}).get('duration') or video.get('duration') or 0),
+        'width': int(video.get('width') or 0),
+        'height': int(video.get('height') or 0),
+        'video_codec': video.get('codec_name'),
+        'pix_fmt': video.get('pix_fmt'),
+        'audio_codec': audio.get('codec_name') if audio else None,
+        'size': os.path.getsize(file_path),
+    }
+
+
+def _run_ffmpeg(ffmpeg: str, args: list, output_path: str, timeout: float):
+    """Run ffmpeg into a .part file and move it into place when it succeeds"""
+    part_path = output_path + '.part'
+    try:
+        subprocess.run([ffmpeg, '-y', '-v', 'error', '-nostdin'] + args + [part_path],
+                       capture_output=True, check=True, timeout=timeout)
+        os.replace(part_path, output_path)
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+
+def prepare_video(source_path: str, variant_path: str, thumbnail_path: str, metadata_path: str,
+                  max_bytes: int, max_dimension: int = 1280, preset: str = 'veryfast',
+                  ffmpeg: str = 'ffmpeg', ffprobe: str = 'ffprobe', timeout: float = 600) -> dict:
+    """
+    Write the streamable variant, thumbnail and metadata of a video
+
+    Runs in a worker process. A video that already is H.264/AAC, fits
+    max_bytes and has its index up front is linked as is; one that only
+    lacks the up-front index is remuxed; anything else is re-encoded at the
+    bitrate that fits max_bytes, scaled down to max_dimension.
+
+    Returns:
+        the metadata that was written
+    """
+    info = probe_video(source_path, ffprobe)
+    compatible = (info['video_codec'] == 'h264' and info['pix_fmt'] in ('yuv420p', None)
+                  and info['audio_codec'] in ('aac', None))
+
+    if compatible and info['size'] <= max_bytes and is_faststart(source_path):
+        method = 'link'
+        try:
+            os.link(source_path, variant_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copyfile(source_path, variant_path)
+    elif compatible and info['size'] <= max_bytes:
+        method = 'remux'
+        _run_ffmpeg(ffmpeg, ['-i', source_path, '-map', '0', '-c', 'copy', '-movflags', '+faststart', '-f', 'mp4'],
+                    variant_path, timeout)
+    else:
+        method = 'transcode'
+        if info['duration'] <= 0:
+            raise ValueError(f"Unknown duration of {source_path}")
+        audio_bitrate = AUDIO_BITRATE if info['audio_codec'] else 0
+        # 5% headroom for the container
+        video_bitrate = int(max_bytes * 8 * 0.95 / info['duration']) - audio_bitrate
+        video_bitrate = min(video_bitrate, int(info['size'] * 8 / info['duration']))
+        if video_bitrate < MIN_VIDEO_BITRATE:
+            raise ValueError(f"{source_path} is too long to fit in {max_bytes} bytes")
+        scale = (f"scale='if(gt(iw,ih),min(iw,{max_dimension}),-2)':'if(gt(iw,ih),-2,min(ih,{max_dimension}))',"
+                 f"format=yuv420p")
+        _run_ffmpeg(ffmpeg, [
+            '-i', source_path, '-map', '0:v:0', '-map', '0:a:0?', '-vf', scale,
+            '-c:v', 'libx264', '-preset', preset, '-b:v', str(video_bitrate),
+            '-maxrate', str(video_bitrate), '-bufsize', str(2 * video_bitrate),
+            '-c:a', 'aac', '-b:a', str(AUDIO_BITRATE), '-movflags', '+faststart', '-f', 'mp4'
+        ], variant_path, timeout)
+        if os.path.getsize(variant_path) > max_bytes:
+            os.remove(variant_path)
+            raise ValueError(f"Transcoded {source_path} is still over {max_bytes} bytes")
+        info.update({k: v for k, v in probe_video(variant_path, ffprobe).items() if k in ('width', 'height')})
+
+    try:
+        _run_ffmpeg(ffmpeg, [
+            '-ss', str(min(1.0, info['duration'] / 2)), '-i', variant_path, '-frames:v', '1',
+            '-vf', f"scale={THUMBNAIL_SIZE}:{THUMBNAIL_SIZE}:force_original_aspect_ratio=decrease",
+            '-q:v', '5', '-f', 'mjpeg'
+        ], thumbnail_path, timeout)
+    except (subprocess.SubprocessError, OSError) as e:
+        logger.warning(f"Could not create thumbnail of {source_path}: {e}")
+
+    metadata = {
+        'width': info['width'],
+        'height': info['height'],
+        'duration': round(info['duration']),
+        'method': method,
+    }
+    # Written last: a variant only counts as ready once its metadata exists
+    with open(metadata_path + '.part', 'w', encoding='utf-8') as f:
+        json.dump(metadata, f)
+    os.replace(metadata_path + '.part', metadata_path)
+    return metadata
+
+
+class MediaProcessor:
+    def __init__(self, cache: PostCache, max_bytes: int, max_dimension: int = 1280,
+                 workers: int = 2, preset: str = 'veryfast', timeout: float = 600,
+                 ffmpeg: str = 'ffmpeg', ffprobe: str = 'ffprobe', enabled: bool = True):
+        """
+        Prepare downloaded videos for Telegram in a process pool
+
+        Every video gets a streamable MP4 variant (H.264/AAC, index at the
+        start, at most max_bytes) and a JPEG thumbnail, created in the
+        background when it is first sent, so later sends use send_video and
+        play before the video is fully downloaded. Variants
+        are kept next to the video's blob, keyed by its content hash, so
+        every later request for the same media reuses them; they count
+        against the storage quota and are deleted together with the blob.
+
+        Args:
+            cache: post index, used to find the blob of a file
+            max_bytes: size cap of the variants
+            max_dimension: longer side of re-encoded videos in pixels
+            workers: number of processes running ffmpeg
+            preset: x264 preset of re-encodes
+            timeout: seconds after which an ffmpeg run is killed
+        """
+        self.cache = cache
+        self.max_bytes = max_bytes
+        self.max_dimension = max_dimension
+        self.workers = workers
+        self.preset = preset
+        self.timeout = timeout
+        self.ffmpeg = shutil.which(ffmpeg)
+        self.ffprobe = shutil.which(ffprobe)
+        self.available = bool(enabled and self.ffmpeg and self.ffprobe)
+        if enabled and not self.available:
+            logger.warning("ffmpeg or ffprobe not found, videos are sent as downloaded")
+
+        # Concurrent requests for the same video share one ffmpeg run
+        self._single_flight = SingleFlight()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # Variants being created for later requests
+        self._tasks = set()
+
+    def _load(self, sha256: str) -> Optional[VideoVariant]:
+        """Read a finished variant of a blob"""
+        blobs = self.cache.blobs
+        metadata_path = blobs.variant_path(sha256, METADATA_SUFFIX)
+        variant_path = blobs.variant_path(sha256, VARIANT_SUFFIX)
+        thumbnail_path = blobs.variant_path(sha256, THUMBNAIL_SUFFIX)
+        try:
+            with open(metadata_path, encoding='utf-8') as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not os.path.isfile(variant_path):
+            return None
+        return VideoVariant(
+            path=variant_path,
+            thumbnail=thumbnail_path if os.path.isfile(thumbnail_path) else None,
+            width=metadata['width'],
+            height=metadata['height'],
+            duration=metadata['duration']
+        )
+
+    async def prepare(self, file_path: str) -> Optional[VideoVariant]:
+        """
+        Get the streamable variant of a downloaded video if it is ready
+
+        A missing variant is created in the background for later requests,
+        so callers never wait for ffmpeg.
+
+        Returns:
+            the variant, or None if the original should be sent as is
+        """
+        if not self.available:
+            return None
+
+        try:
+            sha256 = await asyncio.to_thread(self.cache.file_sha256, file_path)
+            if sha256 is None:
+                return None
+            variant = await asyncio.to_thread(self._load, sha256)
+            if variant is None:
+                task = asyncio.create_task(self._create(file_path, sha256))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            return variant
+
+        except Exception as e:
+            logger.warning(f"Could not prepare {file_path} for streaming: {e}")
+            ERRORS.labels('transcode', type(e).__name__).inc()
+            return None
+
+    async def _create(self, file_path: str, sha256: str):
+        """Create the variant of a blob and count its bytes against the storage quota"""
+        try:
+            with STAGE_SECONDS.labels('transcode').time():
+                metadata = await self._single_flight.do(sha256, lambda: self._run(file_path, sha256))
+            await asyncio.to_thread(self.cache.set_variant_size, sha256, self.cache.blobs.variant_size(sha256))
+            logger.info(f"Prepared streamable variant of {file_path} ({metadata['method']})")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Could not prepare {file_path} for streaming: {e}")
+            ERRORS.labels('transcode', type(e).__name__).inc()
+
+    async def _run(self, file_path: str, sha256: str) -> dict:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        blobs = self.cache.blobs
+        return await asyncio.get_running_loop().run_in_executor(
+            self._pool, prepare_video,
+            file_path,
+            blobs.variant_path(sha256, VARIANT_SUFFIX),
+            blobs.variant_path(sha256, THUMBNAIL_SUFFIX),
+            blobs.variant_path(sha256, METADATA_SUFFIX),
+            self.max_bytes, self.max_dimension, self.preset, self.ffmpeg, self.ffprobe, self.timeout
+        )
+
+    def shutdown(self):
+        """Stop the ffmpeg processes"""
+        for task in self._tasks:
+            task.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,148 @@
+import os
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+import mimetypes
+from concurrent.futures import Executor
+from typing import AsyncIterator, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+class MediaStream:
+    """
+    Chunks of a streamed CDN response, optionally teed into a cache file
+
+    The response is read on the event loop, so a slow CDN holds no thread.
+    Disk work of the tee runs in the given executor and the cache file is a
+    temporary file of its own, only renamed into place once the stream
+    completes.
+    """
+
+    def __init__(self, response: httpx.Response, tee_path: Optional[str] = None,
+                 chunk_size: int = 1024 * 1024, executor: Optional[Executor] = None):
+        self.response = response
+        self.tee_path = tee_path
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.size = 0
+        self.completed = False
+        # Content-Length counts the bytes on the wire, before any decoding
+        length = response.headers.get('Content-Length', '')
+        encoded = response.headers.get('Content-Encoding', 'identity').lower() != 'identity'
+        self.length: Optional[int] = int(length) if length.isdigit() and not encoded else None
+
+        self._digest = hashlib.sha256()
+        self._tee = None
+        self._part_path: Optional[str] = None
+        # Guards the tee file between the writer and aclose
+        self._lock = threading.Lock()
+
+    @property
+    def sha256(self) -> str:
+        return self._digest.hexdigest()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _open_tee(self):
+        os.makedirs(os.path.dirname(self.tee_path) or '.', exist_ok=True)
+        # Streams of the same post must not share a temporary file
+        fd, part_path = tempfile.mkstemp(prefix=os.path.basename(self.tee_path) + '.', suffix='.part',
+                                         dir=os.path.dirname(self.tee_path) or '.')
+        # mkstemp creates the file readable by the owner only
+        os.chmod(part_path, 0o644)
+        with self._lock:
+            self._tee, self._part_path = os.fdopen(fd, 'wb'), part_path
+
+    def _consume(self, chunk: bytes):
+        self._digest.update(chunk)
+        with self._lock:
+            if self._tee is not None:
+                self._tee.write(chunk)
+
+    def _publish_tee(self):
+        with self._lock:
+            self._tee.close()
+            os.replace(self._part_path, self.tee_path)
+            self._tee = self._part_path = None
+
+    def _discard_tee(self):
+        with self._lock:
+            if self._tee is not None:
+                self._tee.close()
+                self._tee = None
+            if self._part_path:
+                try:
+                    os.remove(self._part_path)
+                except FileNotFoundError:
+                    pass
+                self._part_path = None
+
+    async def aiter_chunks(self) -> AsyncIterator[bytes]:
+        """Yield the response chunks, hashing and teeing each one first"""
+        if self.tee_path:
+            await self._run(self._open_tee)
+        async for chunk in self.response.aiter_bytes(self.chunk_size):
+            await self._run(self._consume, chunk)
+            self.size += len(chunk)
+            yield chunk
+        if self.tee_path:
+            await self._run(self._publish_tee)
+        self.completed = True
+
+    async def aclose(self):
+        """Close the response and drop an unfinished tee file"""
+        try:
+            await self.response.aclose()
+        finally:
+            await self._run(self._discard_tee)
+
+    async def __aenter__(self) -> "MediaStream":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+async def upload(client: httpx.AsyncClient, url: str, fields: dict, file_field: str, filename: str,
+                 stream: MediaStream) -> httpx.Response:
+    """
+    POST a stream as a multipart/form-data file while it is still downloading
+
+    The body has an exact Content-Length instead of chunked transfer
+    encoding, so the stream needs a known length.
+    """
+    if stream.length is None:
+        raise IOError(f"Length of {filename} is unknown")
+
+    boundary = os.urandom(16).hex()
+    head = b''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in fields.items()
+    )
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    head += (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+             f'filename="{filename.replace(chr(34), "")}"\r\nContent-Type: {content_type}\r\n\r\n').encode()
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+
+    async def body():
+        yield head
+        sent = 0
+        async for chunk in stream.aiter_chunks():
+            sent += len(chunk)
+            if sent > stream.length:
+                raise IOError(f"{filename} is longer than its Content-Length")
+            yield chunk
+        if sent != stream.length:
+            raise IOError(f"Got {sent} of {stream.length} bytes of {filename}")
+        yield tail
+
+    return await client.post(url, content=body(), headers={
+        'Content-Type': f'multipart/form-data; boundary={boundary}',
+        'Content-Length': str(len(head) + stream.length + len(tail)),
+    })
@@ -0,0 +1,69 @@
+import time
+import heapq
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class PopularityTracker:
+    def __init__(self, half_life: float = 3600, max_items: int = 10000):
+        """
+        Exponentially decaying request counts per shortcode
+
+        Every request adds 1 to a shortcode's score and scores halve every
+        half_life seconds, so the hottest shortcodes are those requested
+        often and recently. Scores are decayed lazily when read or updated.
+        When more than max_items shortcodes are tracked, the coldest are dropped.
+
+        Args:
+            half_life: seconds after which a request counts half
+            max_items: maximum number of tracked shortcodes
+        """
+        self.half_life = half_life
+        self.max_items = max_items
+        # shortcode -> (score, time of the score)
+        self._scores: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def _decayed(self, score: float, at: float, now: float) -> float:
+        return score * 0.5 ** ((now - at) / self.half_life)
+
+    def record(self, shortcode: str, weight: float = 1.0, at: Optional[float] = None):
+        """Count a request, made now or at the wall-clock time `at`"""
+        now = time.time()
+        at = min(at or now, now)
+        with self._lock:
+            score, scored_at = self._scores.get(shortcode, (0.0, now))
+            self._scores[shortcode] = (
+                self._decayed(score, scored_at, now) + self._decayed(weight, at, now), now
+            )
+            if len(self._scores) > self.max_items:
+                self._trim(now)
+
+    def _trim(self, now: float):
+        """Keep the hottest 90% of max_items, so trimming is not needed on every record"""
+        keep = heapq.nlargest(int(self.max_items * 0.9), self._scores.items(),
+                              key=lambda item: self._decayed(item[1][0], item[1][1], now))
+        self._scores = dict(keep)
+
+    def score(self, shortcode: str) -> float:
+        with self._lock:
+            entry = self._scores.get(shortcode)
+        return self._decayed(entry[0], entry[1], time.time()) if entry else 0.0
+
+    def hottest(self, limit: int, min_score: float = 0.0) -> List[Tuple[str, float]]:
+        """
+        The highest-scoring shortcodes
+
+        Returns:
+            up to `limit` (shortcode, score) pairs with score >= min_score, hottest first
+        """
+        now = time.time()
+        with self._lock:
+            scores = [(shortcode, self._decayed(score, at, now)) for shortcode, (score, at) in self._scores.items()]
+        return [item for item in heapq.nlargest(limit, scores, key=lambda item: item[1]) if item[1] >= min_score]
+
+    def __len__(self) -> int:
+        return len(self._scores)
@@ -0,0 +1,426 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Optional, List, Tuple
+
+from blob_store import BlobStore
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = "index.sqlite3"
+BLOBS_DIRNAME = ".blobs"
+
+
+def file_checksum(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Return the SHA-256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PostCache:
+    def __init__(self, download_path: str = "downloads"):
+        """
+        On-disk index of downloaded posts keyed by shortcode
+
+        Stores post metadata together with the path, size and checksum of
+        every downloaded file, so a repeat request is a single indexed lookup.
+        File contents are deduplicated in a blob store; the index counts the
+        posts on disk that reference each blob, and blobs are only deleted
+        once nothing references them.
+        """
+        self.download_path = download_path
+        os.makedirs(download_path, exist_ok=True)
+        self.index_path = os.path.join(download_path, INDEX_FILENAME)
+        self.blobs = BlobStore(os.path.join(download_path, BLOBS_DIRNAME))
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.index_path, check_same_thread=False, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock, self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS posts (
+                    shortcode TEXT PRIMARY KEY,
+                    metadata TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    post_date TEXT,
+                    total_size INTEGER NOT NULL DEFAULT 0,
+                    last_access REAL,
+                    access_count INTEGER NOT NULL DEFAULT 0,
+                    evicted INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS files (
+                    shortcode TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    telegram_file_id TEXT,
+                    telegram_kind TEXT,
+                    PRIMARY KEY (shortcode, path)
+                );
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    refcount INTEGER NOT NULL DEFAULT 0,
+                    variant_size INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS user_posts (
+                    user_id INTEGER NOT NULL,
+                    shortcode TEXT NOT NULL,
+                    requested_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, shortcode)
+                );
+            """)
+            # Indexes created by older versions lack these columns
+            self._add_column('files', 'telegram_file_id', 'TEXT')
+            self._add_column('files', 'telegram_kind', 'TEXT')
+            if self._add_column('posts', 'post_date', 'TEXT'):
+                self._conn.execute("UPDATE posts SET post_date = json_extract(metadata, '$.date')")
+            if self._add_column('posts', 'total_size', 'INTEGER NOT NULL DEFAULT 0'):
+                self._conn.execute(
+                    "UPDATE posts SET total_size = "
+                    "(SELECT COALESCE(SUM(size), 0) FROM files WHERE files.shortcode = posts.shortcode)"
+                )
+            if self._add_column('posts', 'last_access', 'REAL'):
+                self._conn.execute("UPDATE posts SET last_access = created_at")
+            self._add_column('posts', 'access_count', 'INTEGER NOT NULL DEFAULT 0')
+            self._add_column('posts', 'evicted', 'INTEGER NOT NULL DEFAULT 0')
+            if not self._conn.execute("SELECT 1 FROM blobs LIMIT 1").fetchone():
+                # Files indexed before the blob store count as one blob per distinct content
+                self._conn.execute(
+                    "INSERT INTO blobs (sha256, size, refcount) "
+                    "SELECT f.sha256, MAX(f.size), COUNT(*) FROM files f JOIN posts p ON p.shortcode = f.shortcode "
+                    "WHERE p.evicted = 0 GROUP BY f.sha256"
+                )
+            if self._add_column('blobs', 'variant_size', 'INTEGER NOT NULL DEFAULT 0'):
+                # Variants created before they were counted
+                for row in self._conn.execute("SELECT sha256 FROM blobs").fetchall():
+                    size = self.blobs.variant_size(row['sha256'])
+                    if size:
+                        self._conn.execute("UPDATE blobs SET variant_size = ? WHERE sha256 = ?", (size, row['sha256']))
+            self._conn.execute("CREATE INDEX IF NOT EXISTS files_by_sha256 ON files (sha256)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS blobs_by_refcount ON blobs (refcount)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS posts_by_date ON posts (post_date)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS posts_by_access ON posts (evicted, last_access)")
+
+    def _add_column(self, table: str, column: str, declaration: str) -> bool:
+        """Add a column if the table lacks it, returns True if it was added"""
+        columns = {row['name'] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+        if column in columns:
+            return False
+        self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        return True
+
+    def put_post(self, post_info: dict, file_paths: List[str],
+                 hashed: Optional[List[Tuple[str, int, str]]] = None, on_disk: bool = True):
+        """
+        Store post metadata and its files, replacing any previous entry
+
+        Args:
+            post_info: post metadata
+            file_paths: media files of the post
+            hashed: precomputed (path, size, sha256) per file, e.g. from a stream
+            on_disk: False if the media was never kept locally
+        """
+        shortcode = post_info['shortcode']
+        metadata = {k: v for k, v in post_info.items() if k != 'file_paths'}
+
+        # Hash outside the lock, this is the expensive part
+        if hashed is None:
+            hashed = [(file_path, os.path.getsize(file_path), file_checksum(file_path)) for file_path in file_paths]
+
+        # Replace duplicate copies with links to the stored blob
+        if on_disk:
+            for file_path, _, sha256 in hashed:
+                self.blobs.link(file_path, sha256)
+
+        with self._lock, self._conn:
+            self._release_blobs(shortcode)
+            # Keep Telegram file_ids of files whose content did not change
+            known_ids = {
+                row['sha256']: (row['telegram_file_id'], row['telegram_kind'])
+                for row in self._conn.execute(
+                    "SELECT sha256, telegram_file_id, telegram_kind FROM files "
+                    "WHERE shortcode = ? AND telegram_file_id IS NOT NULL", (shortcode,)
+                )
+            }
+            file_rows = [
+                (shortcode, file_path, size, sha256, position, *known_ids.get(sha256, (None, None)))
+                for position, (file_path, size, sha256) in enumerate(hashed)
+            ]
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO posts "
+                "(shortcode, metadata, created_at, post_date, total_size, last_access, access_count, evicted) "
+                "VALUES (?, ?, ?, ?, ?, ?, 1, ?)",
+                (shortcode, json.dumps(metadata, ensure_ascii=False), now, metadata.get('date'),
+                 sum(size for _, size, _ in hashed), now, 0 if on_disk else 1)
+            )
+            self._conn.execute("DELETE FROM files WHERE shortcode = ?", (shortcode,))
+            self._conn.executemany(
+                "INSERT INTO files (shortcode, path, size, sha256, position, telegram_file_id, telegram_kind) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                file_rows
+            )
+            if on_disk:
+                self._reference_blobs(shortcode)
+        logger.info(f"Indexed post {shortcode} with {len(file_rows)} files")
+
+    def _reference_blobs(self, shortcode: str):
+        """Count a post's files as references to their blobs"""
+        # "AND true" keeps SQLite from parsing ON CONFLICT as a join constraint
+        self._conn.execute(
+            "INSERT INTO blobs (sha256, size, refcount) "
+            "SELECT sha256, size, 1 FROM files WHERE shortcode = ? AND true "
+            "ON CONFLICT (sha256) DO UPDATE SET refcount = refcount + 1",
+            (shortcode,)
+        )
+
+    def _release_blobs(self, shortcode: str):
+        """Drop a post's references to its blobs if its media is on disk"""
+        row = self._conn.execute("SELECT evicted FROM posts WHERE shortcode = ?", (shortcode,)).fetchone()
+        if row is None or row['evicted']:
+            return
+        self._conn.execute(
+            "UPDATE blobs SET refcount = refcount - "
+            "(SELECT COUNT(*) FROM files WHERE shortcode = ? AND files.sha256 = blobs.sha256) "
+            "WHERE sha256 IN (SELECT sha256 FROM files WHERE shortcode = ?)",
+            (shortcode, shortcode)
+        )
+
+    def get_post(self, shortcode: str) -> Optional[dict]:
+        """
+        Look up a post by shortcode
+
+        Returns:
+            post metadata with a 'files' list of
+            {path, size, sha256, telegram_file_id, telegram_kind}
+            and an 'evicted' flag, or None
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT metadata, evicted FROM posts WHERE shortcode = ?", (shortcode,)
+            ).fetchone()
+            if row is None:
+                return None
+            files = self._conn.execute(
+                "SELECT path, size, sha256, telegram_file_id, telegram_kind FROM files "
+                "WHERE shortcode = ? ORDER BY position", (shortcode,)
+            ).fetchall()
+
+        post_info = json.loads(row['metadata'])
+        post_info['files'] = [dict(f) for f in files]
+        post_info['evicted'] = bool(row['evicted'])
+        return post_info
+
+    def file_sha256(self, file_path: str) -> Optional[str]:
+        """
+        Content hash of an indexed file, or None if the path is not indexed
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT sha256 FROM files WHERE path = ? LIMIT 1", (file_path,)).fetchone()
+        return row['sha256'] if row else None
+
+    def touch(self, shortcode: str):
+        """
+        Record a cache hit for LRU/LFU eviction
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE posts SET last_access = ?, access_count = access_count + 1 WHERE shortcode = ?",
+                (time.time(), shortcode)
+            )
+
+    def storage_usage(self) -> int:
+        """
+        Total bytes of media currently kept on disk, each blob and its variants counted once
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT COALESCE(SUM(size + variant_size), 0) FROM blobs").fetchone()
+        return row[0]
+
+    def eviction_candidates(self, policy: str = "lru", accessed_before: Optional[float] = None,
+                            limit: int = 50) -> List[dict]:
+        """
+        Posts with media on disk in eviction order
+
+        Args:
+            policy: 'lru' (least recently used first) or 'lfu' (least frequently used first)
+            accessed_before: skip posts accessed after this timestamp
+            limit: maximum number of candidates
+
+        Returns:
+            list of {shortcode, total_size, paths}
+        """
+        order = "access_count ASC, last_access ASC" if policy == "lfu" else "last_access ASC"
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT shortcode, total_size FROM posts WHERE evicted = 0 AND last_access < ? "
+                f"ORDER BY {order} LIMIT ?",
+                (accessed_before if accessed_before is not None else time.time(), limit)
+            ).fetchall()
+            candidates = []
+            for row in rows:
+                paths = [f['path'] for f in self._conn.execute(
+                    "SELECT path FROM files WHERE shortcode = ?", (row['shortcode'],)
+                )]
+                candidates.append({'shortcode': row['shortcode'], 'total_size': row['total_size'], 'paths': paths})
+        return candidates
+
+    def mark_evicted(self, shortcode: str):
+        """
+        Flag a post whose media was deleted; metadata and file_ids are kept
+        """
+        with self._lock, self._conn:
+            self._release_blobs(shortcode)
+            self._conn.execute("UPDATE posts SET evicted = 1 WHERE shortcode = ?", (shortcode,))
+
+    def mark_restored(self, shortcode: str):
+        """
+        Flag an evicted post whose files were relinked from blobs kept by other posts
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT evicted FROM posts WHERE shortcode = ?", (shortcode,)).fetchone()
+            if row is None or not row['evicted']:
+                return
+            self._conn.execute("UPDATE posts SET evicted = 0 WHERE shortcode = ?", (shortcode,))
+            self._reference_blobs(shortcode)
+
+    def pop_orphaned_blobs(self) -> List[Tuple[str, int]]:
+        """
+        Remove blobs no post on disk references from the index
+
+        Returns:
+            (sha256, size) of each removed blob, whose file and variants the caller deletes
+        """
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "DELETE FROM blobs WHERE refcount <= 0 RETURNING sha256, size + variant_size AS size"
+            ).fetchall()
+        return [(row['sha256'], row['size']) for row in rows]
+
+    def set_variant_size(self, sha256: str, size: int):
+        """Record the bytes of the files derived from a blob"""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE blobs SET variant_size = ? WHERE sha256 = ?", (size, sha256))
+
+    def set_file_id(self, shortcode: str, file_path: str, file_id: Optional[str], kind: Optional[str] = None):
+        """
+        Record (or clear, with file_id=None) the Telegram file_id of a sent file
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE files SET telegram_file_id = ?, telegram_kind = ? WHERE shortcode = ? AND path = ?",
+                (file_id, kind if file_id else None, shortcode, file_path)
+            )
+
+    def record_request(self, user_id: int, shortcode: str):
+        """
+        Remember that a user received a post, for per-user listings
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO user_posts (user_id, shortcode, requested_at) VALUES (?, ?, ?)",
+                (user_id, shortcode, time.time())
+            )
+
+    def recent_requests(self, since: float) -> List[Tuple[str, float]]:
+        """
+        Requests made after `since`, oldest first
+
+        Returns:
+            list of (shortcode, requested_at), one per user and post
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT shortcode, requested_at FROM user_posts WHERE requested_at > ? ORDER BY requested_at",
+                (since,)
+            ).fetchall()
+        return [(row['shortcode'], row['requested_at']) for row in rows]
+
+    def count_posts(self, user_id: Optional[int] = None) -> int:
+        """
+        Count indexed posts, optionally only those a user received
+        """
+        with self._lock:
+            if user_id is None:
+                row = self._conn.execute("SELECT COUNT(*) FROM posts").fetchone()
+            else:
+                row = self._conn.execute(
+                    "SELECT COUNT(*) FROM user_posts WHERE user_id = ?", (user_id,)
+                ).fetchone()
+        return row[0]
+
+    def list_posts(self, user_id: Optional[int] = None, offset: int = 0, limit: int = 10) -> List[dict]:
+        """
+        List indexed posts newest first, optionally only those a user received
+
+        Returns:
+            list of {shortcode, username, date, is_video, file_count}
+        """
+        query = """
+            SELECT p.shortcode, p.metadata,
+                   (SELECT COUNT(*) FROM files f WHERE f.shortcode = p.shortcode) AS file_count
+            FROM posts p
+        """
+        params: list = []
+        if user_id is not None:
+            query += " JOIN user_posts u ON u.shortcode = p.shortcode WHERE u.user_id = ?"
+            params.append(user_id)
+        query += " ORDER BY p.post_date DESC LIMIT ? OFFSET ?"
+        params += [limit, offset]
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+
+        posts = []
+        for row in rows:
+            metadata = json.loads(row['metadata'])
+            posts.append({
+                'shortcode': row['shortcode'],
+                'username': metadata.get('username', 'Unknown'),
+                'date': metadata.get('date', 'Unknown'),
+                'is_video': metadata.get('is_video', False),
+                'file_count': row['file_count']
+            })
+        return posts
+
+    def import_legacy_metadata(self, shortcode: str) -> Optional[dict]:
+        """
+        Import a pre-index `<shortcode>_metadata.json` file if one exists
+        """
+        candidates = [
+            os.path.join(self.download_path, shortcode, f"{shortcode}_metadata.json"),
+            os.path.join(self.download_path, f"{shortcode}_metadata.json"),
+        ]
+        for metadata_path in candidates:
+            if not os.path.exists(metadata_path):
+                continue
+            try:
+                with open(metadata_path, 'r', encoding='utf-8') as f:
+                    post_info = json.load(f)
+                file_paths = [p for p in post_info.get('file_paths', []) if os.path.exists(p)]
+                if not file_paths:
+                    continue
+                self.put_post(post_info, file_paths)
+                logger.info(f"Imported legacy metadata: {metadata_path}")
+                return self.get_post(shortcode)
+            except Exception as e:
+                logger.error(f"Error importing legacy metadata {metadata_path}: {e}")
+        return None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,73 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import instaloader
+
+logger = logging.getLogger(__name__)
+
+
+class PostResolver:
+    def __init__(self, loader_pool, ttl: float = 300, max_entries: int = 1000):
+        """
+        Resolve shortcodes to Instaloader posts with a short-TTL in-memory cache
+
+        A resolved Post is reused for the info preview, the media download and
+        metadata persistence, so each link costs one GraphQL fetch.
+
+        Args:
+            loader_pool: LoaderPool whose loaders are leased for fetching
+            ttl: seconds a resolved post stays cached
+            max_entries: maximum number of cached posts
+        """
+        self.loader_pool = loader_pool
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._posts: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, shortcode: str) -> instaloader.Post:
+        """
+        Get the post for a shortcode, fetching it only on a cache miss
+        """
+        post = self.get_cached(shortcode)
+        if post is not None:
+            logger.info(f"Post cache hit: {shortcode}")
+            return post
+
+        with self.loader_pool.lease() as loader:
+            post = instaloader.Post.from_shortcode(loader.context, shortcode)
+        self.prime(post)
+        return post
+
+    def prime(self, post: instaloader.Post):
+        """
+        Cache a post obtained elsewhere, e.g. from a profile listing
+        """
+        with self._lock:
+            self._posts[post.shortcode] = (time.monotonic() + self.ttl, post)
+            self._posts.move_to_end(post.shortcode)
+            while len(self._posts) > self.max_entries:
+                self._posts.popitem(last=False)
+
+    def get_cached(self, shortcode: str) -> Optional[instaloader.Post]:
+        """
+        Get a cached post if it has not expired
+        """
+        with self._lock:
+            entry = self._posts.get(shortcode)
+            if entry is None:
+                return None
+            expires_at, post = entry
+            if expires_at < time.monotonic():
+                del self._posts[shortcode]
+                return None
+            self._posts.move_to_end(shortcode)
+            return post
+
+    def invalidate(self, shortcode: str):
+        """Drop a post from the cache"""
+        with self._lock:
+            self._posts.pop(shortcode, None)
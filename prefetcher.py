@@ -0,0 +1,117 @@
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from metrics import PREFETCHES, STAGE_SECONDS
+from popularity import PopularityTracker
+from post_cache import PostCache
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    def __init__(self, tracker: PopularityTracker, cache: PostCache,
+                 warm: Callable[[str], Awaitable[bool]], is_idle: Callable[[], bool],
+                 interval: float = 60, top: int = 20, min_score: float = 3.0,
+                 retry_after: float = 3600):
+        """
+        Warm the cache for trending posts while Instagram is idle
+
+        Every interval seconds the hottest shortcodes of the tracker are
+        checked against the post index. A post that cannot be answered
+        instantly - never downloaded, or evicted without a Telegram file_id
+        for every file - is handed to warm(), one at a time and only while
+        is_idle() says no user download is waiting for Instagram. Posts that
+        fail to warm are not retried for retry_after seconds.
+
+        Args:
+            tracker: request popularity of shortcodes
+            cache: post index
+            warm: coroutine function downloading (and uploading) a shortcode, True on success
+            is_idle: whether the Instagram request budget is unused
+            interval: seconds between rounds
+            top: hottest shortcodes considered per round
+            min_score: minimum popularity score worth warming
+            retry_after: seconds before a failed shortcode is tried again
+        """
+        self.tracker = tracker
+        self.cache = cache
+        self.warm = warm
+        self.is_idle = is_idle
+        self.interval = interval
+        self.top = top
+        self.min_score = min_score
+        self.retry_after = retry_after
+
+        self._failed: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def needs_warming(self, shortcode: str) -> bool:
+        """Whether a request for the post would have to wait for Instagram"""
+        post = self.cache.get_post(shortcode)
+        if post is None or not post['files']:
+            return True
+        return any(not f['telegram_file_id'] and not self.cache.blobs.has(f['sha256']) for f in post['files'])
+
+    def candidates(self) -> List[str]:
+        """Hottest shortcodes that need warming, hottest first"""
+        now = time.monotonic()
+        self._failed = {sc: until for sc, until in self._failed.items() if until > now}
+        return [
+            shortcode for shortcode, _ in self.tracker.hottest(self.top, self.min_score)
+            if shortcode not in self._failed and self.needs_warming(shortcode)
+        ]
+
+    async def run_once(self) -> int:
+        """
+        Run one prefetch round
+
+        Returns:
+            number of posts warmed
+        """
+        warmed = 0
+        for shortcode in await asyncio.to_thread(self.candidates):
+            if not self.is_idle():
+                PREFETCHES.labels('busy').inc()
+                logger.debug("Instagram is busy, prefetch round stopped")
+                break
+            try:
+                with STAGE_SECONDS.labels('prefetch').time():
+                    success = await self.warm(shortcode)
+            except Exception as e:
+                logger.warning(f"Prefetch of {shortcode} failed: {e}")
+                success = False
+            if success:
+                warmed += 1
+                PREFETCHES.labels('ok').inc()
+                logger.info(f"Prefetched trending post {shortcode} (score {self.tracker.score(shortcode):.1f})")
+            else:
+                PREFETCHES.labels('failed').inc()
+                self._failed[shortcode] = time.monotonic() + self.retry_after
+        return warmed
+
+    def start(self):
+        """Start the background prefetch task on the running event loop"""
+        if self._task is not None:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logger.info(f"Prefetcher started: top {self.top} posts every {self.interval:g}s")
+
+    async def stop(self):
+        """Stop the background prefetch task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Error during prefetch: {e}")
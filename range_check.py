@@ -0,0 +1,311 @@
+"""
+Offline check of the ranged media download
+
+Serves a random file from a local range-capable server and runs
+RangeFetcher against it with thresholds small enough that the ranged
+path is taken: a parallel fetch, fallbacks to a linear read, dropped
+connections, resuming a failed attempt from its .part file and .json
+sidecar with a freshly signed URL, a file that changed between attempts
+or during one (If-Range) and two jobs fetching the same media at once.
+Exits with 1 if any scenario fails.
+
+    python range_check.py
+    python range_check.py --size-mb 20 --chunk-kb 1024 --connections 8
+"""
+import os
+import re
+import sys
+import json
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from instaloader.exceptions import ConnectionException
+
+from range_fetcher import RangeFetcher
+
+MEDIA_PATH = '/v/t51.2885-15/check.mp4'
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves `data` with Range, If-Range and ETag support, optionally dropping connections"""
+    protocol_version = 'HTTP/1.1'
+    data = b''
+    etag = '"v1"'
+    accept_ranges = True
+    drop_rate = 0.0
+    requests = 0
+    ranges = 0
+    _lock = threading.Lock()
+    _random = random.Random(0)
+
+    def do_GET(self):
+        size = len(self.data)
+        start, end = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if_range = self.headers.get('If-Range')
+        ranged = bool(match) and self.accept_ranges and (if_range is None or if_range == self.etag)
+        if ranged:
+            start, end = int(match[1]), min(int(match[2] or size - 1), size - 1)
+        body = self.data[start:end + 1]
+
+        with self._lock:
+            RangeHandler.requests += 1
+            RangeHandler.ranges += ranged
+            drop = self._random.random() < self.drop_rate
+        self.send_response(206 if ranged else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.etag)
+        if self.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if ranged:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if drop:
+            # Send part of the body and close, like a CDN connection reset
+            body = body[:len(body) // 3]
+            self.close_connection = True
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            # RangeFetcher closes the first response once it has its first range
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-request are part of the scenarios
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class Check:
+    def __init__(self, url: str, workdir: str, args: argparse.Namespace):
+        self.url = url
+        self.workdir = workdir
+        self.partial_dir = os.path.join(workdir, '.partial')
+        self.session = requests.Session()
+        self.args = args
+        self.failures = []
+
+    def fetcher(self, **overrides) -> RangeFetcher:
+        options = dict(min_bytes=self.args.chunk_kb * 1024, chunk_bytes=self.args.chunk_kb * 1024,
+                       connections=self.args.connections, retries=3, timeout=30)
+        options.update(overrides)
+        return RangeFetcher(self.session, **options)
+
+    def open(self, signature: str = 'sig1') -> requests.Response:
+        """Open the media like Instaloader does, with a signed query string"""
+        resp = self.session.get(f"{self.url}?oh={signature}", stream=True, timeout=30)
+        resp.raw.decode_content = True
+        return resp
+
+    def fetch(self, name: str, fetcher: RangeFetcher = None, signature: str = 'sig1') -> str:
+        path = os.path.join(self.workdir, name)
+        resp = self.open(signature)
+        try:
+            ranged = (fetcher or self.fetcher()).fetch(resp, path, self.partial_dir)
+        finally:
+            resp.close()
+        return path if ranged else None
+
+    def matches(self, path: str) -> bool:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).digest() == hashlib.sha256(RangeHandler.data).digest()
+
+    def reset(self, **handler):
+        RangeHandler.requests = RangeHandler.ranges = 0
+        RangeHandler.etag = '"v1"'
+        RangeHandler.accept_ranges = True
+        RangeHandler.drop_rate = 0.0
+        for key, value in handler.items():
+            setattr(RangeHandler, key, value)
+
+    def run(self, name: str, scenario):
+        try:
+            detail = scenario()
+        except Exception as e:
+            detail = f"{type(e).__name__}: {e}"
+            self.failures.append(name)
+            print(f"FAIL  {name}: {detail}")
+            return
+        print(f"ok    {name}: {detail}")
+
+    def expect(self, condition: bool, message: str):
+        if not condition:
+            raise AssertionError(message)
+
+    # Scenarios
+
+    def parallel(self):
+        self.reset()
+        path = self.fetch('parallel.mp4')
+        self.expect(path is not None, "file was read linearly")
+        self.expect(self.matches(path), "content differs")
+        self.expect(RangeHandler.requests > 1, "no range requests were made")
+        # Lock files stay for the next job and are pruned with old partials
+        leftovers = [name for name in os.listdir(self.partial_dir) if not name.endswith('.lock')]
+        self.expect(not leftovers, f"leftovers {leftovers}")
+        return f"{RangeHandler.requests} requests"
+
+    def small_file(self):
+        self.reset()
+        path = self.fetch('small.mp4', self.fetcher(min_bytes=len(RangeHandler.data) + 1))
+        self.expect(path is None, "file under min_bytes was fetched in ranges")
+        return "read linearly"
+
+    def no_ranges(self):
+        self.reset(accept_ranges=False)
+        path = self.fetch('no-ranges.mp4')
+        self.expect(path is None, "server without Accept-Ranges was fetched in ranges")
+        return "read linearly"
+
+    def dropped_connections(self):
+        self.reset(drop_rate=0.3)
+        path = self.fetch('dropped.mp4', self.fetcher(retries=10))
+        self.expect(self.matches(path), "content differs")
+        return f"{RangeHandler.requests} requests for {self.chunks()} ranges"
+
+    def resume(self):
+        # Every connection drops and nothing is retried, so the attempt fails part way
+        self.reset(drop_rate=0.5)
+        RangeHandler._random.seed(3)
+        try:
+            self.fetch('resume.mp4', self.fetcher(retries=0))
+        except ConnectionException:
+            pass
+        else:
+            raise AssertionError("first attempt did not fail")
+        state = self.state()
+        self.expect(state and state['done'], "no finished ranges were recorded")
+        done = len(state['done'])
+
+        self.reset()
+        path = self.fetch('resume.mp4', signature='sig2')
+        self.expect(self.matches(path), "content differs")
+        # The first range comes from the opened response, the others from range requests
+        self.expect(RangeHandler.ranges < self.chunks() - 1, "finished ranges were fetched again")
+        self.expect(self.state() is None, "sidecar was not removed")
+        return f"{done} of {self.chunks()} ranges kept, {RangeHandler.ranges} range requests"
+
+    def changed_file(self):
+        # A failed attempt leaves ranges of version 1 behind
+        self.reset(drop_rate=0.5)
+        RangeHandler._random.seed(3)
+        try:
+            self.fetch('changed.mp4', self.fetcher(retries=0))
+        except ConnectionException:
+            pass
+        self.expect(self.state() is not None, "no sidecar was left")
+
+        # The file changes, so the old ranges must not be mixed in
+        old_data = RangeHandler.data
+        RangeHandler.data = bytes(reversed(old_data))
+        try:
+            self.reset(etag='"v2"')
+            path = self.fetch('changed.mp4', signature='sig2')
+            self.expect(self.matches(path), "content mixes both versions")
+            self.expect(RangeHandler.ranges >= self.chunks() - 1, "ranges of the old version were kept")
+        finally:
+            RangeHandler.data = old_data
+        return "old ranges discarded"
+
+    def changed_mid_fetch(self):
+        self.reset()
+        path = os.path.join(self.workdir, 'mid-fetch.mp4')
+        resp = self.open()
+        # The file changes after the first response was opened
+        RangeHandler.etag = '"v2"'
+        try:
+            self.fetcher().fetch(resp, path, self.partial_dir)
+        except ConnectionException as e:
+            self.expect(not os.path.exists(path), "a mixed file was written")
+            return f"ranges of the new version refused ({type(e).__name__})"
+        finally:
+            resp.close()
+        raise AssertionError("ranges of the new version were accepted")
+
+    def contention(self):
+        self.reset()
+        fetcher = self.fetcher()
+        key = hashlib.sha256(MEDIA_PATH.encode()).hexdigest()[:32]
+        os.makedirs(self.partial_dir, exist_ok=True)
+        lock = fetcher._lock_partial(os.path.join(self.partial_dir, key + '.lock'))
+        self.expect(lock is not None, "could not take the lock")
+        try:
+            path = self.fetch('contention.mp4', fetcher)
+        finally:
+            fetcher._unlock_partial(lock)
+        self.expect(self.matches(path), "content differs")
+        self.expect(not os.path.exists(path + '.part'), "private .part file was left")
+        return "fetched into a private .part file"
+
+    def corrupt_state(self):
+        self.reset()
+        key = hashlib.sha256(MEDIA_PATH.encode()).hexdigest()[:32]
+        os.makedirs(self.partial_dir, exist_ok=True)
+        with open(os.path.join(self.partial_dir, key + '.part'), 'wb') as f:
+            f.write(b'\0' * len(RangeHandler.data))
+        with open(os.path.join(self.partial_dir, key + '.json'), 'w', encoding='utf-8') as f:
+            f.write('{"size": ')
+        path = self.fetch('corrupt.mp4')
+        self.expect(self.matches(path), "content differs")
+        return "unreadable sidecar ignored"
+
+    def chunks(self) -> int:
+        chunk_bytes = self.args.chunk_kb * 1024
+        return (len(RangeHandler.data) + chunk_bytes - 1) // chunk_bytes
+
+    def state(self):
+        states = [name for name in os.listdir(self.partial_dir) if name.endswith('.json')]
+        if not states:
+            return None
+        with open(os.path.join(self.partial_dir, states[0]), encoding='utf-8') as f:
+            return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check ranged, resumable media downloads against a local server")
+    parser.add_argument('--size-mb', type=float, default=5, help="size of the served file")
+    parser.add_argument('--chunk-kb', type=int, default=512, help="range size, also the ranged-path threshold")
+    parser.add_argument('--connections', type=int, default=4, help="ranges fetched at once")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # An odd size, so the last range is shorter than the others
+    RangeHandler.data = random.Random(args.seed).randbytes(int(args.size_mb * 1024 * 1024) + 123)
+    server = RangeServer(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory(prefix="insta-range-") as workdir:
+        check = Check(f"http://127.0.0.1:{server.server_address[1]}{MEDIA_PATH}", workdir, args)
+        for name, scenario in [
+            ('parallel', check.parallel),
+            ('small file', check.small_file),
+            ('no ranges', check.no_ranges),
+            ('dropped connections', check.dropped_connections),
+            ('resume', check.resume),
+            ('changed file', check.changed_file),
+            ('changed mid-fetch', check.changed_mid_fetch),
+            ('contention', check.contention),
+            ('corrupt sidecar', check.corrupt_state),
+        ]:
+            check.run(name, scenario)
+    server.shutdown()
+
+    if check.failures:
+        print(f"FAIL: {', '.join(check.failures)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Set
+from urllib.parse import urlparse
+
+import requests
+from instaloader.exceptions import ConnectionException
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+
+# Partial files in use by this process, where fcntl locks are unavailable
+_active_partials: Set[str] = set()
+_active_lock = threading.Lock()
+
+
+class RangeFetcher:
+    def __init__(self, session: requests.Session, min_bytes: int = 8 * 1024 * 1024,
+                 chunk_bytes: int = 4 * 1024 * 1024, connections: int = 4, retries: int = 3,
+                 timeout: float = 300, partial_ttl: float = 86400):
+        """
+        Download large media files as parallel, resumable HTTP Range requests
+
+        Args:
+            session: pooled HTTP session for the range requests
+            min_bytes: smallest file fetched in ranges
+            chunk_bytes: size of each range
+            connections: ranges fetched at once per file
+            retries: extra attempts per range after a dropped connection
+            timeout: connect and read timeout of each request in seconds
+            partial_ttl: seconds after which unfinished files are deleted
+        """
+        self.session = session
+        self.min_bytes = min_bytes
+        self.chunk_bytes = chunk_bytes
+        self.connections = connections
+        self.retries = retries
+        self.timeout = timeout
+        self.partial_ttl = partial_ttl
+
+    def ranged_size(self, resp: requests.Response) -> Optional[int]:
+        """Size of the response body if it should be fetched in ranges, otherwise None"""
+        if self.min_bytes <= 0 or resp.status_code != 200:
+            return None
+        if resp.headers.get('Accept-Ranges', '').lower() != 'bytes':
+            return None
+        # Lengths of compressed bodies do not match the decoded file
+        if resp.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+            return None
+        length = resp.headers.get('Content-Length', '')
+        if not length.isdigit() or int(length) < self.min_bytes:
+            return None
+        return int(length)
+
+    def fetch(self, resp: requests.Response, filename: str, partial_dir: Optional[str] = None) -> bool:
+        """
+        Write the body of an open GET response to filename using range requests
+
+        Returns:
+            False, without consuming resp, if the file should be read linearly
+
+        Raises:
+            ConnectionException: if a range could not be fetched completely
+        """
+        size = self.ranged_size(resp)
+        if size is None:
+            return False
+
+        lock = None
+        if partial_dir:
+            os.makedirs(partial_dir, exist_ok=True)
+            self._prune(partial_dir)
+            # The query string carries an expiring signature, the path names the file
+            key = hashlib.sha256(urlparse(resp.url).path.encode()).hexdigest()[:32]
+            lock = self._lock_partial(os.path.join(partial_dir, key + '.lock'))
+        if lock is not None:
+            part_path = os.path.join(partial_dir, key + '.part')
+            state_path = os.path.join(partial_dir, key + '.json')
+        else:
+            # Another job is fetching the same media (e.g. a repost) into the shared partial
+            part_path, state_path = filename + '.part', None
+
+        try:
+            return self._fetch(resp, filename, size, part_path, state_path)
+        finally:
+            if lock is not None:
+                self._unlock_partial(lock)
+
+    def _fetch(self, resp: requests.Response, filename: str, size: int, part_path: str,
+               state_path: Optional[str]) -> bool:
+        """Fetch the missing ranges into part_path and move the complete file to filename"""
+        validator = resp.headers.get('ETag') or resp.headers.get('Last-Modified')
+        chunks = [(start, min(start + self.chunk_bytes, size) - 1) for start in range(0, size, self.chunk_bytes)]
+        done = self._load_state(state_path, part_path, size, validator)
+        if not done:
+            with open(part_path, 'wb') as f:
+                f.truncate(size)
+        resumed = sum(end - start + 1 for index, (start, end) in enumerate(chunks) if index in done)
+        started = time.perf_counter()
+
+        lock = threading.Lock()
+        errors = []
+
+        def fetch_range(index: int):
+            try:
+                self._fetch_range(resp.url, part_path, *chunks[index], size, validator)
+            except Exception as e:
+                errors.append(e)
+                return
+            with lock:
+                done.add(index)
+                self._save_state(state_path, size, validator, done)
+
+        with ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix="range") as pool:
+            for index in range(1, len(chunks)):
+                if index not in done:
+                    pool.submit(fetch_range, index)
+            # Meanwhile the first range comes from the response that is already open
+            if 0 not in done:
+                with resp:
+                    first_ok = self._write_first(resp, part_path, chunks[0][1] + 1)
+                if first_ok:
+                    with lock:
+                        done.add(0)
+                        self._save_state(state_path, size, validator, done)
+                else:
+                    pool.submit(fetch_range, 0)
+            else:
+                resp.close()
+        if errors:
+            raise ConnectionException(f"{len(errors)} of {len(chunks)} ranges of {filename} failed: {errors[0]}")
+
+        actual = os.path.getsize(part_path)
+        if actual != size:
+            raise ConnectionException(f"{filename} has {actual} bytes, expected {size}")
+        os.replace(part_path, filename)
+        if state_path and os.path.exists(state_path):
+            os.remove(state_path)
+        logger.info(f"Fetched {filename} in {len(chunks)} ranges ({size} bytes, {resumed} resumed) "
+                    f"in {time.perf_counter() - started:.2f}s")
+        return True
+
+    def _write_first(self, resp: requests.Response, part_path: str, length: int) -> bool:
+        """Write the first range from the already open response, False if it broke off"""
+        written = 0
+        try:
+            with open(part_path, 'r+b') as f:
+                for data in resp.iter_content(chunk_size=READ_SIZE):
+                    data = data[:length - written]
+                    f.write(data)
+                    written += len(data)
+                    if written >= length:
+                        return True
+        except (requests.RequestException, OSError) as e:
+            logger.debug(f"First range of {part_path} broke off after {written} bytes: {e}")
+        return False
+
+    def _fetch_range(self, url: str, part_path: str, start: int, end: int, size: int, validator: Optional[str]):
+        """Fetch bytes start..end into the .part file, continuing after dropped connections"""
+        offset = start
+        error = None
+        for _ in range(self.retries + 1):
+            headers = {'Range': f'bytes={offset}-{end}'}
+            if validator:
+                # A changed file is sent whole with 200 instead of a mismatched range
+                headers['If-Range'] = validator
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as resp:
+                    if resp.status_code != 206:
+                        raise ConnectionException(f"Range request answered with {resp.status_code}")
+                    match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', resp.headers.get('Content-Range', ''))
+                    if not match or (int(match[1]), int(match[2])) != (offset, end) or match[3] not in (str(size), '*'):
+                        raise ConnectionException(f"Unexpected Content-Range {resp.headers.get('Content-Range')!r}")
+                    with open(part_path, 'r+b') as f:
+                        f.seek(offset)
+                        for data in resp.iter_content(chunk_size=READ_SIZE):
+                            if offset + len(data) > end + 1:
+                                raise ConnectionException(f"Range {start}-{end} is longer than requested")
+                            f.write(data)
+                            offset += len(data)
+                if offset == end + 1:
+                    return
+                error = f"connection closed at byte {offset}"
+            except requests.RequestException as e:
+                error = e
+            logger.debug(f"Range {start}-{end} interrupted ({error}), resuming at {offset}")
+        raise ConnectionException(f"Range {start}-{end} incomplete after {self.retries + 1} attempts: {error}")
+
+    def _load_state(self, state_path: Optional[str], part_path: str, size: int,
+                    validator: Optional[str]) -> Set[int]:
+        """Finished ranges of an earlier attempt at the same file, if it is still valid"""
+        if not state_path or not os.path.exists(state_path) or not os.path.exists(part_path):
+            return set()
+        try:
+            with open(state_path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if (state.get('size'), state.get('validator'), state.get('chunk_bytes')) != (size, validator, self.chunk_bytes):
+            return set()
+        if os.path.getsize(part_path) != size:
+            return set()
+        return set(state.get('done', []))
+
+    def _save_state(self, state_path: Optional[str], size: int, validator: Optional[str], done: Set[int]):
+        if not state_path:
+            return
+        with open(state_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'size': size, 'validator': validator, 'chunk_bytes': self.chunk_bytes,
+                       'done': sorted(done)}, f)
+        os.replace(state_path + '.tmp', state_path)
+
+    def _lock_partial(self, lock_path: str):
+        """Take the lock of a shared partial file, None if another job holds it"""
+        if fcntl is None:
+            with _active_lock:
+                if lock_path in _active_partials:
+                    return None
+                _active_partials.add(lock_path)
+            return lock_path
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT)
+        try:
+            # Released by the OS if the process dies, so crashed downloads stay resumable
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        os.utime(lock_path)
+        return fd
+
+    def _unlock_partial(self, lock):
+        if fcntl is None:
+            with _active_lock:
+                _active_partials.discard(lock)
+        else:
+            os.close(lock)
+
+    def _prune(self, partial_dir: str):
+        """Delete unfinished files nobody resumed within partial_ttl"""
+        cutoff = time.time() - self.partial_ttl
+        for entry in os.listdir(partial_dir):
+            path = os.path.join(partial_dir, entry)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
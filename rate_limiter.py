@@ -0,0 +1,173 @@
+import time
+import heapq
+import random
+import logging
+import threading
+import itertools
+from enum import IntEnum
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Priority of the Instagram requests made by the current thread
+_local = threading.local()
+
+
+class Priority(IntEnum):
+    """Request classes, lower values are served first"""
+    INTERACTIVE = 0  # cache misses for a waiting user
+    PREFETCH = 1     # cache warming
+    BACKGROUND = 2   # maintenance work
+
+
+@contextmanager
+def request_priority(priority: Priority):
+    """Run the block's Instagram requests with the given priority"""
+    previous = current_priority()
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def current_priority() -> Priority:
+    """Priority of the Instagram requests made by the current thread"""
+    return getattr(_local, 'priority', Priority.INTERACTIVE)
+
+
+def classify_response(resp) -> Optional[str]:
+    """
+    Classify an Instagram API response for rate limiting and session health
+
+    Returns:
+        'rate_limited', 'login_wall', 'ok', or None for non-API responses
+    """
+    host = resp.url.split('/')[2] if '://' in resp.url else ''
+    if host not in ('www.instagram.com', 'i.instagram.com'):
+        return None
+    if resp.status_code == 429 or (
+            resp.status_code in (400, 401) and 'Please wait a few minutes' in resp.text):
+        return 'rate_limited'
+    if resp.is_redirect and '/accounts/login' in resp.headers.get('location', ''):
+        return 'login_wall'
+    if resp.status_code == 401:
+        return 'login_wall'
+    if resp.status_code == 200:
+        return 'ok'
+    return None
+
+
+def retry_after_seconds(resp) -> Optional[float]:
+    """Parse a numeric Retry-After header"""
+    retry_after = resp.headers.get('Retry-After', '')
+    return float(retry_after) if retry_after.isdigit() else None
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, rate: float = 0.5, burst: int = 5, min_rate: float = 0.02,
+                 backoff_base: float = 5, backoff_max: float = 900):
+        """
+        Token bucket for Instagram requests that adapts to rate limiting
+
+        The refill rate grows additively on success and is cut in half on
+        every 429 / "Please wait a few minutes" response, which also pauses
+        all requests for the server's Retry-After or a jittered exponential
+        backoff. Waiting requests are served strictly by priority.
+
+        Args:
+            rate: starting (and maximum) requests per second
+            burst: bucket size
+            min_rate: lowest rate the limiter backs off to
+            backoff_base: first backoff delay in seconds
+            backoff_max: upper bound of the backoff delay
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._failures = 0
+
+        self._cond = threading.Condition()
+        self._waiters: list = []
+        self._sequence = itertools.count()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority: Optional[Priority] = None):
+        """
+        Block until a request of the given priority may be sent
+        """
+        if priority is None:
+            priority = current_priority()
+
+        with self._cond:
+            ticket = (int(priority), next(self._sequence))
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._waiters[0] == ticket and now >= self._paused_until and self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    if now < self._paused_until:
+                        timeout = self._paused_until - now
+                    elif self._waiters[0] == ticket:
+                        timeout = (1 - self._tokens) / self.rate
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+            finally:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def on_success(self):
+        """Additive increase after a successful request"""
+        with self._cond:
+            self._failures = 0
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def on_rate_limited(self, retry_after: Optional[float] = None) -> float:
+        """
+        Multiplicative decrease and a pause after a rate-limit response
+
+        Returns:
+            the pause in seconds
+        """
+        with self._cond:
+            self._failures += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            delay = retry_after if retry_after is not None else self.backoff_delay(self._failures)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._tokens = 0
+            self._cond.notify_all()
+        logger.warning(f"Instagram rate limit hit, pausing {delay:.1f}s, rate now {self.rate:.3f} req/s")
+        return delay
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter"""
+        return random.uniform(self.backoff_base, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def available_tokens(self) -> float:
+        """Tokens currently in the bucket, 0 while paused"""
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            return 0.0 if now < self._paused_until else self._tokens
+
+    def is_idle(self) -> bool:
+        """True when nobody is waiting and the bucket is nearly full"""
+        with self._cond:
+            return not self._waiters and self.available_tokens() >= self.burst - 1
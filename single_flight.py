@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+def _cancelling() -> bool:
+    """Whether the current task itself has a pending cancellation request"""
+    task = asyncio.current_task()
+    # Task.cancelling() is only available from Python 3.11
+    return task is not None and getattr(task, 'cancelling', lambda: 0)() > 0
+
+
+class SingleFlight:
+    def __init__(self):
+        """
+        Coalesce concurrent calls that share a key
+
+        The first caller for a key runs the work; callers arriving while it is
+        in flight await the same result instead of repeating the work.
+        """
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def in_flight(self, key: Hashable) -> bool:
+        """Check whether work for a key is currently running"""
+        return key in self._calls
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run `fn` for `key`, or join the call already in flight for it
+        """
+        while key in self._calls:
+            future = self._calls[key]
+            logger.info(f"Joining in-flight call for {key}")
+            try:
+                # Shield so one waiter's cancellation does not cancel the shared call
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled() or _cancelling():
+                    raise
+                # Only the leader was cancelled, so run the work again ourselves
+                logger.info(f"In-flight call for {key} was cancelled, retrying")
+
+        future = asyncio.get_running_loop().create_future()
+        # Followers may all be gone; retrieve the exception so it is not logged as lost
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
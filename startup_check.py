@@ -0,0 +1,110 @@
+"""
+Startup time check for the bot
+
+Imports bot.py in fresh interpreters under `python -X importtime`, then
+builds InstagramDownloadBot. Reports the import and construction times
+and the slowest imports. Exits with 1 if the import goes over the budget
+or if a module that should load on first use (Instaloader, requests)
+was imported at startup.
+
+    python startup_check.py
+    python startup_check.py --budget-ms 300 --runs 10
+    python startup_check.py --json startup.json
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import tempfile
+
+# Imported on the first request that needs Instagram, never at startup
+DEFERRED_MODULES = ('instaloader', 'requests', 'loader_pool', 'range_fetcher', 'post_resolver', 'media_stream')
+
+PROBE = """
+import sys, time, json
+import bot
+imported = time.perf_counter()
+bot.InstagramDownloadBot()
+built = time.perf_counter()
+print(json.dumps({
+    'construct_ms': (built - imported) * 1000,
+    'deferred_loaded': [m for m in %r if m in sys.modules],
+}))
+""" % (DEFERRED_MODULES,)
+
+
+def parse_importtime(stderr: str) -> list:
+    """(cumulative microseconds, self microseconds, module) per line of -X importtime output"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        entries.append((int(cumulative_us), int(self_us), module.rstrip()))
+    return entries
+
+
+def measure(repo: str, workdir: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=repo, BOT_TOKEN=os.getenv('BOT_TOKEN', '123456:startup'),
+               METRICS_PORT='0')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE],
+                            cwd=workdir, env=env, capture_output=True, text=True, check=True)
+    entries = parse_importtime(result.stderr)
+    probe = json.loads(result.stdout.strip().splitlines()[-1])
+    bot_entry = next(e for e in entries if e[2].strip() == 'bot')
+    return {
+        'import_ms': bot_entry[0] / 1000,
+        'construct_ms': probe['construct_ms'],
+        'deferred_loaded': probe['deferred_loaded'],
+        'slowest': sorted(entries, reverse=True),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the bot's import time against a budget")
+    parser.add_argument('--budget-ms', type=float, default=float(os.getenv('STARTUP_BUDGET_MS', '350')),
+                        help="maximum time to import bot.py")
+    parser.add_argument('--runs', type=int, default=5, help="fresh interpreters to measure, the fastest counts")
+    parser.add_argument('--top', type=int, default=10, help="slowest imports to list")
+    parser.add_argument('--json', help="write results to this file")
+    args = parser.parse_args()
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory(prefix="insta-startup-") as workdir:
+        # The first run also fills the bytecode cache, like a warm deployment
+        measure(repo, workdir)
+        runs = [measure(repo, workdir) for _ in range(args.runs)]
+
+    best = min(runs, key=lambda run: run['import_ms'])
+    deferred_loaded = sorted({m for run in runs for m in run['deferred_loaded']})
+    results = {
+        'import_ms': best['import_ms'],
+        'construct_ms': min(run['construct_ms'] for run in runs),
+        'budget_ms': args.budget_ms,
+        'deferred_loaded': deferred_loaded,
+    }
+
+    print(f"Import bot:   {results['import_ms']:.0f} ms (budget {args.budget_ms:.0f} ms, best of {args.runs})")
+    print(f"Construct:    {results['construct_ms']:.1f} ms")
+    print("Slowest imports (cumulative / self):")
+    for cumulative_us, self_us, module in best['slowest'][1:args.top + 1]:
+        print(f"  {cumulative_us / 1000:8.1f} ms {self_us / 1000:8.1f} ms  {module.strip()}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    failed = False
+    if deferred_loaded:
+        print(f"FAIL: imported at startup: {', '.join(deferred_loaded)}")
+        failed = True
+    if results['import_ms'] > args.budget_ms:
+        print(f"FAIL: import took {results['import_ms']:.0f} ms, over the {args.budget_ms:.0f} ms budget")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
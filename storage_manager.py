@@ -0,0 +1,136 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Optional
+
+from post_cache import PostCache
+
+logger = logging.getLogger(__name__)
+
+
+class StorageManager:
+    def __init__(self, cache: PostCache, quota_bytes: int, policy: str = "lru",
+                 check_interval: float = 300, min_age: float = 300):
+        """
+        Keep the downloads directory under a byte quota
+
+        Sizes and access times come from the post index, which is updated by
+        download_post writes and load_saved_post hits. A post's blobs are
+        deleted with it unless another post still links to them. Evicted posts
+        keep their metadata and Telegram file_ids, so they can still be resent
+        by id or downloaded again on demand.
+
+        Args:
+            cache: post index of the download directory
+            quota_bytes: maximum bytes of media on disk (0 disables eviction)
+            policy: 'lru' or 'lfu'
+            check_interval: seconds between periodic checks
+            min_age: never evict posts accessed within this many seconds
+        """
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+
+        self.cache = cache
+        self.quota_bytes = quota_bytes
+        self.policy = policy
+        self.check_interval = check_interval
+        self.min_age = min_age
+
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def evict_if_needed(self) -> int:
+        """
+        Delete media of the coldest posts until usage is under the quota
+
+        Returns:
+            number of bytes freed
+        """
+        if self.quota_bytes <= 0:
+            return 0
+
+        # Blobs orphaned by re-downloads with changed content
+        freed = self._delete_orphaned_blobs()
+        usage = self.cache.storage_usage() + freed
+        while usage - freed > self.quota_bytes:
+            candidates = self.cache.eviction_candidates(self.policy, accessed_before=time.time() - self.min_age)
+            if not candidates:
+                logger.warning(f"Storage over quota ({usage - freed} bytes) but nothing is old enough to evict")
+                break
+
+            for candidate in candidates:
+                if usage - freed <= self.quota_bytes:
+                    break
+                self._delete_files(candidate['paths'])
+                self.cache.mark_evicted(candidate['shortcode'])
+                # Only blobs no other post links to actually free space
+                released = self._delete_orphaned_blobs()
+                freed += released
+                logger.info(f"Evicted {candidate['shortcode']} ({released} of {candidate['total_size']} bytes freed)")
+
+        return freed
+
+    def _delete_orphaned_blobs(self) -> int:
+        """Delete blobs that lost their last reference, returns bytes freed"""
+        freed = 0
+        for sha256, size in self.cache.pop_orphaned_blobs():
+            self.cache.blobs.remove(sha256)
+            freed += size
+        return freed
+
+    @staticmethod
+    def _delete_files(paths: list):
+        for file_path in paths:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not delete {file_path}: {e}")
+
+        # Remove the post directory once it is empty
+        for directory in {os.path.dirname(p) for p in paths}:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+
+    def request_eviction(self):
+        """Ask the background task to check the quota now"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        """Start the background eviction task on the running event loop"""
+        if self.quota_bytes <= 0 or self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        logger.info(f"Storage manager started: quota {self.quota_bytes} bytes, {self.policy} eviction")
+
+    async def stop(self):
+        """Stop the background eviction task"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.check_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                # File deletion and index queries stay off the event loop
+                freed = await asyncio.to_thread(self.evict_if_needed)
+                if freed:
+                    logger.info(f"Storage manager freed {freed} bytes")
+            except Exception as e:
+                logger.error(f"Error during eviction: {e}")
@@ -0,0 +1,33 @@
+import uuid
+import logging
+import contextvars
+from typing import Optional
+
+# Trace id of the request being handled, copied into threads by asyncio.to_thread
+_trace_id: contextvars.ContextVar = contextvars.ContextVar('trace_id', default='-')
+
+
+def new_trace_id(trace_id: Optional[str] = None) -> str:
+    """Start a trace for the current request and return its id"""
+    trace_id = trace_id or uuid.uuid4().hex[:8]
+    _trace_id.set(trace_id)
+    return trace_id
+
+
+def current_trace_id() -> str:
+    return _trace_id.get()
+
+
+class TraceIdFilter(logging.Filter):
+    """Add the current trace id to log records as `trace_id`"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.trace_id = _trace_id.get()
+        return True
+
+
+def install_trace_ids(log_format: str):
+    """Prefix every log line of the root handlers with the request's trace id"""
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceIdFilter())
+        handler.setFormatter(logging.Formatter(log_format))
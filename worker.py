@@ -0,0 +1,105 @@
+import time
+import socket
+import asyncio
+import logging
+import multiprocessing
+
+from telegram import Bot
+
+from config import BOT_TOKEN, WORKER_PROCESSES, WORKER_CONCURRENCY, WORKER_POLL_INTERVAL, METRICS_PORT, METRICS_ADDR
+from bot import InstagramDownloadBot, job_message
+from metrics import start_http_server
+
+logger = logging.getLogger(__name__)
+
+# How often a worker puts jobs of crashed workers back in the queue
+STALE_CHECK_INTERVAL = 60
+
+
+async def run_worker(worker_id: str):
+    """Claim jobs from the shared queue and process them until cancelled"""
+    app = InstagramDownloadBot()
+    queue = app.download_queue
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    tasks = set()
+
+    async def handle(job: dict):
+        try:
+            # process_job completes or fails the job in the queue itself
+            await app.process_job(bot, job['chat_id'], job['user_id'], job_message(bot, job), job['url'], job['id'])
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {e}")
+            await asyncio.to_thread(queue.fail, job['id'], str(e))
+        finally:
+            slots.release()
+
+    async with Bot(BOT_TOKEN) as bot:
+        # Leftovers of this worker's previous run; other workers' downloads are younger
+        await asyncio.to_thread(app.cleanup_interrupted, queue.stale_after)
+        # Jobs this worker was running when it was stopped are taken back right away
+        for job in await asyncio.to_thread(queue.resume_interrupted, worker_id):
+            await slots.acquire()
+            task = asyncio.create_task(handle(job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        app.storage.start()
+        logger.info(f"Worker {worker_id} started, {WORKER_CONCURRENCY} concurrent jobs")
+        last_stale_check = 0.0
+        try:
+            while True:
+                if time.monotonic() - last_stale_check > STALE_CHECK_INTERVAL:
+                    await asyncio.to_thread(queue.requeue_stale)
+                    last_stale_check = time.monotonic()
+
+                await slots.acquire()
+                job = await asyncio.to_thread(queue.claim, worker_id)
+                if job is None:
+                    slots.release()
+                    await asyncio.sleep(WORKER_POLL_INTERVAL)
+                    continue
+
+                logger.info(f"Worker {worker_id} took job {job['id']}: {job['url']}")
+                task = asyncio.create_task(handle(job))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            await app.storage.stop()
+            await app.executor.aclose()
+            await app.close_stream_clients()
+            app.executor.shutdown(wait=False)
+
+
+def _worker_main(index: int):
+    # Stable across restarts, so a restarted worker can resume its own jobs
+    worker_id = f"{socket.gethostname()}-{index}"
+    if METRICS_PORT:
+        # The bot serves METRICS_PORT, each worker process the ports after it
+        start_http_server(METRICS_PORT + 1 + index, METRICS_ADDR)
+    try:
+        asyncio.run(run_worker(worker_id))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    """Start worker processes that serve jobs queued by the bot in WORKER_MODE=queue"""
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN not found! Please set it in your environment variables.")
+        return
+
+    processes = [multiprocessing.Process(target=_worker_main, args=(i,), name=f"worker-{i}") for i in range(WORKER_PROCESSES)]
+    for process in processes:
+        process.start()
+    logger.info(f"Started {len(processes)} worker processes")
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        logger.info("Stopping workers...")
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()